@@ -238,6 +238,9 @@ class Application(object):
     :cvar bool searchable: If True, show search box in the left menu of this
         Application. Default is True.
     :cvar bool exportable: Default is False, Application can't be exported to json.
+    :ivar bulk_export_archive: Set during a streaming bulk export; attachments
+        are written into this :class:`~allura.tasks.export_tasks.ExportArchive`
+        by :meth:`save_attachments` instead of to the filesystem.
     :cvar list permissions: Named permissions used by instances of this
         Application. Default is [].
     :cvar dict permissions_desc: Descriptions of the named permissions.
@@ -294,6 +297,7 @@ class Application(object):
     max_instances = float("inf")
     searchable = False
     exportable = False
+    bulk_export_archive = None
     DiscussionClass = model.Discussion
     PostClass = model.Post
     AttachmentClass = model.DiscussionAttachment
@@ -796,6 +800,12 @@ def make_dir_for_attachments(self, path):
                 os.makedirs(path)
 
     def save_attachments(self, path, attachments):
+        if self.bulk_export_archive is not None:
+            for attachment in attachments:
+                self.bulk_export_archive.write_stream(
+                    os.path.join(path, os.path.basename(attachment.filename)),
+                    attachment.rfile())
+            return
         self.make_dir_for_attachments(path)
         for attachment in attachments:
             attachment_path = os.path.join(
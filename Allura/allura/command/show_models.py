@@ -174,9 +174,11 @@ def _post_add_artifacts(self, chunk):
         """
         try:
             with self.ming_config(self.options.ming_config):
+                # don't let queued tasks coalesce into chunks bigger than asked for
                 add_artifacts.post(chunk,
                                    update_solr=self.options.solr,
                                    update_refs=self.options.refs,
+                                   coalesce_max_items=self.options.max_chunk,
                                    **self.add_artifact_kwargs)
         except InvalidDocument as e:
             # there are many types of InvalidDocument, only recurse if its
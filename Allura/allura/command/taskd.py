@@ -21,6 +21,7 @@
 
 import re
 import logging
+import logging.config
 import os
 import time
 import six.moves.queue
@@ -30,10 +31,11 @@
 import sys
 
 import faulthandler
+import resource
 from setproctitle import setproctitle, getproctitle
 import tg
-from paste.deploy import loadapp
-from paste.deploy.converters import asint
+from paste.deploy import loadapp, appconfig
+from paste.deploy.converters import asint, aslist
 from webob import Request
 
 from . import base
@@ -58,20 +60,47 @@ def proctitle(title):
         raise
 
 
+def memory_mb():
+    '''Current resident memory of this process, in MB'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf(str('SC_PAGE_SIZE')) // (1024 * 1024)
+    except (IOError, OSError, ValueError, IndexError):
+        # no procfs: fall back to the peak RSS (in KB on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
 class TaskdCommand(base.Command):
     summary = 'Task server'
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='claim up to this many ready tasks of the same name at once, and run them in one go '
+                           '(useful for floods of small tasks, like indexing)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--supervisor', dest='supervisor', action="store_true", default=False,
+                      help='fork and supervise a pool of worker processes for each task group configured '
+                           'with taskd.pools in the ini file')
+
+    children = {}
+    supervised = False
 
     def command(self):
         setproctitle('taskd')
-        self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        self.setup_signals()
+        if self.options.supervisor:
+            self.supervise()
+            return
+        self.basic_setup()
         base.log.info('Starting taskd, pid %s' % os.getpid())
+        self.worker()
+
+    def setup_signals(self):
         signal.signal(signal.SIGHUP, self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
         signal.signal(signal.SIGUSR1, self.log_current_task)
@@ -81,7 +110,6 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -89,12 +117,116 @@ def graceful_restart(self, signum, frame):
             (os.getpid(), signum))
         self.keep_running = False
         self.restart_when_done = True
+        self.signal_children(signal.SIGTERM)
 
     def graceful_stop(self, signum, frame):
         base.log.info(
             'taskd pid %s recieved signal %s preparing to do a graceful stop' %
             (os.getpid(), signum))
         self.keep_running = False
+        self.signal_children(signal.SIGTERM)
+
+    def signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def load_pools(self, conf):
+        '''Read the worker pools for --supervisor mode from the ini file::
+
+            taskd.pools = indexing, mail, default
+            taskd.pool.indexing.tasks = allura.tasks.index_tasks.
+            taskd.pool.indexing.workers = 2
+            taskd.pool.mail.tasks = allura.tasks.mail_tasks.
+            taskd.pool.mail.workers = 1
+            taskd.pool.default.workers = 2
+
+        Task names ending in ``.`` are prefixes.  A pool without ``tasks``
+        handles every task not handled by another pool.
+        '''
+        pools = []
+        for name in aslist(conf.get('taskd.pools', 'default'), ','):
+            prefix = 'taskd.pool.%s.' % name
+            pools.append(dict(
+                name=name,
+                only=aslist(conf.get(prefix + 'tasks'), ','),
+                exclude=[],
+                workers=asint(conf.get(prefix + 'workers', 1))))
+        claimed = [t for pool in pools for t in pool['only']]
+        for pool in pools:
+            if not pool['only']:
+                pool['exclude'] = claimed
+        if all(pool['only'] for pool in pools):
+            log.warning('No catch-all taskd pool configured; tasks not listed in any pool will not run')
+        return pools
+
+    def supervise(self):
+        '''Fork the configured worker pools and keep them running, replacing
+        workers as they exit (e.g. after hitting taskd.max_tasks or
+        taskd.max_memory_mb).  Workers are forked before any database
+        connections are made; each one does its own setup.
+        '''
+        conf = appconfig('config:%s' % self.args[0], relative_to=os.getcwd())
+        logging.config.fileConfig(self.args[0].split('#')[0], disable_existing_loggers=False)
+        base.log = logging.getLogger('allura.command')
+        base.log.info('Starting taskd supervisor, pid %s' % os.getpid())
+        setproctitle('taskd:supervisor')
+        for pool in self.load_pools(conf):
+            for i in range(pool['workers']):
+                self.spawn(pool)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                break
+            pool, started = self.children.pop(pid, (None, None))
+            if pool is None:
+                continue
+            base.log.info('taskd worker pid %s for pool %s exited with status %s',
+                          pid, pool['name'], status)
+            if self.keep_running:
+                if time.time() - started < 10:
+                    # don't fork-bomb if workers are dying immediately
+                    time.sleep(10)
+                self.spawn(pool)
+        base.log.info('taskd supervisor pid %s stopping gracefully.' % os.getpid())
+        if self.restart_when_done:
+            base.log.info('taskd supervisor pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def spawn(self, pool):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (pool, time.time())
+            return pid
+        self.children = {}
+        self.supervised = True
+        status = 0
+        try:
+            setproctitle('taskd:%s' % pool['name'])
+            self.basic_setup()
+            base.log.info('Starting taskd worker for pool %s, pid %s' % (pool['name'], os.getpid()))
+            self.worker(only=pool['only'], exclude=pool['exclude'])
+        except Exception:
+            base.log.exception('taskd worker for pool %s failed', pool['name'])
+            status = 1
+        finally:
+            os._exit(status)
+
+    def should_recycle(self, tasks_run):
+        '''Whether this worker should be replaced with a fresh process'''
+        max_tasks = asint(tg.config.get('taskd.max_tasks', 0))
+        if max_tasks and tasks_run >= max_tasks:
+            base.log.info('taskd pid %s ran %s tasks, recycling' % (os.getpid(), tasks_run))
+            return True
+        max_memory = asint(tg.config.get('taskd.max_memory_mb', 0))
+        memory = max_memory and memory_mb()
+        if max_memory and memory >= max_memory:
+            base.log.info('taskd pid %s using %sMB, recycling' % (os.getpid(), memory))
+            return True
+        return False
 
     def log_current_task(self, signum, frame):
         entry = 'taskd pid %s is currently handling task %s' % (
@@ -102,15 +234,15 @@ def log_current_task(self, signum, frame):
         status_log.info(entry)
         base.log.info(entry)
 
-    def worker(self):
+    def worker(self, only=None, exclude=None):
         from allura import model as M
         name = '%s pid %s' % (os.uname()[1], os.getpid())
         wsgi_app = loadapp('config:%s#task' %
                            self.args[0], relative_to=os.getcwd())
         poll_interval = asint(tg.config.get('monq.poll_interval', 10))
-        only = self.options.only
-        if only:
-            only = only.split(',')
+        if only is None and self.options.only:
+            only = self.options.only.split(',')
+        tasks_run = 0
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -121,6 +253,13 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        wakeup = M.MonQWakeup(only=only, exclude=exclude)
+
+        def waitfunc_wakeup():
+            # polling remains the fallback: wait() returns after poll_interval
+            # even if no signal arrives
+            wakeup.wait(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -129,29 +268,51 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if M.MonQWakeup.enabled():
+            waitfunc = waitfunc_wakeup
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                        process=name,
-                        waitfunc=waitfunc,
-                        only=only)
+                    if self.options.batch_size > 1:
+                        self.task = M.MonQTask.get_batch(
+                            process=name,
+                            size=self.options.batch_size,
+                            waitfunc=waitfunc,
+                            only=only,
+                            exclude=exclude)
+                    else:
+                        self.task = M.MonQTask.get(
+                            process=name,
+                            waitfunc=waitfunc,
+                            only=only,
+                            exclude=exclude)
                     if self.task:
-                        with(proctitle("taskd:{0}:{1}".format(
-                                self.task.task_name, self.task._id))):
+                        if isinstance(self.task, list):
+                            first = self.task[0]
+                            title = "taskd:{0}:{1}+{2}".format(first.task_name, first._id, len(self.task) - 1)
+                            environ = {'tasks': self.task}
+                        else:
+                            first = self.task
+                            title = "taskd:{0}:{1}".format(first.task_name, first._id)
+                            environ = {'task': self.task}
+                        environ['nocapture'] = self.options.nocapture
+                        with(proctitle(title)):
                             # Build the (fake) request
-                            request_path = '/--%s--/%s/' % (self.task.task_name,
-                                                            self.task._id)
+                            request_path = '/--%s--/%s/' % (first.task_name,
+                                                            first._id)
                             r = Request.blank(request_path,
                                               base_url=tg.config['base_url'].rstrip(
                                                   '/') + request_path,
-                                              environ={'task': self.task,
-                                                       'nocapture': self.options.nocapture,
-                                                       })
+                                              environ=environ)
                             list(wsgi_app(r.environ, start_response))
+                            tasks_run += len(self.task) if isinstance(self.task, list) else 1
                             self.task = None
+                        if self.should_recycle(tasks_run):
+                            self.keep_running = False
+                            self.restart_when_done = True
             except Exception as e:
                 if self.keep_running:
                     base.log.exception(
@@ -161,7 +322,8 @@ def waitfunc_checks_running():
                     base.log.exception('taskd error %s' % e)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
+        if self.restart_when_done and not self.supervised:
+            # supervised workers just exit, and the supervisor starts a new one
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
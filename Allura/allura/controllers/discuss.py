@@ -604,9 +604,12 @@ def reply(self, **kw):
 class ThreadRestController(ThreadController):
 
     @expose('json:')
-    def index(self, limit=25, page=None, **kw):
+    def index(self, limit=25, page=None, cursor=None, **kw):
         limit, page = h.paging_sanitizer(limit, page)
-        return dict(thread=self.thread.__json__(limit=limit, page=page))
+        try:
+            return dict(thread=self.thread.__json__(limit=limit, page=page, cursor=cursor))
+        except ValueError:
+            raise exc.HTTPBadRequest('Invalid cursor')
 
     @h.vardec
     @expose()
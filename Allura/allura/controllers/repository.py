@@ -249,10 +249,16 @@ def commit_browser_data(self, start=None, limit=None, **kw):
             head_ids = [head.object_id for head in c.app.repo.get_heads()]
         log.debug('Got %s heads', len(head_ids))
 
+        graph = c.app.repo.commit_graph
+        if graph is not None and not all(head_id in graph for head_id in head_ids):
+            graph = None  # not refreshed yet
         # recent commits from any head
-        heads_log = list(c.app.repo.log(head_ids, id_only=True, limit=int(limit)))
+        if graph is not None:
+            commit_ids = list(graph.log(head_ids, limit=int(limit)))
+        else:
+            heads_log = list(c.app.repo.log(head_ids, id_only=True, limit=int(limit)))
+            commit_ids = [c.app.repo.rev_to_commit_id(r) for r in heads_log]
         log.debug('Did log lookup')
-        commit_ids = [c.app.repo.rev_to_commit_id(r) for r in heads_log]
 
         # any we didn't get to will be attempted in next page of commits
         next_page_commits = list(set(head_ids) - set(commit_ids))
@@ -269,9 +275,13 @@ def commit_browser_data(self, start=None, limit=None, **kw):
         children = defaultdict(list)
         dates = {}
         for row, (oid, ci) in enumerate(six.iteritems(commits_by_id)):
-            parents[oid] = list(ci.parent_ids)
-            dates[oid] = ci.committed.date
-            for p_oid in ci.parent_ids:
+            if graph is not None:
+                parents[oid] = graph.parent_ids(oid)
+                dates[oid] = graph.date(oid)
+            else:
+                parents[oid] = list(ci.parent_ids)
+                dates[oid] = ci.committed.date
+            for p_oid in parents[oid]:
                 children[p_oid].append(oid)
         result = []
         row = 0
@@ -311,6 +321,11 @@ class RepoRestController(RepoRootController, AppRestControllerMixin):
 
     @expose('json:')
     def index(self, **kw):
+        graph = c.app.repo.commit_graph
+        head_ids = [head.object_id for head in c.app.repo.get_heads()]
+        if graph is not None and head_ids and all(head_id in graph for head_id in head_ids):
+            # only the commits still reachable, like new_commits() below
+            return dict(commit_count=graph.count(head_ids))
         all_commits = c.app.repo._impl.new_commits(all_commits=True)
         return dict(commit_count=len(all_commits))
 
@@ -34,9 +34,14 @@ class TaskController(object):
     def __call__(self, environ, context):
         # see TGController / CoreDispatcher for reference on how this works on a normal controllers
 
-        task = environ['task']
         nocapture = environ['nocapture']
-        result = task(restore_context=False, nocapture=nocapture)
+        if 'tasks' in environ:
+            from allura import model as M
+            results = M.MonQTask.run_batch(environ['tasks'], restore_context=False, nocapture=nocapture)
+            result = '\n'.join(six.text_type(r) for r in results if r)
+        else:
+            task = environ['task']
+            result = task(restore_context=False, nocapture=nocapture)
         py_response = context.response
         py_response.headers['Content-Type'] = str('text/plain')  # `None` default is problematic for some middleware
         py_response.body = six.ensure_binary(result or b'')
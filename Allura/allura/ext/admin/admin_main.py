@@ -622,6 +622,7 @@ def _update_mounts(self, subproject=None, tool=None, new=None, **kw):
                     ordinal=int(new['ordinal']) if 'ordinal' in new else None,
                     **config_on_install)
         g.post_event('project_updated')
+        c.project.invalidate_nav_cache()
         g.post_event('project_menu_updated')
         return new_app
 
@@ -719,6 +720,7 @@ def mount_order(self, **kw):
                 if p:
                     p.ordinal = int(ordinal)
         M.AuditLog.log('Updated tool order')
+        c.project.invalidate_nav_cache()
         g.post_event('project_menu_updated')
         return {'status': 'ok'}
 
@@ -735,6 +737,7 @@ def configure_tool_grouping(self, grouping_threshold='1', **kw):
             raise exc.HTTPBadRequest('Invalid threshold. Expected a value between 1 and 10')
 
         M.AuditLog.log('Updated tool grouping threshold')
+        c.project.invalidate_nav_cache()
         g.post_event('project_menu_updated')
         return {'status': 'ok'}
 
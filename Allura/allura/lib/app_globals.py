@@ -67,6 +67,8 @@
 from allura.lib.widgets import analytics
 from allura.lib.security import Credentials
 from allura.lib.solr import MockSOLR, make_solr_from_config
+from allura.lib.markdown_cache import MarkdownRenderCache
+from allura.lib.nav_cache import NavbarCache
 from allura.model.session import artifact_orm_session
 import six
 
@@ -77,6 +79,16 @@
 
 class ForgeMarkdown(markdown.Markdown):
 
+    # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+    bugfix_rev = 4
+
+    def __init__(self, *args, **kwargs):
+        # g.markdown_render_cache, and a name for how this instance is configured
+        # (only instances given both use the cache)
+        self.render_cache = kwargs.pop('render_cache', None)
+        self.cache_variant = kwargs.pop('cache_variant', None)
+        markdown.Markdown.__init__(self, *args, **kwargs)
+
     def convert(self, source, render_limit=True):
         if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it,
@@ -84,8 +96,21 @@ def convert(self, source, render_limit=True):
             log.info('Text is too big. Skipping markdown processing')
             escaped = cgi.escape(h.really_unicode(source))
             return Markup('<pre>%s</pre>' % escaped)
+        cache_key = None
+        if self.render_cache is not None and self.cache_variant and self.render_cache.cacheable(source):
+            # links resolve relative to the current project & tool
+            project_id = getattr(getattr(c, 'project', None), '_id', None)
+            app_config_id = getattr(getattr(getattr(c, 'app', None), 'config', None), '_id', None)
+            cache_key = self.render_cache.key(h.really_unicode(source), self.cache_variant, self.bugfix_rev,
+                                              project_id, app_config_id)
+            html = self.render_cache.get(cache_key)
+            if html is not None:
+                return Markup(html)
         try:
-            return markdown.Markdown.convert(self, source)
+            html = markdown.Markdown.convert(self, source)
+            if cache_key is not None:
+                self.render_cache.put(cache_key, html)
+            return html
         except Exception:
             log.info('Invalid markdown: %s  Upwards trace is %s', source,
                      ''.join(traceback.format_stack()), exc_info=True)
@@ -111,7 +136,7 @@ def cached_convert(self, artifact, field_name):
                 field_name, artifact.__class__.__name__)
             return self.convert(source_text)
 
-        bugfix_rev = 4  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+        bugfix_rev = self.bugfix_rev
         md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
@@ -451,7 +476,9 @@ def forge_markdown(self, **kwargs):
                         ForgeExtension(**kwargs), EmojiExtension(), UserMentionExtension(),
                         'markdown.extensions.tables', 'markdown.extensions.toc', 'markdown.extensions.nl2br',
                         'markdown_checklist.extension'],
-            output_format='html4')
+            output_format='html4',
+            render_cache=self.markdown_render_cache,
+            cache_variant='forge:' + ','.join('%s=%s' % kv for kv in sorted(kwargs.items())))
 
     @property
     def markdown(self):
@@ -473,7 +500,24 @@ def markdown_commit(self):
         """
         app = getattr(c, 'app', None)
         return ForgeMarkdown(extensions=[CommitMessageExtension(app), EmojiExtension(), 'markdown.extensions.nl2br'],
-                             output_format='html4')
+                             output_format='html4',
+                             render_cache=self.markdown_render_cache, cache_variant='commit')
+
+    @LazyProperty
+    def markdown_render_cache(self):
+        """Process-wide cache of rendered markdown, or None if not enabled.
+        See :class:`allura.lib.markdown_cache.MarkdownRenderCache`
+
+        """
+        return MarkdownRenderCache.from_config(config, M.main_doc_session.db)
+
+    @LazyProperty
+    def navbar_cache(self):
+        """Process-wide cache of project navbars, or None if not enabled.
+        See :class:`allura.lib.nav_cache.NavbarCache`
+
+        """
+        return NavbarCache.from_config(config)
 
     @property
     def production_mode(self):
@@ -67,17 +67,35 @@ def myotherfunc():
             # No email notifications will be sent for c.project during this task
             pass
 
+        @task(coalesce=True)
+        def mylistfunc(ids):
+            # Posting this while an earlier call (same context) is still queued
+            # merges ``ids`` into the queued task instead of adding a new one
+            pass
+
+        @task(coalesce=True, coalesce_max_items=1000)
+        def mysmallerlistfunc(ids):
+            # as above, but queued tasks don't grow past 1000 ids.  The cap can
+            # also be given per call: ``mylistfunc.post(ids, coalesce_max_items=10)``
+            pass
+
     """
     def task_(func):
         def post(*args, **kwargs):
             delay = kwargs.pop('delay', 0)
             flush_immediately = kwargs.pop('flush_immediately', True)
+            coalesce_kw = {}
+            for limit in ('coalesce_max_items', 'coalesce_max_bytes'):
+                value = kwargs.pop(limit, kw.get(limit))
+                if value is not None:
+                    coalesce_kw[limit] = value
             project = getattr(c, 'project', None)
             cm = (h.notifications_disabled if project and
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay, flush_immediately=flush_immediately)
+                return M.MonQTask.post(func, args, kwargs, delay=delay, flush_immediately=flush_immediately,
+                                       coalesce=kw.get('coalesce', False), **coalesce_kw)
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
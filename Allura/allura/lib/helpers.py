@@ -60,6 +60,7 @@
 from tg import tmpl_context as c, app_globals as g
 from tg import response, request
 from tg.decorators import before_validate
+from tg.wsgiapp import RequestLocals
 from formencode.variabledecode import variable_decode
 import formencode
 from jinja2 import Markup
@@ -290,6 +291,29 @@ def make_app_admin_only(app):
         app.acl.remove(ace)
 
 
+class WorkerContext(object):
+    pass
+
+
+@contextmanager
+def worker_context(**kw):
+    '''
+    Set up the tg context (with c.* from `kw`) for work done in a worker
+    thread, and clean up the thread's ming sessions afterwards
+    '''
+    from ming.orm import ThreadLocalORMSession
+    tgl = RequestLocals()
+    tgl.tmpl_context = WorkerContext()
+    tgl.tmpl_context.__dict__.update(kw)
+    tgl.app_globals = g._current_obj()
+    tg.request_local.context._push_object(tgl)
+    try:
+        yield
+    finally:
+        ThreadLocalORMSession.close_all()
+        tg.request_local.context._pop_object()
+
+
 @contextmanager
 def push_config(obj, **kw):
     # if you need similar for a dict, use mock.patch.dict
@@ -20,6 +20,9 @@
 import re
 import logging
 import smtplib
+import threading
+import time
+from concurrent import futures
 import email.parser
 from six.moves.email_mime_multipart import MIMEMultipart
 from six.moves.email_mime_text import MIMEText
@@ -262,12 +265,23 @@ class SMTPClient(object):
 
     def __init__(self):
         self._client = None
+        self.stats = dict(messages=0, recipients=0, errors=0, time=0.0)
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
             sender=None, references=None, cc=None, to=None):
+        prepared = self.prepare(addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
+                                sender=sender, references=references, cc=cc, to=to)
+        if prepared:
+            self.send(*prepared)
+
+    @staticmethod
+    def prepare(addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
+                sender=None, references=None, cc=None, to=None):
+        """Set the headers on `message` and return (smtp addresses, content)
+        to pass to :meth:`send`, or None if there's no one to send it to."""
         if not addrs:
-            return
+            return None
         if to:
             message['To'] = AddrHeader(h.really_unicode(to))
         else:
@@ -297,18 +311,32 @@ def sendmail(
         if not smtp_addrs:
             log.warning('No valid addrs in %s, so not sending mail',
                         list(map(six.text_type, addrs)))
-            return
+            return None
+        return smtp_addrs, content
+
+    def send(self, smtp_addrs, content):
+        """Send content over the current connection, reconnecting (once) if
+        there isn't one or it fails"""
+        start = time.time()
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            try:
+                self._client.sendmail(
+                    config.return_path,
+                    smtp_addrs,
+                    content)
+            except Exception:
+                self._connect()
+                self._client.sendmail(
+                    config.return_path,
+                    smtp_addrs,
+                    content)
         except Exception:
-            self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            self.stats['errors'] += 1
+            raise
+        finally:
+            self.stats['time'] += time.time() - start
+        self.stats['messages'] += 1
+        self.stats['recipients'] += len(smtp_addrs)
 
     def _connect(self):
         if asbool(tg.config.get('smtp_ssl', False)):
@@ -329,3 +357,64 @@ def _connect(self):
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
         self._client = smtp_client
+
+
+class SMTPClientPool(object):
+    """A set of persistent SMTP connections to send many messages at once.
+
+    Each connection is kept open between calls and sends its share of the
+    messages one after another on the same SMTP session, so there's no
+    connection setup (or login/TLS) per message.
+    """
+
+    def __init__(self, size=None):
+        self._size = size
+        self._clients = []
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        if self._size is None:
+            return max(asint(tg.config.get('smtp_pool_size', 4)), 1)
+        return self._size
+
+    def _get_clients(self, n):
+        with self._lock:
+            while len(self._clients) < n:
+                self._clients.append(SMTPClient())
+            return self._clients[:n]
+
+    def send_all(self, messages):
+        """Send a list of (smtp addresses, content) as returned by
+        :meth:`SMTPClient.prepare`.  Returns the messages that couldn't be
+        sent."""
+        if not messages:
+            return []
+        clients = self._get_clients(min(self.size, len(messages)))
+        # each connection gets every n-th message
+        shares = [(client, messages[i::len(clients)]) for i, client in enumerate(clients)]
+        if len(shares) == 1:
+            return self._send_share(*shares[0])
+        with futures.ThreadPoolExecutor(max_workers=len(shares)) as executor:
+            return [msg for failed in executor.map(lambda share: self._send_share(*share), shares)
+                    for msg in failed]
+
+    @staticmethod
+    def _send_share(client, messages):
+        failed = []
+        for smtp_addrs, content in messages:
+            try:
+                client.send(smtp_addrs, content)
+            except Exception:
+                log.exception('Error sending mail to %s', smtp_addrs)
+                failed.append((smtp_addrs, content))
+        return failed
+
+    @property
+    def stats(self):
+        totals = dict(messages=0, recipients=0, errors=0, time=0.0)
+        with self._lock:
+            for client in self._clients:
+                for k, v in six.iteritems(client.stats):
+                    totals[k] += v
+        return totals
@@ -0,0 +1,150 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""Process-wide (and optionally shared) cache of rendered markdown"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+import pymongo
+import six
+from paste.deploy.converters import asbool, asint
+
+log = logging.getLogger(__name__)
+
+
+class MarkdownRenderCache(object):
+
+    """LRU cache of rendered markdown html, keyed by a hash of the source text,
+    the markdown variant (wiki, email, commit message, etc) and the project/app
+    it was rendered for.
+
+    Entries are evicted least-recently-used first once their total size goes
+    over `max_size` bytes.  If a pymongo `collection` is given, it is used as a
+    second tier shared between processes: it should be a capped collection, so
+    mongo takes care of evicting from it.
+
+    Text containing macros is never cached, since macros render differently
+    depending on who is looking.  Neither is text with artifact links,
+    @mentions or trac-style refs, since how those render depends on the state
+    of what they point to (e.g. missing or closed artifacts), which can
+    change at any time in any process.
+    """
+
+    uncacheable_re = re.compile(r'\[|@\w|(?<!\w)[#r]\d|ticket:\d')
+
+    def __init__(self, max_size=50 * 1024 * 1024, collection=None):
+        self.max_size = max_size
+        self.collection = collection
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = dict(hits=0, shared_hits=0, misses=0, evictions=0)
+
+    @classmethod
+    def from_config(cls, config, db=None):
+        """Create the cache from `markdown_render_cache.*` settings, or return
+        None if it isn't enabled"""
+        if not asbool(config.get('markdown_render_cache', False)):
+            return None
+        collection = None
+        if db is not None and asbool(config.get('markdown_render_cache.shared', False)):
+            collection = cls.shared_collection(
+                db, asint(config.get('markdown_render_cache.shared_size', 256 * 1024 * 1024)))
+        return cls(max_size=asint(config.get('markdown_render_cache.max_size', 50 * 1024 * 1024)),
+                   collection=collection)
+
+    @staticmethod
+    def shared_collection(db, size, name=str('markdown_render_cache')):
+        if not db.list_collection_names(filter={'name': name}):
+            try:
+                db.create_collection(name, capped=True, size=size)
+            except pymongo.errors.CollectionInvalid:
+                pass  # created concurrently by another process
+        return db[name]
+
+    @classmethod
+    def cacheable(cls, source):
+        return not cls.uncacheable_re.search(source)
+
+    @staticmethod
+    def key(source, variant, bugfix_rev, project_id=None, app_config_id=None):
+        md5 = hashlib.md5(source.encode('utf-8')).hexdigest()
+        return '%s:%s:%s:%s:%s' % (md5, variant, bugfix_rev, project_id, app_config_id)
+
+    def get(self, key):
+        """Return the cached html for `key`, or None"""
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return html
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one({'_id': key})
+            except pymongo.errors.PyMongoError:
+                log.warning('Error reading shared markdown cache', exc_info=True)
+                doc = None
+            if doc is not None:
+                with self._lock:
+                    self.stats['shared_hits'] += 1
+                self._store(key, doc['html'])
+                return doc['html']
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, html):
+        html = six.text_type(html)
+        self._store(key, html)
+        if self.collection is not None:
+            try:
+                self.collection.insert_one({'_id': key, 'html': html})
+            except pymongo.errors.DuplicateKeyError:
+                pass  # same key means same html, cached by another process
+            except pymongo.errors.PyMongoError:
+                # e.g. doc too big for the capped collection
+                log.warning('Error writing shared markdown cache', exc_info=True)
+
+    def _store(self, key, html):
+        size = len(html)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = html
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
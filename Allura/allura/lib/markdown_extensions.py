@@ -246,10 +246,12 @@ def __init__(self, wiki=False, email=False, macro_context=None):
         self._use_wiki = wiki
         self._is_email = email
         self._macro_context = macro_context
+        self.prefetched_links = {}
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('prefetch_links', ForgeLinkPrefetchPreprocessor(md, ext=self), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -273,6 +275,35 @@ def extendMarkdown(self, md, md_globals):
 
     def reset(self):
         self.forge_link_tree_processor.reset()
+        self.prefetched_links = {}
+
+    def lookup_link(self, link):
+        '''Return (shortlink, ref, artifact) for an artifact link, using the
+        results of :class:`ForgeLinkPrefetchPreprocessor` when available'''
+        if link in self.prefetched_links:
+            return self.prefetched_links[link]
+        if not ForgeLinkPattern.is_artifact_link(link):
+            return None, None, None
+        shortlink = M.Shortlink.lookup(link)
+        ref = shortlink.ref if shortlink else None
+        artifact = ref.artifact if ref else None
+        return shortlink, ref, artifact
+
+    def prefetch_links(self, links):
+        '''Resolve many artifact links at once: one Shortlink.from_links call,
+        one query for their references, and a query per artifact type'''
+        links = [link for link in set(links) if link not in self.prefetched_links]
+        if not links:
+            return
+        shortlinks = M.Shortlink.from_links(*links)
+        ref_ids = [sl.ref_id for sl in shortlinks.values() if sl]
+        refs = {ref._id: ref for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}))}
+        M.ArtifactReference.resolve_artifacts(list(refs.values()))
+        for link in links:
+            shortlink = shortlinks.get(link)
+            ref = refs.get(shortlink.ref_id) if shortlink else None
+            artifact = ref.artifact if ref else None
+            self.prefetched_links[link] = (shortlink, ref, artifact)
 
 
 class EmojiExtension(markdown.Extension):
@@ -330,11 +361,18 @@ def handleMatch(self, m):
 class ForgeLinkPattern(markdown.inlinepatterns.LinkPattern):
 
     artifact_re = re.compile(r'((.*?):)?((.*?):)?(.+)')
+    # links to other sites, which can't be artifact links
+    external_re = re.compile(r'([a-z][a-z0-9+.-]*:)?//|mailto:', re.IGNORECASE)
 
     def __init__(self, *args, **kwargs):
         self.ext = kwargs.pop('ext')
         markdown.inlinepatterns.LinkPattern.__init__(self, *args, **kwargs)
 
+    @classmethod
+    def is_artifact_link(cls, link):
+        '''Whether `link` could be an artifact link, and so worth looking up'''
+        return bool(cls.artifact_re.match(link)) and not cls.external_re.match(link)
+
     def handleMatch(self, m):
         el = markdown.util.etree.Element('a')
         el.text = m.group(2)
@@ -378,10 +416,10 @@ def _expand_alink(self, link, is_link_with_brackets):
         if is_link_with_brackets:
             classes = 'alink'
         href = link
-        shortlink = M.Shortlink.lookup(link)
-        if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
+        shortlink, ref, artifact = self.ext.lookup_link(link)
+        if shortlink and ref and not getattr(artifact, 'deleted', False):
             href = shortlink.url
-            if getattr(shortlink.ref.artifact, 'is_closed', False):
+            if getattr(artifact, 'is_closed', False):
                 classes += ' strikethrough'
             self.ext.forge_link_tree_processor.alinks.append(shortlink)
         elif is_link_with_brackets:
@@ -389,10 +427,10 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
-            shortlink = M.Shortlink.lookup(attach_link[0])
+            shortlink, ref, artifact = self.ext.lookup_link(attach_link[0])
             if shortlink:
                 attach_status = ' notfound'
-                for attach in shortlink.ref.artifact.attachments:
+                for attach in artifact.attachments:
                     if attach.filename == attach_link[1]:
                         attach_status = ''
                 classes += attach_status
@@ -532,6 +570,46 @@ def handleMatch(self, mo):
         return result
 
 
+class ForgeLinkPrefetchPreprocessor(markdown.preprocessors.Preprocessor):
+
+    '''Collect every candidate artifact link in the source, and resolve them
+    all up front so :class:`ForgeLinkPattern` doesn't query for each one.
+
+    Finds both ``[link]`` and ``[text](link)``, skipping the ones
+    :class:`ForgeLinkPattern` wouldn't look up (e.g. links to other sites).
+    Anything else that isn't really a link (e.g. inside a code block) is just
+    an unused lookup.
+    '''
+    link_re = re.compile(r'\[([^\[\]\n]+)\](?:\(\s*<?([^)\s>]+)>?[^)]*\))?')
+
+    def __init__(self, md, ext):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.ext = ext
+
+    def run(self, lines):
+        # links resolve relative to c.project, which may differ between conversions
+        self.ext.prefetched_links = {}
+        links = []
+        for line in lines:
+            if '[' not in line:
+                continue
+            for m in self.link_re.finditer(line):
+                link = m.group(2) or m.group(1)
+                if (link in ('x', ' ', 'TOC') or link.startswith('[')
+                        or not ForgeLinkPattern.is_artifact_link(link)):
+                    continue
+                links.append(link)
+                if '/attachment/' in link and self.ext._use_wiki:
+                    links.append(link.split('/attachment/')[0])
+        if len(links) > 1:
+            try:
+                self.ext.prefetch_links(links)
+            except Exception:
+                # links will be looked up one at a time instead
+                log.exception('Error prefetching links')
+        return lines
+
+
 class ForgeMacroIncludePreprocessor(markdown.preprocessors.Preprocessor):
 
     '''Join include statements to prevent extra <br>'s inserted by nl2br extension.
@@ -0,0 +1,112 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""Process-wide cache of computed project navbars"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+from paste.deploy.converters import asbool, asint
+
+log = logging.getLogger(__name__)
+
+
+class NavbarCache(object):
+
+    """LRU cache of project sitemap / navbar entries.
+
+    Keys start with the project _id, and should include everything else the
+    navbar depends on: a signature of the project's tools and subprojects, and
+    the roles of the user looking at it that its ACLs name (so users with the
+    same permissions share an entry).
+    See :meth:`allura.model.project.Project.nav_cache_key`.
+
+    Entries are deep-copied in and out, since callers modify them.  They also
+    expire after `ttl` seconds, for changes the key doesn't capture.  Hit
+    rates are logged every `report_interval` lookups.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, report_interval=1000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.report_interval = report_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = dict(hits=0, misses=0, evictions=0, invalidations=0)
+
+    @classmethod
+    def from_config(cls, config):
+        """Create the cache from `navbar_cache.*` settings, or return None if
+        it isn't enabled"""
+        if not asbool(config.get('navbar_cache', False)):
+            return None
+        return cls(max_entries=asint(config.get('navbar_cache.max_entries', 10000)),
+                   ttl=asint(config.get('navbar_cache.ttl', 300)),
+                   report_interval=asint(config.get('navbar_cache.report_interval', 1000)))
+
+    def get(self, key):
+        """Return a copy of the cached entries for `key`, or None"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0] < time.time():
+                del self._entries[key]
+                item = None
+            if item is None:
+                self.stats['misses'] += 1
+            else:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+            self._maybe_report()
+        return deepcopy(item[1]) if item is not None else None
+
+    def put(self, key, entries):
+        entries = deepcopy(entries)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, entries)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, project_id):
+        """Drop all the entries for a project"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == project_id]:
+                del self._entries[key]
+            self.stats['invalidations'] += 1
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return float(self.stats['hits']) / lookups if lookups else 0.0
+
+    def _maybe_report(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        if self.report_interval and lookups % self.report_interval == 0:
+            log.info('navbar cache: %.1f%% hit rate over %d lookups, %d entries, %s',
+                     self.hit_rate() * 100, lookups, len(self._entries), self.stats)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -381,15 +381,18 @@ def find_shortlinks(text):
     return [link for link in link_index if link is not None]
 
 
-def artifacts_from_index_ids(index_ids, model, objectid_id=True):
+def artifacts_from_index_ids(index_ids, model=None, objectid_id=True):
     '''
     :param list[str] index_ids: a list of search/subscription/artifact-reference index_id values
-    :param type model: the Artifact class
+    :param type model: the Artifact class.  If not given, index_ids may be for any mix of
+                       artifact types, and are looked up through their ArtifactReferences
     :param bool objectid_id: whether the _id values are ObjectIds
     :return: instances of the model, for each id given
     :rtype: list
     '''
-    # this could be made more flexible to not require the model passed in
+    if model is None:
+        from allura.model import ArtifactReference
+        return [a for a in ArtifactReference.artifacts_by_ids(index_ids) if a is not None]
     ids = [index_id.split('#')[1] for index_id in index_ids]
     if objectid_id:
         ids = [bson.ObjectId(_id) for _id in ids if _id != 'None']
@@ -20,10 +20,15 @@
 
 import json
 import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent import futures
 
 from tg import config
 from paste.deploy.converters import asbool
 import pysolr
+from pysolr import SolrError
 import six
 
 from allura.lib.helpers import shlex_split
@@ -66,29 +71,55 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
     Make a :class:`Solr <Solr>` instance from config defaults.  Use
     `**kwargs` to override any value
     """
+    push_timeout = config.get('solr.push_timeout')
     solr_kwargs = dict(
         commit=asbool(config.get('solr.commit', True)),
         commitWithin=config.get('solr.commitWithin'),
         timeout=int(config.get('solr.long_timeout', 60)),
+        push_timeout=float(push_timeout) if push_timeout else None,
     )
     solr_kwargs.update(kwargs)
     return Solr(push_servers, query_server, **solr_kwargs)
 
 
+class SolrPushError(SolrError):
+
+    """Raised when an update failed on more than one of the push servers.
+
+    `errors` maps each failed server's url to its exception.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(SolrPushError, self).__init__('; '.join(
+            '%s: %r' % (url, exc) for url, exc in six.iteritems(errors)))
+
+
 class Solr(object):
 
     """Solr interface that pushes updates to multiple solr instances.
 
     `push_servers`: list of servers to push to.
     `query_server`: server to read from. Uses `push_servers[0]` if not specified.
+    `push_timeout`: max seconds to wait for each push server.  A server that
+        takes longer is reported as an error, but doesn't hold up the others.
 
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Updates are sent to all the push servers concurrently.  If any of them
+    fail, the rest are still updated and then the error is raised (a
+    :class:`SolrPushError` if several servers failed).  Per-server timings are
+    collected in `push_stats`.
+
+    Each push server gets its own worker thread, so a hung server can't hold
+    up the others.  While a call that timed out is still running, further
+    calls to that server fail straight away rather than queueing behind it.
     """
 
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
+                 commit=True, commitWithin=None, push_timeout=None, **kw):
         self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
@@ -96,30 +127,87 @@ def __init__(self, push_servers, query_server=None,
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.push_timeout = push_timeout
+        self.push_stats = defaultdict(lambda: dict(calls=0, errors=0, timeouts=0, time=0.0))
+        self._lock = threading.Lock()
+        # per push server: its single-thread executor, and a call still
+        # running after it timed out
+        self._executors = [None] * len(self.push_pool)
+        self._hung = [None] * len(self.push_pool)
+
+    def _executor(self, i):
+        with self._lock:
+            if self._executors[i] is None:
+                self._executors[i] = futures.ThreadPoolExecutor(max_workers=1)
+            return self._executors[i]
+
+    def _count(self, url, **incs):
+        with self._lock:
+            stats = self.push_stats[url]
+            for k, v in six.iteritems(incs):
+                stats[k] += v
+
+    def _timed_call(self, solr, method, args, kw):
+        start = time.time()
+        try:
+            return getattr(solr, method)(*args, **kw)
+        finally:
+            elapsed = time.time() - start
+            self._count(solr.url, time=elapsed)
+            log.debug('solr %s to %s took %.3fs', method, solr.url, elapsed)
+
+    def _push(self, method, *args, **kw):
+        """Call `method` on every push server at once and gather the results"""
+        pending = []
+        errors = {}
+        for i, solr in enumerate(self.push_pool):
+            with self._lock:
+                hung = self._hung[i]
+                if hung is not None and hung.done():
+                    hung = self._hung[i] = None
+            if hung is not None:
+                self._count(solr.url, calls=1, timeouts=1)
+                errors[solr.url] = (SolrError, SolrError('%s to %s skipped, an earlier call is still running' % (
+                    method, solr.url)), None)
+                continue
+            pending.append((i, solr, self._executor(i).submit(self._timed_call, solr, method, args, kw)))
+        futures.wait([f for i, solr, f in pending], timeout=self.push_timeout)
+        responses = []
+        for i, solr, future in pending:
+            if not future.done():
+                with self._lock:
+                    self._hung[i] = future
+                self._count(solr.url, calls=1, timeouts=1)
+                errors[solr.url] = (SolrError, SolrError('%s to %s timed out after %ss' % (
+                    method, solr.url, self.push_timeout)), None)
+                continue
+            exc = future.exception()
+            if exc is not None:
+                self._count(solr.url, calls=1, errors=1)
+                errors[solr.url] = (type(exc), exc, getattr(exc, '__traceback__', None))
+                continue
+            self._count(solr.url, calls=1)
+            responses.append(future.result())
+        if len(errors) == 1:
+            six.reraise(*list(errors.values())[0])
+        if errors:
+            raise SolrPushError({url: exc_info[1] for url, exc_info in six.iteritems(errors)})
+        return responses
 
     def add(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        return self._push('add', *args, **kw)
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', *args, **kw)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', *args, **kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
@@ -175,6 +175,45 @@ def chunked_find(cls, query=None, pagesize=1024, sort_key='_id', sort_dir=1):
         page += 1
 
 
+_CURSOR_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_cursor(values):
+    '''
+    Encode the sort key values of the last item of a page into an opaque,
+    url-safe token, for keyset pagination (the next page is then queried as
+    "items sorting after these values", instead of skipping over all the
+    previous pages).  Datetimes are kept to the millisecond, like in mongo.
+    '''
+    def default(obj):
+        if isinstance(obj, datetime.datetime):
+            delta = obj - _CURSOR_EPOCH
+            return {'$date': (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000}
+        raise TypeError(repr(obj))
+    data = json.dumps(list(values), default=default, separators=(',', ':'))
+    return six.ensure_text(base64.urlsafe_b64encode(data.encode('utf-8'))).rstrip('=')
+
+
+def decode_cursor(token):
+    '''
+    Decode a token from :func:`encode_cursor` back into the list of values.
+    Raises ValueError if the token is invalid.
+    '''
+    def object_hook(obj):
+        if list(obj.keys()) == ['$date']:
+            return _CURSOR_EPOCH + datetime.timedelta(milliseconds=obj['$date'])
+        return obj
+    try:
+        token = six.ensure_binary(token)
+        data = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+        values = json.loads(data.decode('utf-8'), object_hook=object_hook)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %r' % token)
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor: %r' % token)
+    return values
+
+
 def chunked_list(l, n):
     """ Yield successive n-sized chunks from l.
     """
@@ -166,11 +166,8 @@ def related_artifacts(self, user=None):
 
         """
         related_artifacts = []
-        for ref_id in self.refs + self.backrefs:
-            ref = ArtifactReference.query.get(_id=ref_id)
-            if ref is None:
-                continue
-            artifact = ref.artifact
+        # load all the artifacts up front, with a query per artifact type
+        for ref, artifact in ArtifactReference.artifacts_by_ids(self.refs + self.backrefs, with_refs=True):
             if artifact is None:
                 continue
             artifact = artifact.primary()
@@ -190,8 +190,9 @@ def attachments_for_json(self, page):
         return [dict(bytes=attach.length,
                      url=h.absurl(attach.url())) for attach in page.attachments]
 
-    def __json__(self, limit=None, page=None, is_export=False):
-        return dict(
+    def __json__(self, limit=None, page=None, is_export=False, cursor=None):
+        posts = self.query_posts(status='ok', style='chronological', limit=limit, page=page, cursor=cursor).all()
+        json = dict(
             _id=self._id,
             discussion_id=str(self.discussion_id),
             subject=self.subject,
@@ -205,9 +206,12 @@ def __json__(self, limit=None, page=None, is_export=False):
                         timestamp=p.timestamp,
                         last_edited=p.last_edit_date,
                         attachments=self.attachment_for_export(p) if is_export else self.attachments_for_json(p))
-                   for p in self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+                   for p in posts
                    ]
         )
+        if limit and len(posts) == int(limit):
+            json['next_cursor'] = self.post_cursor(posts[-1], style='chronological')
+        return json
 
     @property
     def activity_name(self):
@@ -405,7 +409,14 @@ def create_post_threads(self, posts):
         return result
 
     def query_posts(self, page=None, limit=None,
-                    timestamp=None, style='threaded', status=None):
+                    timestamp=None, style='threaded', status=None, full_slug=None, cursor=None):
+        '''
+        Query the posts in this thread, in display order for `style`.
+
+        For deep pages, pass the :meth:`post_cursor` of the last post of the
+        previous page as `cursor` (the posts after it are returned, with an
+        indexed query) instead of a `page` to skip to.
+        '''
         if timestamp:
             terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
                          status={'$in': ['ok', 'pending']}, timestamp=timestamp)
@@ -414,19 +425,38 @@ def query_posts(self, page=None, limit=None,
                          status={'$in': ['ok', 'pending']})
         if status:
             terms['status'] = status
+        if full_slug:
+            terms['full_slug'] = full_slug
+        if cursor:
+            after = utils.decode_cursor(cursor)
+            if style == 'threaded':
+                last_slug, = after
+                terms['full_slug'] = dict(terms.get('full_slug') or {}, **{'$gt': last_slug})
+            else:
+                last_timestamp, last_id = after
+                terms['$or'] = [{'timestamp': {'$gt': last_timestamp}},
+                                {'timestamp': last_timestamp, '_id': {'$gt': last_id}}]
         terms['deleted'] = False
         q = self.post_class().query.find(terms)
         if style == 'threaded':
             q = q.sort('full_slug')
         else:
-            q = q.sort('timestamp')
+            # _id breaks ties, so that cursors are stable
+            q = q.sort([('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
         if limit is not None:
             limit = int(limit)
-            if page is not None:
+            if page is not None and not cursor:
                 q = q.skip(page * limit)
             q = q.limit(limit)
         return q
 
+    @staticmethod
+    def post_cursor(post, style='threaded'):
+        '''Cursor for :meth:`query_posts`, to get the posts after `post`'''
+        if style == 'threaded':
+            return utils.encode_cursor([post.full_slug])
+        return utils.encode_cursor([post.timestamp, post._id])
+
     def find_posts(self, page=None, limit=None, timestamp=None,
                    style='threaded'):
         return self.query_posts(page=page, limit=limit,
@@ -504,7 +534,9 @@ class __mongometa__:
         indexes = [
             # used in general lookups, last_post, etc
             ('discussion_id', 'status', 'timestamp'),
-            'thread_id'
+            'thread_id',
+            # threaded display order, and position of a post in it (url_paginated)
+            ('thread_id', 'full_slug'),
         ]
     type_s = 'Post'
 
@@ -690,24 +722,11 @@ def url_paginated(self):
             # all posts in a single page
             page = 0
         else:
-            posts = self.thread.find_posts()
-            posts = self.thread.create_post_threads(posts)
-
-            def find_i(posts):
-                '''Find the index number of this post in the display order'''
-                q = []
-
-                def traverse(posts):
-                    for p in posts:
-                        if p['post']._id == self._id:
-                            return True  # found
-                        q.append(p)
-                        if traverse(p['children']):
-                            return True
-                traverse(posts)
-                return len(q)
-
-            page = find_i(posts) // limit
+            # posts are displayed in full_slug order (replies right after
+            # their parent), so the index of this post in the display order
+            # is the number of posts sorting before it
+            i = self.thread.query_posts(full_slug={'$lt': self.full_slug}).count()
+            page = i // limit
 
         slug = h.urlquote(self.slug)
         url = self.main_url()
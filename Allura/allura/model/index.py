@@ -69,6 +69,21 @@
     Index('project_id', 'link'),
 )
 
+# Unpickled artifact classes, keyed by their pickled form.  There are only a
+# handful of distinct artifact classes, so this never grows large.
+_artifact_classes = {}
+
+
+def load_artifact_class(pickled_cls):
+    '''Unpickle the class stored in an ArtifactReference, memoized'''
+    pickled_cls = six.binary_type(pickled_cls)
+    try:
+        return _artifact_classes[pickled_cls]
+    except KeyError:
+        cls = _artifact_classes[pickled_cls] = loads(pickled_cls)
+        return cls
+
+
 # Class definitions
 
 
@@ -94,12 +109,65 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def resolve_artifacts(cls, refs):
+        '''Look up the artifacts for many references at once.
+
+        Issues one ``$in`` query per artifact class (and project), rather than
+        one query per reference.  Returns a list of artifacts in the same
+        order as ``refs``, with None for any that couldn't be loaded.  Also
+        primes each reference's ``artifact`` property.
+        '''
+        refs_by_class = defaultdict(list)
+        for ref in refs:
+            if 'artifact' in ref.__dict__:
+                continue  # already loaded
+            aref = ref.artifact_reference
+            try:
+                artifact_cls = load_artifact_class(aref.cls)
+            except Exception:
+                log.exception('Error loading artifact class for %s: %r',
+                              ref._id, aref)
+                ref.artifact = None
+                continue
+            refs_by_class[(artifact_cls, aref.project_id)].append(ref)
+        for (artifact_cls, project_id), class_refs in six.iteritems(refs_by_class):
+            try:
+                with h.push_context(project_id):
+                    artifact_ids = [ref.artifact_reference.artifact_id for ref in class_refs]
+                    found = {a._id: a for a in
+                             artifact_cls.query.find(dict(_id={'$in': artifact_ids}))}
+                for ref in class_refs:
+                    ref.artifact = found.get(ref.artifact_reference.artifact_id)
+            except Exception:
+                log.exception('Error loading %s artifacts for project %s',
+                              artifact_cls, project_id)
+                for ref in class_refs:
+                    ref.artifact = None
+        return [ref.artifact for ref in refs]
+
+    @classmethod
+    def artifacts_by_ids(cls, ref_ids, with_refs=False):
+        '''Look up the artifacts for many reference ids at once (see
+        :meth:`resolve_artifacts`).  Returns a list in the same order as
+        ``ref_ids``, with None for any missing reference or artifact.  If
+        ``with_refs`` is True, the list is of ``(reference, artifact)`` pairs.
+        '''
+        refs = {ref._id: ref for ref in cls.query.find(dict(_id={'$in': list(ref_ids)}))}
+        cls.resolve_artifacts(list(refs.values()))
+        result = []
+        for ref_id in ref_ids:
+            ref = refs.get(ref_id)
+            artifact = ref.artifact if ref else None
+            result.append((ref, artifact) if with_refs else artifact)
+        return result
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
         aref = self.artifact_reference
         try:
-            cls = loads(six.binary_type(aref.cls))
+            cls = load_artifact_class(aref.cls)
             with h.push_context(aref.project_id):
                 return cls.query.get(_id=aref.artifact_id)
         except Exception:
@@ -157,7 +225,8 @@ def from_links(cls, *links):
         if len(links):
             result = {}
             # Parse all the links
-            parsed_links = dict((link, cls._parse_link(link))
+            projects = {}
+            parsed_links = dict((link, cls._parse_link(link, projects))
                                 for link in links)
             links_by_artifact = defaultdict(list)
             project_ids = set()
@@ -221,8 +290,12 @@ def log_ambiguous_link(cls, msg, matches, *args):
             log.warn('... %r', m)
 
     @classmethod
-    def _parse_link(cls, s):
-        '''Parse a shortlink into its nbhd/project/app/artifact parts'''
+    def _parse_link(cls, s, projects=None):
+        '''Parse a shortlink into its nbhd/project/app/artifact parts
+
+        :param projects: optional dict to cache project lookups in, when
+            parsing many links
+        '''
         s = s.strip()
         if s.startswith('['):
             s = s[1:]
@@ -237,7 +310,11 @@ def _parse_link(cls, s):
             p_id = getattr(c.project, '_id', None)
             p_nbhd = c.project.neighborhood_id
         if len(parts) == 3:
-            p = Project.query.get(shortname=parts[0], neighborhood_id=p_nbhd)
+            if projects is None:
+                projects = {}
+            if parts[0] not in projects:
+                projects[parts[0]] = Project.query.get(shortname=parts[0], neighborhood_id=p_nbhd)
+            p = projects[parts[0]]
             if p:
                 p_id = p._id
             return dict(
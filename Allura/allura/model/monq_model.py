@@ -17,6 +17,7 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import re
 import sys
 import time
 import traceback
@@ -24,21 +25,30 @@
 from datetime import datetime, timedelta
 
 import pymongo
+import six
+from pymongo import UpdateOne
+import bson
+from bson import ObjectId
 from tg import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
 from ming import schema as S
-from ming.orm import session, FieldProperty
+from ming.orm import session, FieldProperty, ThreadLocalORMSession
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
+# default caps on coalesced args, to keep them well under the max BSON
+# document size; posters can lower them (see MonQTask.post)
+COALESCE_MAX_ITEMS = 100 * 1000
+COALESCE_MAX_BYTES = 4 * 1024 * 1024
+
 
 class MonQTask(MappedClass):
 
@@ -99,6 +109,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    progress = FieldProperty(None, if_missing=None)  # optionally updated by long running tasks
 
     sort = [
         ('priority', ming.DESCENDING),
@@ -128,6 +139,13 @@ def __repr__(self):
             app_mount,
             username)
 
+    @property
+    def queue_latency(self):
+        '''Seconds between when the task became ready and when it was started'''
+        if self.time_start is None or self.time_queue is None:
+            return None
+        return max((self.time_start - self.time_queue).total_seconds(), 0.0)
+
     @LazyProperty
     def function(self):
         '''The function that is called by this task'''
@@ -144,8 +162,21 @@ def post(cls,
              priority=10,
              delay=0,
              flush_immediately=True,
+             coalesce=False,
+             coalesce_max_items=COALESCE_MAX_ITEMS,
+             coalesce_max_bytes=COALESCE_MAX_BYTES,
              ):
-        '''Create a new task object based on the current context.'''
+        '''Create a new task object based on the current context.
+
+        If ``coalesce`` is True and the last task queued with the same context
+        is still ready and has the same name, priority and kwargs, the new call
+        is merged into it instead: list arguments are unioned and an identical
+        call is dropped.
+        The existing task is returned in that case.  A merge that would make a
+        list argument longer than ``coalesce_max_items``, or the args bigger
+        than ``coalesce_max_bytes`` of BSON, is skipped and a new task is
+        inserted instead.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -166,6 +197,12 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        time_queue = datetime.utcnow() + timedelta(seconds=delay)
+        if coalesce:
+            existing = cls._coalesce(task_name, args, kwargs, priority, context, time_queue,
+                                     coalesce_max_items, coalesce_max_bytes)
+            if existing is not None:
+                return existing
         obj = cls(
             state='ready',
             priority=priority,
@@ -176,25 +213,67 @@ def post(cls,
             process=None,
             result=None,
             context=context,
-            time_queue=datetime.utcnow() + timedelta(seconds=delay))
+            time_queue=time_queue)
         if flush_immediately:
             session(obj).flush(obj)
+            if not delay:
+                MonQWakeup.notify(obj)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def _coalesce(cls, task_name, args, kwargs, priority, context, time_queue,
+                  max_items=COALESCE_MAX_ITEMS, max_bytes=COALESCE_MAX_BYTES):
+        '''Merge a call into an equivalent ready task, if there is one.
+        Returns the task merged into, or None.
+
+        Only the last ready task queued in the same context is considered:
+        merging into an older one would move the call ahead of the tasks
+        queued since, e.g. an add_artifacts ahead of a del_artifacts for the
+        same artifact.
+        '''
+        query = {'state': 'ready'}
+        for k, v in six.iteritems(context):
+            query['context.' + k] = v
+        coll = cls._collection()
+        doc = coll.find_one(query, {'task_name': 1, 'priority': 1, 'kwargs': 1, 'time_queue': 1, 'args': 1},
+                            sort=[('_id', pymongo.DESCENDING)])
+        if (doc is None or doc['task_name'] != task_name or doc['priority'] != priority
+                or doc['kwargs'] != kwargs
+                # don't hold up the new call behind a task delayed further out
+                or doc['time_queue'] > time_queue):
+            return None
+        merged = _merge_args(doc['args'], args, max_items, max_bytes)
+        if merged is None:
+            return None
+        if merged != doc['args']:
+            # matching on the old args too means a concurrent merge or
+            # claim by a worker makes this a no-op rather than losing data
+            updated = coll.update_one(
+                {'_id': doc['_id'], 'state': 'ready', 'args': doc['args']},
+                {'$set': {'args': merged}})
+            if not updated.matched_count:
+                return None
+        log.debug('coalesced %s call into task %s', task_name, doc['_id'])
+        return cls.query.find(dict(_id=doc['_id']), refresh=True).first()
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
         StopIteration, stop waiting for a task
+
+        ``only`` and ``exclude`` are lists of task names to restrict to or skip.
+        Names ending in ``.`` match as prefixes, e.g. ``allura.tasks.mail_tasks.``
         '''
         while True:
             try:
                 query = dict(state=state)
                 query['time_queue'] = {'$lte': datetime.utcnow()}
-                if only:
-                    query['task_name'] = {'$in': only}
+                name_query = task_name_query(only, exclude)
+                if name_query:
+                    query['task_name'] = name_query
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
@@ -216,6 +295,103 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, process='worker', size=10, state='ready', waitfunc=None, only=None, exclude=None):
+        '''Like :meth:`get`, but claim up to ``size`` tasks for the current
+        process at once.  The first task is chosen exactly as :meth:`get` does,
+        and the rest of the batch is filled with other ready tasks of the same
+        ``task_name``.  Returns a (possibly empty) list of tasks.
+        '''
+        first = cls.get(process=process, state=state, waitfunc=waitfunc, only=only, exclude=exclude)
+        if first is None:
+            return []
+        tasks = [first]
+        if size > 1:
+            tasks.extend(cls._claim(first.task_name, process, size - 1, state, exclude=first._id))
+        return tasks
+
+    @classmethod
+    def _collection(cls):
+        return session(cls).impl.db[cls.__mongometa__.name]
+
+    @classmethod
+    def _claim(cls, task_name, process, limit, state='ready', exclude=None):
+        coll = cls._collection()
+        query = dict(
+            state=state,
+            task_name=task_name,
+            time_queue={'$lte': datetime.utcnow()})
+        if exclude is not None:
+            query['_id'] = {'$ne': exclude}
+        ids = [doc['_id'] for doc in
+               coll.find(query, {'_id': 1}).sort(cls.sort).limit(limit)]
+        if not ids:
+            return []
+        # the state in the filter makes each task's claim atomic; tasks another
+        # worker grabbed in the meantime simply won't be updated for us
+        coll.update_many(
+            {'_id': {'$in': ids}, 'state': state},
+            {'$set': dict(state='busy', process=process)})
+        return cls.query.find(
+            {'_id': {'$in': ids}, 'state': 'busy', 'process': process}).sort(cls.sort).all()
+
+    @classmethod
+    def run_batch(cls, tasks, restore_context=True, nocapture=False):
+        '''Run tasks claimed by :meth:`get_batch` in the current process.
+
+        Instead of flushing each task before and after it runs, the start and
+        stop state transitions for the whole batch are recorded with bulk
+        writes.  The ORM sessions are flushed (unless the task failed) and
+        closed after each task, as at the end of the request a single task
+        runs in, so no pending changes or loaded objects carry over to the
+        next one.  Returns the list of results.
+        '''
+        if not tasks:
+            return []
+        coll = cls._collection()
+        started = datetime.utcnow()
+        for task in tasks:
+            # recorded in bulk below, so keep the ORM session from saving them one by one
+            session(task).expunge(task)
+            task.time_start = started
+        coll.update_many(
+            {'_id': {'$in': [task._id for task in tasks]}},
+            {'$set': dict(time_start=started)})
+        old_cproject = getattr(c, 'project', None)
+        old_capp = getattr(c, 'app', None)
+        old_cuser = getattr(c, 'user', None)
+        results = []
+        begin = time.time()
+        try:
+            for task in tasks:
+                log.info('starting %s %s (batch of %d)', task.task_name, task._id, len(tasks))
+                try:
+                    results.append(task._execute(nocapture))
+                    if task.state == 'complete':
+                        task._flush_sessions()
+                finally:
+                    task.time_stop = datetime.utcnow()
+                    ThreadLocalORMSession.close_all()
+        finally:
+            updates = []
+            for task in tasks:
+                if task.time_stop:
+                    fields = dict(state=task.state, result=task.result, time_stop=task.time_stop)
+                else:
+                    # never started (monq.raise_errors aborted the batch), give it back
+                    fields = dict(state='ready', process=None, time_start=None)
+                updates.append(UpdateOne({'_id': task._id}, {'$set': fields}))
+            coll.bulk_write(updates, ordered=False)
+            elapsed = time.time() - begin
+            log.info('ran %d %s tasks in %.3fs (%.1f tasks/sec)',
+                     len(results), tasks[0].task_name, elapsed,
+                     len(results) / elapsed if elapsed else 0)
+            if restore_context:
+                c.project = old_cproject
+                c.app = old_capp
+                c.user = old_cuser
+        return results
+
     @classmethod
     def run_ready(cls, worker=None):
         '''Run all the tasks that are currently ready'''
@@ -230,13 +406,29 @@ def __call__(self, restore_context=True, nocapture=False):
         c.project/app/user will be restored to the values they had before this
         function was called.
         '''
-        from allura import model as M
         self.time_start = datetime.utcnow()
         session(self).flush(self)
         log.info('starting %r', self)
+        log.info('task %s %s waited %.3fs in queue',
+                 self.task_name, self._id, self.queue_latency)
         old_cproject = getattr(c, 'project', None)
         old_capp = getattr(c, 'app', None)
         old_cuser = getattr(c, 'user', None)
+        try:
+            return self._execute(nocapture)
+        finally:
+            self.time_stop = datetime.utcnow()
+            session(self).flush(self)
+            if restore_context:
+                c.project = old_cproject
+                c.app = old_capp
+                c.user = old_cuser
+
+    def _execute(self, nocapture=False):
+        '''Set up c.project/app/user for this task and run it, recording the
+        resulting state and result on the task (but not saving it).
+        '''
+        from allura import model as M
         try:
             func = self.function
             c.project = M.Project.query.get(_id=self.context.project_id)
@@ -264,13 +456,18 @@ def __call__(self, restore_context=True, nocapture=False):
                     log.error(self.result)
                 else:
                     self.result = traceback.format_exc()
-        finally:
-            self.time_stop = datetime.utcnow()
-            session(self).flush(self)
-            if restore_context:
-                c.project = old_cproject
-                c.app = old_capp
-                c.user = old_cuser
+
+    def _flush_sessions(self):
+        '''Save the changes this task made, recording an error on it if that
+        fails'''
+        try:
+            ThreadLocalORMSession.flush_all()
+        except Exception as exc:
+            if asbool(config.get('monq.raise_errors')):
+                raise
+            log.exception('Error "%s" saving changes of job %s', exc, self)
+            self.state = 'error'
+            self.result = traceback.format_exc()
 
     def join(self, poll_interval=0.1):
         '''Wait until this task is either complete or errors out, then return the result.'''
@@ -284,3 +481,166 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+def _task_name_pattern(names):
+    alternatives = [re.escape(n) if n.endswith('.') else re.escape(n) + '$'
+                    for n in names]
+    return re.compile('^(?:%s)' % '|'.join(alternatives))
+
+
+def task_name_query(only=None, exclude=None):
+    '''Build a mongo query for the ``task_name`` field from lists of task
+    names to include or exclude (names ending in ``.`` are prefixes).
+    Returns None if there is nothing to filter on.
+    '''
+    query = {}
+    if only:
+        if any(n.endswith('.') for n in only):
+            query['$regex'] = _task_name_pattern(only).pattern
+        else:
+            query['$in'] = only
+    if exclude:
+        query['$not'] = _task_name_pattern(exclude)
+    return query or None
+
+
+def task_name_matches(task_name, only=None, exclude=None):
+    '''Python equivalent of :func:`task_name_query`'''
+    if only and not _task_name_pattern(only).match(task_name):
+        return False
+    if exclude and _task_name_pattern(exclude).match(task_name):
+        return False
+    return True
+
+
+def _freeze(value):
+    '''A hashable equivalent of a task arg, so list args of dicts can be
+    unioned with a set rather than by comparing every pair of items.'''
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in six.iteritems(value)))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _merge_args(existing, new, max_items=COALESCE_MAX_ITEMS, max_bytes=COALESCE_MAX_BYTES):
+    '''Fold the positional args ``new`` into ``existing``.
+
+    Returns the combined args, where list arguments are unioned (keeping
+    order), or None if the calls can't be combined: different non-list
+    arguments, a list that would grow past ``max_items``, or args that would
+    take more than ``max_bytes`` as BSON.
+    '''
+    if len(existing) != len(new):
+        return None
+    merged = []
+    for old_arg, new_arg in zip(existing, new):
+        if isinstance(new_arg, tuple):
+            new_arg = list(new_arg)
+        if isinstance(old_arg, list) and isinstance(new_arg, list):
+            try:
+                seen = set(_freeze(a) for a in old_arg)
+                extra = [a for a in new_arg if _freeze(a) not in seen]
+            except TypeError:  # unhashable items
+                extra = [a for a in new_arg if a not in old_arg]
+            if len(old_arg) + len(extra) > max_items:
+                return None
+            merged.append(old_arg + extra)
+        elif old_arg == new_arg:
+            merged.append(old_arg)
+        else:
+            return None
+    if max_bytes and merged != existing and len(bson.BSON.encode({'args': merged})) > max_bytes:
+        return None
+    return merged
+
+
+class MonQWakeup(object):
+
+    '''Wakeup channel for idle taskd workers.
+
+    When ``monq.wakeup`` is enabled, :meth:`MonQTask.post` inserts a small
+    signal document into a capped collection, and idle workers block on a
+    tailable cursor over it instead of sleeping for ``monq.poll_interval``.
+    Signals are only hints: a worker that misses one (or a deployment with
+    the channel disabled) still finds the task on its next regular poll.
+    '''
+    collection_name = str('monq_signal')
+    _collection_ready = False
+
+    def __init__(self, only=None, exclude=None):
+        self.only = only
+        self.exclude = exclude
+        self.last_id = None
+        self._cursor = None
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('monq.wakeup', False))
+
+    @classmethod
+    def collection(cls):
+        db = task_doc_session.db
+        if not cls._collection_ready:
+            if not db.list_collection_names(filter={'name': cls.collection_name}):
+                try:
+                    db.create_collection(
+                        cls.collection_name,
+                        capped=True,
+                        size=asint(config.get('monq.wakeup.size', 1024 * 1024)))
+                except pymongo.errors.CollectionInvalid:
+                    pass  # created concurrently by another process
+            cls._collection_ready = True
+        return db[cls.collection_name]
+
+    @classmethod
+    def notify(cls, task):
+        '''Signal waiting workers that ``task`` is ready to run'''
+        if not cls.enabled():
+            return
+        try:
+            cls.collection().insert_one(dict(
+                _id=ObjectId(),
+                task_id=task._id,
+                task_name=task.task_name))
+        except pymongo.errors.PyMongoError:
+            log.warning('Could not signal taskd workers for %s', task._id, exc_info=True)
+
+    def _open_cursor(self):
+        coll = self.collection()
+        if self.last_id is None:
+            latest = coll.find_one(sort=[('$natural', pymongo.DESCENDING)])
+            self.last_id = latest['_id'] if latest else ObjectId()
+        self._cursor = coll.find(
+            {'_id': {'$gt': self.last_id}},
+            cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+        self._cursor.max_await_time_ms(1000)
+
+    def wait(self, timeout):
+        '''Block until a relevant task is signalled or ``timeout`` seconds
+        pass.  Returns True if woken by a signal, False on timeout.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                if self._cursor is None or not self._cursor.alive:
+                    self._open_cursor()
+                    if not self._cursor.alive:
+                        # an empty capped collection can't be tailed yet
+                        time.sleep(min(remaining, 1))
+                        continue
+                doc = next(self._cursor)
+            except StopIteration:
+                continue
+            except pymongo.errors.PyMongoError:
+                log.warning('taskd wakeup channel failed, falling back to polling', exc_info=True)
+                self._cursor = None
+                time.sleep(max(min(remaining, 1), 0))
+                continue
+            self.last_id = doc['_id']
+            if task_name_matches(doc.get('task_name', ''), self.only, self.exclude):
+                return True
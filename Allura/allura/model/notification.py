@@ -37,15 +37,17 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import logging
+import time
 from bson import ObjectId
 from datetime import datetime, timedelta
 from collections import defaultdict
+from concurrent import futures
 
 from tg import tmpl_context as c, app_globals as g
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool, aslist
+from paste.deploy.converters import asbool, asint, aslist
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -256,6 +258,17 @@ def _make_notification(cls, artifact, topic, **kwargs):
     def footer(self, toaddr=''):
         return self.ref.artifact.get_mail_footer(self, toaddr)
 
+    @classmethod
+    def prefetch(cls, mailboxes):
+        '''Load the notifications queued in all the mailboxes with one query.
+        Returns a dict of them by _id.'''
+        ids = set()
+        for mbox in mailboxes:
+            ids.update(mbox.queue)
+        if not ids:
+            return {}
+        return {n._id: n for n in cls.query.find(dict(_id={'$in': list(ids)}))}
+
     def _sender(self):
         from allura.model import AppConfig
         app_config = AppConfig.query.get(_id=self.app_config_id)
@@ -305,7 +318,7 @@ def send_direct(self, user_id):
                       ', '.join([str(a) for a in artifact.acl]),
                       ', '.join([str(a) for a in artifact.parent_security_context().acl]))
             return
-        allura.tasks.mail_tasks.sendmail.post(
+        allura.tasks.mail_tasks.post_sendmail(
             destinations=[str(user_id)],
             fromaddr=self.from_address,
             reply_to=self.reply_to_address,
@@ -349,7 +362,7 @@ def perm_check(notification):
             text.append(n.text or '-no text-')
         text.append(n.footer())
         text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
+        allura.tasks.mail_tasks.post_sendmail(
             destinations=[str(user_id)],
             fromaddr=from_address,
             reply_to=reply_to_address,
@@ -372,7 +385,7 @@ def send_summary(self, user_id, from_address, subject, notifications):
             text.append(h.text.truncate(n.text or '-no text-', 128))
         text.append(n.footer())
         text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
+        allura.tasks.mail_tasks.post_sendmail(
             destinations=[str(user_id)],
             fromaddr=from_address,
             reply_to=from_address,
@@ -537,7 +550,7 @@ def subscribed(
     def deliver(cls, nid, artifact_index_ids, topic):
         '''Called in the notification message handler to deliver notification IDs
         to the appropriate mailboxes.  Atomically appends the nids
-        to the appropriate mailboxes.
+        to the appropriate mailboxes, all with a single update.
         '''
 
         artifact_index_ids.append(None)  # get tool-wide ("None") and specific artifact subscriptions
@@ -547,30 +560,47 @@ def deliver(cls, nid, artifact_index_ids, topic):
             'artifact_index_id': {'$in': artifact_index_ids},
             'topic': {'$in': [None, topic]}
         }
-        mboxes = cls.query.find(d).all()
-        log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
-        for mbox in mboxes:
+        update = {'$push': dict(queue=nid),
+                  '$set': dict(last_modified=datetime.utcnow(),
+                               queue_empty=False),
+                  }
+        try:
+            result = cls._collection().update_many(d, update)
+        except Exception:
+            log.exception('Error delivering notification %s to all mailboxes at once, delivering one by one', nid)
+            cls._deliver_each(nid, d, update, artifact_index_ids)
+        else:
+            log.debug('Delivered notification %s to %s mailboxes', nid, result.modified_count)
+
+    @classmethod
+    def _deliver_each(cls, nid, query, update, artifact_index_ids):
+        '''Deliver to the mailboxes matching query one at a time, so an error
+        with one mailbox is reported for it and doesn't stop the rest.'''
+        mboxes = cls._collection()
+        # skip the ones a partly-failed bulk update already got to
+        for mbox in mboxes.find(dict(query, queue={'$ne': nid}), {'user_id': 1}):
             try:
-                mbox.query.update(
-                    # _id is automatically specified by ming's "query", so this matches the current mbox
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
+                mboxes.update_one({'_id': mbox['_id'], 'queue': {'$ne': nid}}, update)
             except Exception:
                 # log error but try to keep processing, lest all the other eligible
                 # mboxes for this notification get skipped and lost forever
                 log.exception(
                     'Error adding notification: %s for artifact %s on project %s to user %s',
-                    nid, artifact_index_ids, c.project._id, mbox.user_id)
+                    nid, artifact_index_ids, c.project._id, mbox.get('user_id'))
+
+    @classmethod
+    def _collection(cls):
+        return cls.query.mapper.collection.m.collection
 
     @classmethod
     def fire_ready(cls):
         '''Fires all direct subscriptions with notifications as well as
         all summary & digest subscriptions with notifications that are ready.
         Clears the mailbox queue.
+
+        If `notification.fire_workers` is more than 1, the mailboxes are
+        split into that many _id ranges and fired in parallel, see
+        :meth:`_fire_sharded`.
         '''
         now = datetime.utcnow()
         # Queries to find all matching subscription objects
@@ -584,14 +614,12 @@ def fire_ready(cls):
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
 
+        workers = asint(config.get('notification.fire_workers', 1))
+        if workers > 1:
+            return cls._fire_sharded(q_direct, q_digest, now, workers)
+
         def find_and_modify_direct_mbox():
-            return cls.query.find_and_modify(
-                query=q_direct,
-                update={'$set': dict(
-                    queue=[],
-                    queue_empty=True,
-                )},
-                new=False)
+            return cls._claim_direct(q_direct)
 
         for mbox in take_while_true(find_and_modify_direct_mbox):
             try:
@@ -604,32 +632,154 @@ def find_and_modify_direct_mbox():
                 raise
 
         for mbox in cls.query.find(q_digest):
-            next_scheduled = now
-            if mbox.frequency.unit == 'day':
-                next_scheduled += timedelta(days=mbox.frequency.n)
-            elif mbox.frequency.unit == 'week':
-                next_scheduled += timedelta(days=7 * mbox.frequency.n)
-            elif mbox.frequency.unit == 'month':
-                next_scheduled += timedelta(days=30 * mbox.frequency.n)
             mbox = cls.query.find_and_modify(
                 query=dict(_id=mbox._id),
                 update={'$set': dict(
-                        next_scheduled=next_scheduled,
+                        next_scheduled=mbox._next_scheduled(now),
                         queue=[],
                         queue_empty=True,
                         )},
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    @classmethod
+    def _claim_direct(cls, query):
+        '''Atomically take the queue of one direct mailbox matching query.
+        Returns the mailbox as it was, or None if there are no more.'''
+        return cls.query.find_and_modify(
+            query=query,
+            update={'$set': dict(
+                queue=[],
+                queue_empty=True,
+            )},
+            new=False)
+
+    def _next_scheduled(self, now):
+        next_scheduled = now
+        if self.frequency.unit == 'day':
+            next_scheduled += timedelta(days=self.frequency.n)
+        elif self.frequency.unit == 'week':
+            next_scheduled += timedelta(days=7 * self.frequency.n)
+        elif self.frequency.unit == 'month':
+            next_scheduled += timedelta(days=30 * self.frequency.n)
+        return next_scheduled
+
+    @classmethod
+    def _fire_sharded(cls, q_direct, q_digest, now, workers):
+        '''Fire the ready mailboxes with `workers` threads, each claiming the
+        mailboxes in its own _id range (so they never contend for the same
+        ones) in batches of `notification.fire_batch_size`.  Returns the
+        number of mailboxes fired.'''
+        batch_size = asint(config.get('notification.fire_batch_size', 100))
+        context = dict(project=getattr(c, 'project', None),
+                       app=getattr(c, 'app', None),
+                       user=getattr(c, 'user', None))
+        shards = [(q_direct, r) for r in cls._shard_ranges(q_direct, workers)]
+        shards += [(q_digest, r) for r in cls._shard_ranges(q_digest, workers)]
+        if not shards:
+            return 0
+        start = time.time()
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            fired = sum(pool.map(
+                lambda shard: cls._fire_shard(shard[0], shard[1], now, batch_size, context),
+                shards))
+        elapsed = time.time() - start
+        log.info('Fired %s mailboxes in %s shards in %.2fs (%.1f mailboxes/sec)',
+                 fired, len(shards), elapsed, fired / elapsed if elapsed else 0)
+        return fired
+
+    @classmethod
+    def _shard_ranges(cls, query, n):
+        '''Split the mailboxes matching query into up to `n` contiguous _id
+        ranges of about the same size, as (low, high) pairs for
+        `low <= _id < high`.  The first and last are open-ended (None), so
+        mailboxes that become ready meanwhile are covered too.'''
+        ids = [doc['_id'] for doc in cls._collection().find(query, {'_id': 1}).sort('_id', pymongo.ASCENDING)]
+        if not ids:
+            return []
+        n = min(n, len(ids))
+        bounds = [ids[len(ids) * i // n] for i in range(1, n)]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    @classmethod
+    def _fire_shard(cls, query, id_range, now, batch_size, context):
+        '''Fire the mailboxes matching query within id_range, a batch at a time.
+        Runs in a worker thread.'''
+        query = dict(query)
+        low, high = id_range
+        if low is not None or high is not None:
+            query['_id'] = {}
+            if low is not None:
+                query['_id']['$gte'] = low
+            if high is not None:
+                query['_id']['$lt'] = high
+        direct = query.get('type') == 'direct'
+        fired = 0
+        with h.worker_context(**context):
+            while True:
+                if direct:
+                    mboxes = []
+                    while len(mboxes) < batch_size:
+                        mbox = cls._claim_direct(query)
+                        if mbox is None:
+                            break
+                        mboxes.append(mbox)
+                else:
+                    mboxes = cls._claim_digests(query, now, batch_size)
+                if not mboxes:
+                    return fired
+                notifications = Notification.prefetch(mboxes)
+                error = None
+                with allura.tasks.mail_tasks.sendmail_batch():
+                    for mbox in mboxes:
+                        try:
+                            mbox.fire(now, notifications)
+                        except Exception as e:
+                            log.exception(
+                                'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
+                            # the rest of the batch is already claimed (their
+                            # queues emptied), so fire them but claim no more
+                            error = error or e
+                fired += len(mboxes)
+                # done with them, don't let the session accumulate every batch
+                for obj in mboxes + list(notifications.values()):
+                    session(obj).expunge(obj)
+                if error is not None:
+                    raise error
+
+    @classmethod
+    def _claim_digests(cls, query, now, limit):
+        '''Take the queues of up to `limit` digest/summary mailboxes that are due'''
+        claimed = []
+        for mbox in cls.query.find(query).limit(limit).all():
+            mbox = cls.query.find_and_modify(
+                # still due, i.e. not fired by someone else in the meantime
+                query=dict(_id=mbox._id, next_scheduled=query['next_scheduled']),
+                update={'$set': dict(
+                        next_scheduled=mbox._next_scheduled(now),
+                        queue=[],
+                        queue_empty=True,
+                        )},
+                new=False)
+            if mbox is not None:
+                claimed.append(mbox)
+        return claimed
+
+    def fire(self, now, prefetched=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        :param prefetched: optional dict of the Notifications by _id, as
+            returned by :meth:`Notification.prefetch`
         '''
         if len(self.queue) == 0:
             return
 
-        notifications = Notification.query.find(dict(_id={'$in': self.queue}))
-        notifications = notifications.all()
+        if prefetched is not None:
+            notifications = [prefetched[nid] for nid in self.queue if nid in prefetched]
+        else:
+            notifications = Notification.query.find(dict(_id={'$in': self.queue}))
+            notifications = notifications.all()
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
@@ -245,6 +245,8 @@ class __mongometa__:
     last_updated = FieldProperty(datetime, if_missing=None)
     tool_data = FieldProperty({str: {str: None}})  # entry point: prefs dict
     ordinal = FieldProperty(int, if_missing=0)
+    # bumped to invalidate cached navbars, see invalidate_nav_cache()
+    nav_revision = FieldProperty(int, if_missing=0)
     database_configured = FieldProperty(bool, if_missing=True)
     _extra_tool_status = FieldProperty([str])
     trove_root_database = FieldProperty([S.ObjectId])
@@ -548,6 +550,13 @@ def sitemap(self, excluded_tools=None, included_tools=None,
 
         """
         from allura.app import SitemapEntry
+        cache_key = None
+        if (g.navbar_cache is not None and per_tool_limit == SITEMAP_PER_TOOL_LIMIT
+                and not (excluded_tools or included_tools or tools_only or xml)):
+            cache_key = self.nav_cache_key('sitemap')
+            cached = g.navbar_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                return cached
         entries = []
 
         anchored_tools = self.neighborhood.get_anchored_tools()
@@ -638,7 +647,58 @@ def sitemap(self, excluded_tools=None, included_tools=None,
             max_ordinal += 1
 
         entries = sorted(entries, key=lambda e: e['ordinal'])
-        return [e['entry'] for e in entries]
+        entries = [e['entry'] for e in entries]
+        if cache_key:
+            g.navbar_cache.put(cache_key, entries)
+        return entries
+
+    def nav_cache_key(self, kind):
+        """Key for caching this project's navbar data (of the given `kind`)
+        for c.user in :attr:`g.navbar_cache`, or None if it can't be cached.
+
+        Of the user's roles, it includes only those named in the ACLs
+        involved, so users with the same permissions share the key, even if
+        they each have a role of their own.  It changes when the tools or
+        their options, the subprojects, the ACLs, the anchored tools or
+        :attr:`nav_revision` change.
+        """
+        user = getattr(c, 'user', None)
+        project = getattr(c, 'project', None)
+        # tools' visibility can depend on c.project
+        if user is None or project is None or project._id != self._id or self.is_nbhd_project:
+            return None
+        cred = security.Credentials.get()
+        roles = cred.user_roles(user_id=user._id, project_id=self.root_project._id).reaching_ids
+        nbhd_project = self.neighborhood.neighborhood_project
+        nbhd_roles = []
+        if nbhd_project:
+            nbhd_roles = cred.user_roles(user_id=user._id, project_id=nbhd_project._id).reaching_ids
+        project_acls = [p.acl for p in self.parent_iter()]
+        signature = sha256()
+        for data in [self.nav_revision,
+                     self.get_tool_data('allura', 'grouping_threshold', 1),
+                     self.neighborhood.anchored_tools,
+                     self.neighborhood.acl,
+                     project_acls]:
+            signature.update(repr(data).encode('utf-8'))
+        for ac in self.app_configs:
+            project_acls.append(ac.acl)
+            signature.update(repr((ac._id, ac.tool_name, sorted(ac.options.items()), ac.acl)).encode('utf-8'))
+        for sub in self.direct_subprojects:
+            signature.update(repr((sub._id, sub.name, sub.shortname, sub.ordinal)).encode('utf-8'))
+        # only the roles the ACLs can tell apart
+        project_role_ids = set(ace.role_id for acl in project_acls for ace in acl)
+        nbhd_role_ids = set(ace.role_id for ace in self.neighborhood.acl)
+        return (self._id, kind, signature.hexdigest(), user.is_anonymous(),
+                tuple(sorted(r for r in roles if r in project_role_ids)),
+                tuple(sorted(r for r in nbhd_roles if r in nbhd_role_ids)))
+
+    def invalidate_nav_cache(self):
+        """Make cached navbars of this project stale.  Call this when tools or
+        subprojects are added, removed or reordered."""
+        self.nav_revision += 1
+        if g.navbar_cache is not None:
+            g.navbar_cache.invalidate(self._id)
 
     def install_anchored_tools(self):
         anchored_tools = self.neighborhood.get_anchored_tools()
@@ -711,6 +771,11 @@ def grouped_navbar_entries(self):
         """Return a :class:`~allura.app.SitemapEntry` list suitable for rendering
         the project navbar with tools grouped together by tool type.
         """
+        cache_key = self.nav_cache_key('grouped') if g.navbar_cache is not None else None
+        if cache_key:
+            cached = g.navbar_cache.get(cache_key)
+            if cached is not None:
+                return cached
         # get orginal (non-grouped) navbar entries
         sitemap = self.sitemap()
         # ordered dict to preserve the orginal ordering of tools
@@ -754,7 +819,10 @@ def grouped_navbar_entries(self):
                         e.mount_point = None
                         e.extra_html_attrs = {}
                         grouped_nav[tool_name].children.append(e)
-        return list(grouped_nav.values())
+        grouped_nav = list(grouped_nav.values())
+        if cache_key:
+            g.navbar_cache.put(cache_key, grouped_nav)
+        return grouped_nav
 
     def parent_iter(self):
         yield self
@@ -883,6 +951,7 @@ def install_app(self, ep_name, mount_point=None, mount_label=None, ordinal=None,
         with h.push_config(c, project=self, app=app):
             session(cfg).flush()
             app.install(self)
+        self.invalidate_nav_cache()
         return app
 
     def uninstall_app(self, mount_point):
@@ -893,6 +962,7 @@ def uninstall_app(self, mount_point):
             self.support_page = ''
         with h.push_config(c, project=self, app=app):
             app.uninstall(self)
+        self.invalidate_nav_cache()
 
     def app_instance(self, mount_point_or_config):
         if isinstance(mount_point_or_config, AppConfig):
@@ -924,7 +994,9 @@ def new_subproject(self, name, install_apps=True, user=None, project_name=None):
                 name, check_allowed=False, neighborhood=self.neighborhood)
         except exceptions.Invalid:
             raise exceptions.ToolError('Mount point "%s" is invalid' % name)
-        return provider.register_subproject(self, name, user or c.user, install_apps, project_name=project_name)
+        sp = provider.register_subproject(self, name, user or c.user, install_apps, project_name=project_name)
+        self.invalidate_nav_cache()
+        return sp
 
     def ordered_mounts(self, include_hidden=False):
         '''
@@ -18,15 +18,18 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import logging
+import os
+import time
 from itertools import chain
 from six.moves.cPickle import dumps
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 import bson
+from pymongo import UpdateOne
 
 import tg
 import jinja2
-from paste.deploy.converters import asint
+from paste.deploy.converters import asbool, asint
 from tg import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -34,22 +37,38 @@
 
 from allura.lib import utils
 from allura.lib import helpers as h
-from allura.model.repository import CommitDoc
+from allura.model.repository import CommitDoc, RefreshCheckpointDoc
 from allura.model.repository import Commit, Tree, LastCommit, ModelCache
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.auth import User
 from allura.model.timeline import TransientActor
 import six
+from six.moves import range
 
 log = logging.getLogger(__name__)
 
 QSIZE = 100
+# commit ids per refresh checkpoint doc
+CHECKPOINT_CHUNK_SIZE = 10 * 1000
 
 
 def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_are_new=None):
     if commits_are_new is None:
         commits_are_new = not all_commits and not new_clone
 
+    checkpoint = _load_checkpoint(repo)
+    if checkpoint is not None:
+        # a previous refresh was killed or failed partway, finish it first,
+        # unless that keeps failing
+        max_attempts = asint(tg.config.get('scm.refresh.max_attempts', 3))
+        if checkpoint['attempts'] >= max_attempts:
+            log.error('Giving up on refresh of %d commits on %s after %d attempts, stages %s were done',
+                      len(checkpoint['commit_ids']), repo.full_fs_path, checkpoint['attempts'],
+                      checkpoint['stages'])
+            _clear_checkpoint(repo)
+        else:
+            resume_refresh(repo, checkpoint)
+
     all_commit_ids = commit_ids = list(repo.all_commit_ids())
     if not commit_ids:
         # the repo is empty, no need to continue
@@ -60,23 +79,114 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         commit_ids = new_commit_ids
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
-    # Refresh commits
+    checkpoint = dict(
+        commit_ids=commit_ids,
+        all_commits=all_commits,
+        notify=notify,
+        new_clone=new_clone,
+        commits_are_new=commits_are_new,
+        stages=[],
+        activity_done=0,
+        attempts=1,
+    )
+    _start_checkpoint(repo, checkpoint)
+    _run_refresh_stages(repo, checkpoint, all_commit_ids)
+
+
+def resume_refresh(repo, checkpoint):
+    '''Finish the refresh recorded in `checkpoint` (from
+    :func:`_load_checkpoint`), skipping the stages that were already done'''
+    log.info('Resuming refresh of %d commits on %s after stages %s',
+             len(checkpoint['commit_ids']), repo.full_fs_path, checkpoint['stages'])
+    checkpoint['attempts'] += 1
+    _save_checkpoint(repo, checkpoint)
+    _run_refresh_stages(repo, checkpoint, list(repo.all_commit_ids()))
+
+
+def _run_refresh_stages(repo, checkpoint, all_commit_ids):
+    for name, stage in REFRESH_STAGES:
+        if name in checkpoint['stages']:
+            continue
+        start = time.time()
+        stage(repo, checkpoint, all_commit_ids)
+        checkpoint['stages'].append(name)
+        _save_checkpoint(repo, checkpoint)
+        log.info('Refresh stage %s done in %.2fs on %s', name, time.time() - start, repo.full_fs_path)
+    _clear_checkpoint(repo)
+
+
+# Checkpoints are written straight to mongo (not through the ORM session), so
+# they are saved even if the refresh dies.  The commit ids are written once, in
+# chunks, when a refresh starts; after that only the small state doc changes.
+def _start_checkpoint(repo, checkpoint):
+    _clear_checkpoint(repo)
+    coll = RefreshCheckpointDoc.m.collection
+    commit_ids = checkpoint['commit_ids']
+    chunks = [dict(_id=bson.ObjectId(), repo_id=repo._id, chunk=i // CHECKPOINT_CHUNK_SIZE,
+                   commit_ids=commit_ids[i:i + CHECKPOINT_CHUNK_SIZE])
+              for i in range(0, len(commit_ids), CHECKPOINT_CHUNK_SIZE)]
+    if chunks:
+        coll.insert_many(chunks)
+    # written last: a checkpoint without its state doc is ignored
+    _save_checkpoint(repo, checkpoint)
+
+
+def _save_checkpoint(repo, checkpoint):
+    state = {k: v for k, v in six.iteritems(checkpoint) if k != 'commit_ids'}
+    state['num_commits'] = len(checkpoint['commit_ids'])
+    RefreshCheckpointDoc.m.collection.update_one(
+        {'repo_id': repo._id, 'chunk': -1},
+        {'$set': {'state': state}, '$setOnInsert': {'_id': bson.ObjectId()}},
+        upsert=True)
+
+
+def _load_checkpoint(repo):
+    '''Return the checkpoint of an unfinished refresh of `repo`, or None'''
+    docs = list(RefreshCheckpointDoc.m.collection.find({'repo_id': repo._id}).sort('chunk', 1))
+    if not docs or docs[0]['chunk'] != -1:
+        return None
+    checkpoint = dict(docs[0]['state'])
+    checkpoint['stages'] = list(checkpoint['stages'])
+    checkpoint['commit_ids'] = [ci for doc in docs[1:] for ci in doc['commit_ids']]
+    if len(checkpoint['commit_ids']) != checkpoint.pop('num_commits'):
+        log.error('Ignoring incomplete refresh checkpoint for %s', repo.full_fs_path)
+        return None
+    return checkpoint
+
+
+def _clear_checkpoint(repo):
+    RefreshCheckpointDoc.m.collection.delete_many({'repo_id': repo._id})
+
+
+def _refresh_commit_info(repo, checkpoint, all_commit_ids):
     seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    repo.refresh_commits_info(checkpoint['commit_ids'], seen, not checkpoint['all_commits'])
+
 
+def _refresh_commit_repos(repo, checkpoint, all_commit_ids):
     refresh_commit_repos(all_commit_ids, repo)
 
-    # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = next(CommitDoc.m.find(dict(_id=oid), validate=False))
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
 
+def _refresh_commit_graph(repo, checkpoint, all_commit_ids):
+    graph = repo.commit_graph
+    if graph is not None:
+        refresh_commit_graph(graph, all_commit_ids)
+
+
+def _refresh_children(repo, checkpoint, all_commit_ids):
+    refresh_commits_children(checkpoint['commit_ids'])
+
+
+def _refresh_lcds(repo, checkpoint, all_commit_ids):
+    # Build last commit data for the new commits, so that tree views don't
+    # have to compute it (with a `git log` per path) on first view
+    if asbool(tg.config.get('scm.lcd.precompute', False)):
+        commit_ids = checkpoint['commit_ids']
+        max_commits = asint(tg.config.get('scm.lcd.precompute.max_commits', 500))
+        refresh_lcds(repo, list(reversed(commit_ids[:max_commits] if max_commits else commit_ids)))
+
+
+def _refresh_refs(repo, checkpoint, all_commit_ids):
     # Clear any existing caches for branches/tags
     if repo.cached_branches:
         repo.cached_branches = []
@@ -90,38 +200,83 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     repo.get_branches()
     repo.get_tags()
 
-    if commits_are_new:
-        for commit in commit_ids:
-            new = repo.commit(commit)
-            user = User.by_email_address(new.committed.email)
-            if user is None:
-                user = User.by_username(new.committed.name)
-            if user is not None:
-                g.statsUpdater.newCommit(new, repo.app_config.project, user)
-            actor = user or TransientActor(
-                    activity_name=new.committed.name or new.committed.email)
-            g.director.create_activity(actor, 'committed', new,
-                                       related_nodes=[repo.app_config.project],
-                                       tags=['commit', repo.tool.lower()])
-
-        from allura.webhooks import RepoPushWebhookSender
-        by_branches, by_tags = _group_commits(repo, commit_ids)
-        params = []
-        for b, commits in six.iteritems(by_branches):
-            ref = 'refs/heads/{}'.format(b) if b != '__default__' else None
-            params.append(dict(commit_ids=commits, ref=ref))
-        for t, commits in six.iteritems(by_tags):
-            ref = 'refs/tags/{}'.format(t)
-            params.append(dict(commit_ids=commits, ref=ref))
-        if params:
-            RepoPushWebhookSender().send(params)
 
+def _refresh_activity(repo, checkpoint, all_commit_ids):
+    if not checkpoint['commits_are_new']:
+        return
+    from allura.tasks.repo_tasks import commit_activity
+    commit_ids = checkpoint['commit_ids']
+    in_tasks = asbool(tg.config.get('scm.refresh.activity_tasks', False))
+    # record progress after each chunk, so a resumed refresh doesn't create
+    # activities twice
+    for i in range(checkpoint['activity_done'], len(commit_ids), QSIZE):
+        chunk = commit_ids[i:i + QSIZE]
+        if in_tasks:
+            # let the taskd workers create them in parallel with the rest of the refresh
+            commit_activity.post(chunk)
+        else:
+            refresh_commit_activity(repo, chunk)
+        checkpoint['activity_done'] = i + len(chunk)
+        _save_checkpoint(repo, checkpoint)
+
+
+def refresh_commit_activity(repo, commit_ids):
+    '''Update user stats and create "committed" activities for new commits'''
+    for commit in commit_ids:
+        new = repo.commit(commit)
+        user = User.by_email_address(new.committed.email)
+        if user is None:
+            user = User.by_username(new.committed.name)
+        if user is not None:
+            g.statsUpdater.newCommit(new, repo.app_config.project, user)
+        actor = user or TransientActor(
+                activity_name=new.committed.name or new.committed.email)
+        g.director.create_activity(actor, 'committed', new,
+                                   related_nodes=[repo.app_config.project],
+                                   tags=['commit', repo.tool.lower()])
+
+
+def _refresh_webhooks(repo, checkpoint, all_commit_ids):
+    if not checkpoint['commits_are_new']:
+        return
+    from allura.webhooks import RepoPushWebhookSender
+    by_branches, by_tags = _group_commits(repo, checkpoint['commit_ids'])
+    params = []
+    for b, commits in six.iteritems(by_branches):
+        ref = 'refs/heads/{}'.format(b) if b != '__default__' else None
+        params.append(dict(commit_ids=commits, ref=ref))
+    for t, commits in six.iteritems(by_tags):
+        ref = 'refs/tags/{}'.format(t)
+        params.append(dict(commit_ids=commits, ref=ref))
+    if params:
+        RepoPushWebhookSender().send(params)
+
+
+def _refreshed_event(repo, checkpoint, all_commit_ids):
     log.info('Refresh complete for %s', repo.full_fs_path)
-    g.post_event('repo_refreshed', len(commit_ids), all_commits, new_clone)
+    g.post_event('repo_refreshed', len(checkpoint['commit_ids']), checkpoint['all_commits'],
+                 checkpoint['new_clone'])
+
 
-    # Send notifications
-    if notify:
-        send_notifications(repo, reversed(commit_ids))
+def _refresh_notifications(repo, checkpoint, all_commit_ids):
+    if checkpoint['notify']:
+        send_notifications(repo, reversed(checkpoint['commit_ids']))
+
+
+# (name, function) for each stage of refresh_repo, in order.  Each stage's
+# name is recorded in the refresh's checkpoint once it is done.
+REFRESH_STAGES = [
+    ('commit_info', _refresh_commit_info),
+    ('commit_repos', _refresh_commit_repos),
+    ('children', _refresh_children),
+    ('commit_graph', _refresh_commit_graph),
+    ('lcds', _refresh_lcds),
+    ('refs', _refresh_refs),
+    ('activity', _refresh_activity),
+    ('webhooks', _refresh_webhooks),
+    ('refreshed_event', _refreshed_event),
+    ('notifications', _refresh_notifications),
+]
 
 
 def refresh_commit_repos(all_commit_ids, repo):
@@ -171,6 +326,111 @@ def refresh_children(ci):
         multi=True)
 
 
+def refresh_lcds(repo, commit_ids):
+    '''Build the LastCommit docs for every tree changed by the given commits,
+    which must be sorted oldest to newest'''
+    model_cache = ModelCache(
+        max_instances={LastCommit: 4000, Tree: 4000},
+        max_queries={LastCommit: 4000, Tree: 4000},
+    )
+    lcid_cache = {}
+    prev_commit_id = None
+    num_lcds = 0
+    start = time.time()
+    for i, oid in enumerate(commit_ids):
+        commit = model_cache.get(Commit, dict(_id=oid))
+        if commit is None:
+            continue
+        commit.set_context(repo)
+        if commit.parent_ids != [prev_commit_id]:
+            # lcid_cache only knows the history of the previous commit,
+            # so it's no use unless that was this commit's only parent
+            lcid_cache.clear()
+        num_lcds += compute_lcds(commit, model_cache, lcid_cache)
+        prev_commit_id = oid
+        if (i + 1) % 100 == 0:
+            session(LastCommit).flush()
+            log.info('Compute last commit info %d: %s', (i + 1), oid)
+    session(LastCommit).flush()
+    elapsed = time.time() - start
+    log.info('Computed %d last commit docs for %d commits in %.2fs on %s',
+             num_lcds, len(commit_ids), elapsed, repo.full_fs_path)
+    return num_lcds
+
+
+def compute_lcds(commit, model_cache, lcid_cache):
+    '''Build the LastCommit docs for every tree changed in this commit,
+    and return how many were built.
+
+    Each doc is built from the previous one for the same path, which
+    `lcid_cache` (path -> id of the last commit that changed it) lets us find
+    without asking the SCM.
+    '''
+    with h.push_config(c, model_cache=model_cache, lcid_cache=lcid_cache):
+        tree = commit.tree
+        if tree is None:
+            return 0
+        num_lcds = _compute_lcds(tree, model_cache)
+    for changed_path in commit.changed_paths:
+        lcid_cache[changed_path] = commit._id
+    return num_lcds
+
+
+def _compute_lcds(tree, model_cache):
+    changed_paths = tree.commit.changed_paths
+    path = tree.path().strip('/')
+    if path not in changed_paths:
+        return 0
+    num_lcds = 0
+    if model_cache.get(LastCommit, dict(path=path, commit_id=tree.commit._id)) is None:
+        LastCommit._build(tree)
+        num_lcds += 1
+    for node in tree.tree_ids:
+        if os.path.join(path, node.name) not in changed_paths:
+            continue
+        try:
+            sub_tree = tree[node.name]
+        except KeyError:
+            continue
+        num_lcds += _compute_lcds(sub_tree, model_cache)
+    return num_lcds
+
+
+def refresh_commits_children(commit_ids, batch_size=1000):
+    '''Refresh the list of children of the parents of all the given commits,
+    with one query and one bulk write per batch of commits'''
+    collection = CommitDoc.m.collection
+    num_done = 0
+    for chunk in utils.chunked_iter(commit_ids, batch_size):
+        chunk = list(chunk)
+        children = defaultdict(list)
+        for ci in collection.find({'_id': {'$in': chunk}}, {'parent_ids': 1}):
+            for parent_id in ci.get('parent_ids') or []:
+                children[parent_id].append(ci['_id'])
+        if children:
+            collection.bulk_write([
+                UpdateOne({'_id': parent_id}, {'$addToSet': {'child_ids': {'$each': child_ids}}})
+                for parent_id, child_ids in six.iteritems(children)
+            ], ordered=False)
+        num_done += len(chunk)
+        log.info('Refresh child info for parents of %d commits', num_done)
+
+
+def refresh_commit_graph(graph, all_commit_ids):
+    '''Add any of the given commits that are missing from a repo's
+    CommitGraph (all of them, the first time) to it'''
+    missing = [oid for oid in all_commit_ids if oid not in graph]
+    if not missing:
+        return
+    docs = []
+    for chunk in utils.chunked_iter(missing, 1000):
+        docs.extend(CommitDoc.m.collection.find(
+            {'_id': {'$in': list(chunk)}}, {'parent_ids': 1, 'committed.date': 1}))
+    graph.add_commits(docs)
+    graph.save()
+    log.info('Added %d commits to the commit graph, now %d', len(docs), len(graph))
+
+
 def unknown_commit_ids(all_commit_ids):
     '''filter out all commit ids that have already been cached'''
     result = []
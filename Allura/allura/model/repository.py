@@ -16,6 +16,9 @@
 #       under the License.
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import calendar
+import heapq
+from array import array
 import json
 import os
 import stat
@@ -30,8 +33,8 @@
 from time import time
 from collections import defaultdict, OrderedDict
 from six.moves.urllib.parse import urljoin
-from threading import Thread
-from six.moves.queue import Queue
+from threading import Lock
+from concurrent import futures
 from itertools import chain, islice
 from difflib import SequenceMatcher
 
@@ -48,6 +51,7 @@
 from ming import Field, collection, Index
 from ming.utils import LazyProperty
 from ming.orm import FieldProperty, session, Mapper, mapper
+from ming.orm.base import state, ObjectState
 from ming.base import Object
 
 from allura.lib import helpers as h
@@ -137,6 +141,14 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def refresh_commits_info(self, oids, seen, lazy=True):
+        '''Refresh the data in the commits with the given ids.  Implementations
+        can override this to do it in bulk.'''
+        for i, oid in enumerate(oids):
+            self.refresh_commit_info(oid, seen, lazy)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -251,37 +263,63 @@ def branches(self):
     def tags(self):
         raise NotImplementedError('tags')
 
+    # shared by all instances, see lcd_pool()
+    _lcd_pool = None
+    _lcd_pool_lock = Lock()
+
+    @classmethod
+    def lcd_pool(cls):
+        '''
+        Bounded pool of threads shared by all repos for last commit lookups,
+        so that many concurrent tree views can't start unlimited threads (or
+        SCM processes).  Sized by `lcd_thread_pool_size`.
+        '''
+        with cls._lcd_pool_lock:
+            if RepositoryImplementation._lcd_pool is None:
+                RepositoryImplementation._lcd_pool = futures.ThreadPoolExecutor(
+                    max_workers=asint(tg.config.get('lcd_thread_pool_size', 20)))
+        return RepositoryImplementation._lcd_pool
+
     def last_commit_ids(self, commit, paths):
         '''
         Return a mapping {path: commit_id} of the _id of the last
         commit to touch each path, starting from the given commit.
 
-        Chunks the set of paths based on lcd_thread_chunk_size and
-        runs each chunk (if more than one) in a separate thread.
-
-        Each thread will call :meth:`_get_last_commit` to get the
-        commit ID and list of changed files for the last commit
-        to touch any file in a given chunk.
+        Implementations do the lookup in :meth:`_last_commit_ids`, which
+        should give up (returning what it has so far) after `lcd_timeout`
+        seconds.
         '''
         if not paths:
             return {}
         timeout = float(tg.config.get('lcd_timeout', 60))
         start_time = time()
         paths = list(set(paths))  # remove dupes
-        result = {}  # will be appended to from each thread
-        chunks = Queue()
+        result = self._last_commit_ids(commit, paths, start_time + timeout)
+        elapsed = time() - start_time
+        log.info('last_commit_ids resolved %d of %d paths in %.3fs (%.1f paths/s) for %s',
+                 len(result or {}), len(paths), elapsed, len(result or {}) / elapsed if elapsed else 0,
+                 commit._id)
+        return result
+
+    def _last_commit_ids(self, commit, paths, deadline):
+        '''
+        Chunks the set of paths based on lcd_thread_chunk_size and
+        runs each chunk (if more than one) in the shared :meth:`lcd_pool`.
+
+        Each chunk will call :meth:`_get_last_commit` to get the
+        commit ID and list of changed files for the last commit
+        to touch any file in a given chunk.
+        '''
+        result = {}  # will be added to from each thread
         lcd_chunk_size = asint(tg.config.get('lcd_thread_chunk_size', 10))
-        num_threads = 0
-        for s in range(0, len(paths), lcd_chunk_size):
-            chunks.put(paths[s:s + lcd_chunk_size])
-            num_threads += 1
+        chunks = [paths[s:s + lcd_chunk_size] for s in range(0, len(paths), lcd_chunk_size)]
 
-        def get_ids():
-            paths = set(chunks.get())
+        def get_ids(paths):
+            paths = set(paths)
             try:
                 commit_id = commit._id
                 while paths and commit_id:
-                    if time() - start_time >= timeout:
+                    if time() >= deadline:
                         log.error('last_commit_ids timeout for %s on %s',
                                   commit._id, ', '.join(paths))
                         break
@@ -295,25 +333,14 @@ def get_ids():
                     paths -= changed
             except Exception as e:
                 log.exception('Error in SCM thread: %s', e)
-            finally:
-                chunks.task_done()
-        if num_threads == 1:
-            get_ids()
+        if len(chunks) == 1:
+            get_ids(chunks[0])
         else:
-            for i in range(num_threads):
-                t = Thread(target=get_ids)
-                t.start()
-            # reimplement chunks.join() but with a timeout
-            # see: http://bugs.python.org/issue9634
-            # (giving threads a bit of extra cleanup time in case they timeout)
-            chunks.all_tasks_done.acquire()
-            try:
-                endtime = time() + timeout + 0.5
-                while chunks.unfinished_tasks and endtime > time():
-                    chunks.all_tasks_done.wait(endtime - time())
-            finally:
-                chunks.all_tasks_done.release()
-        return result
+            pool = RepositoryImplementation.lcd_pool()
+            # giving threads a bit of extra cleanup time in case they timeout
+            futures.wait([pool.submit(get_ids, chunk) for chunk in chunks],
+                         timeout=max(deadline - time(), 0) + 0.5)
+        return result.copy()
 
     def _get_last_commit(self, commit_id, paths):
         """
@@ -464,6 +491,9 @@ def all_commit_ids(self):
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    def refresh_commits_info(self, oids, seen, lazy=True):
+        return self._impl.refresh_commits_info(oids, seen, lazy)
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
@@ -753,6 +783,14 @@ def tarball(self, revision, path=None):
     def rev_to_commit_id(self, rev):
         raise NotImplementedError('rev_to_commit_id')
 
+    @property
+    def commit_graph(self):
+        '''The :class:`CommitGraph` of this repo, or None if
+        `scm.commit_graph` isn't enabled'''
+        if not asbool(tg.config.get('scm.commit_graph', False)):
+            return None
+        return CommitGraph.get(self._id)
+
     def set_status(self, status):
         '''
         Update (and flush) the repo status indicator.
@@ -1022,6 +1060,31 @@ def add_meta_post(self, changes):
         name=str,
         commit_id=str)]))
 
+# Compact commit graph of a repository, see CommitGraph
+CommitGraphDoc = collection(
+    str('repo_commit_graph'), main_doc_session,
+    Field('_id', str),  # repo_id:chunk, so a chunk can only be inserted once
+    Field('repo_id', S.ObjectId()),
+    Field('chunk', int),
+    Index('repo_id', 'chunk', unique=True),
+    Field('count', int),  # guards appends, see CommitGraph.save
+    Field('commit_ids', [str]),
+    Field('parents', [[int]]),
+    Field('generations', [int]),
+    Field('dates', [int]))
+
+# Progress of an unfinished repo refresh, see repo_refresh.refresh_repo.
+# Chunk -1 holds the refresh's state, chunks 0 and up the commit ids it is
+# refreshing
+RefreshCheckpointDoc = collection(
+    str('repo_refresh_checkpoint'), main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('repo_id', S.ObjectId()),
+    Field('chunk', int),
+    Index('repo_id', 'chunk', unique=True),
+    Field('state', S.Anything),
+    Field('commit_ids', [str]))
+
 
 class RepoObject(object):
 
@@ -1617,7 +1680,8 @@ def _build(cls, tree):
         unchanged = [os.path.join(path, node) for node in nodes - changed]
         if prev_lcd:
             # get unchanged entries from previously computed LCD
-            entries = prev_lcd.by_name
+            # (copied, since that LCD may be cached and used again)
+            entries = dict(prev_lcd.by_name)
         elif unchanged:
             # no previously computed LCD, so get unchanged entries from SCM
             # (but only ask for the ones that we know we need)
@@ -1660,7 +1724,7 @@ class ModelCache(object):
     for a series of several new commits.
     '''
 
-    def __init__(self, max_instances=None, max_queries=None):
+    def __init__(self, max_instances=None, max_queries=None, shared=None):
         '''
         By default, each model type can have 2000 instances and
         8000 queries.  You can override these for specific model
@@ -1671,7 +1735,12 @@ def __init__(self, max_instances=None, max_queries=None):
 
         If you pass in a number instead of a dict, that value will
         be used as the max for all classes.
+
+        Misses for immutable types are looked up in the `shared`
+        :class:`SharedModelCache` before going to mongo; by default the
+        process-wide one, if enabled in the config.
         '''
+        self._shared = shared if shared is not None else SharedModelCache.instance()
         max_instances_default = 2000
         max_queries_default = 8000
         if isinstance(max_instances, int):
@@ -1708,18 +1777,30 @@ def get(self, cls, query):
         _query = self._normalize_query(query)
         self._touch(cls, _query)
         if _query not in self._query_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query)
             self.set(cls, _query, val)
             return val
         _id = self._query_cache[cls][_query]
         if _id is None:
             return None
         if _id not in self._instance_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query)
             self.set(cls, _query, val)
             return val
         return self._instance_cache[cls][_id]
 
+    def _fetch(self, cls, query):
+        shared = self._shared
+        if shared is None or not shared.handles(cls):
+            return self._model_query(cls).get(**query)
+        key = (cls.__name__, self._normalize_query(query))
+        val = shared.get(cls, key)
+        if val is None:
+            val = self._model_query(cls).get(**query)
+            if val is not None:
+                shared.put(key, val)
+        return val
+
     def set(self, cls, query, val):
         _query = self._normalize_query(query)
         if val is not None:
@@ -1808,6 +1889,340 @@ def batch_load(self, cls, query, attrs=None):
             self.set(cls, keys, result)
 
 
+class SharedModelCache(object):
+
+    '''
+    Process-wide LRU cache of the docs of immutable repository objects
+    (trees and last commit docs, which are keyed by content and never change
+    once written), used by :class:`ModelCache` as a second tier so that every
+    request doesn't have to load them from mongo again.  Commits aren't
+    cached: their repo_ids and child_ids are updated as repos are refreshed.
+
+    Docs are kept BSON-encoded, so that each lookup gets its own instance
+    (instances belong to a thread's ming session) and so that the memory used
+    can be bounded by `max_size` bytes.
+    '''
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self, max_size=64 * 1024 * 1024, types=None):
+        self.max_size = max_size
+        self.types = types or (Tree, LastCommit)
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.stats = dict(hits=0, misses=0, evictions=0)
+
+    @classmethod
+    def instance(cls):
+        '''The process-wide cache, or None if scm.model_cache.shared is off'''
+        if not asbool(tg.config.get('scm.model_cache.shared', False)):
+            return None
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(max_size=asint(tg.config.get(
+                        'scm.model_cache.shared.max_size', 64 * 1024 * 1024)))
+        return cls._instance
+
+    def handles(self, cls):
+        return cls in self.types
+
+    def get(self, cls, key):
+        '''Return a new `cls` instance for the doc cached under `key`, or None'''
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+        doc = bson.BSON(data).decode()
+        sess = session(cls)
+        obj = sess.imap.get(cls, doc['_id'])
+        if obj is None:
+            # same as loading it with a query
+            obj = mapper(cls).create(doc, {})
+            state(obj).status = ObjectState.clean
+            sess.save(obj)
+        return obj
+
+    def put(self, key, obj):
+        st = state(obj)
+        if st.status != ObjectState.clean:
+            return  # only cache what is already in mongo
+        data = bson.BSON.encode(st.document)
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CommitGraph(object):
+
+    '''
+    Compact, append-only index of the commit graph of one repository, so that
+    log paging, ancestry checks and graph rendering don't need to run git or
+    load every commit doc.
+
+    Commits are numbered in the order they were added, which is always
+    topological (parents first), so each commit's parents are stored as the
+    numbers of earlier commits.  Each commit also has its committed date (in
+    seconds) and generation number: 1 for a root commit, otherwise 1 + the
+    highest generation of its parents.  No commit can be an ancestor of one
+    with the same or a lower generation, which lets ancestry walks stop early.
+
+    Numbers are kept in packed arrays, with the parents of all the commits in
+    one array (the parents of commit n are ``parents[parent_offsets[n]:
+    parent_offsets[n + 1]]``).
+
+    Stored in CommitGraphDoc in chunks of CHUNK_SIZE commits, and updated
+    incrementally by repo_refresh.  Instances are cached per process (up to
+    CACHE_SIZE graphs, and `scm.commit_graph.cache_max_commits` commits in
+    all); use :meth:`get` to get an up to date one.
+    '''
+
+    CHUNK_SIZE = 10000
+    CACHE_SIZE = 20
+    CACHE_MAX_COMMITS = 200 * 1000
+    SAVE_ATTEMPTS = 5
+    _cache = OrderedDict()
+    _cache_lock = Lock()
+
+    def __init__(self, repo_id):
+        self.repo_id = repo_id
+        self.commit_ids = []
+        self.parents = array(str('l'))
+        self.parent_offsets = array(str('l'), [0])
+        self.generations = array(str('l'))
+        self.dates = array(str('l'))
+        self.index = {}
+        self._saved = 0  # number of commits saved in mongo
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.commit_ids)
+
+    def __contains__(self, commit_id):
+        return commit_id in self.index
+
+    @classmethod
+    def get(cls, repo_id):
+        '''Return the (cached) commit graph for a repo, with any commits
+        added by other processes loaded'''
+        max_commits = asint(tg.config.get('scm.commit_graph.cache_max_commits', cls.CACHE_MAX_COMMITS))
+        with cls._cache_lock:
+            graph = cls._cache.pop(repo_id, None) or cls(repo_id)
+            cls._cache[repo_id] = graph
+            total = sum(len(cached) for cached in cls._cache.values())
+            while len(cls._cache) > 1 and (len(cls._cache) > cls.CACHE_SIZE or total > max_commits):
+                _, evicted = cls._cache.popitem(last=False)
+                total -= len(evicted)
+        graph.load()
+        return graph
+
+    def load(self):
+        '''Load commits added to mongo since this graph was last loaded'''
+        with self._lock:
+            q = CommitGraphDoc.m.find(
+                dict(repo_id=self.repo_id, chunk={'$gte': self._saved // self.CHUNK_SIZE}),
+                validate=False).sort('chunk', pymongo.ASCENDING)
+            for doc in q:
+                start = self._saved - doc.chunk * self.CHUNK_SIZE
+                if start < 0 or start >= len(doc.commit_ids):
+                    continue
+                for i in range(start, len(doc.commit_ids)):
+                    self._append(doc.commit_ids[i], doc.parents[i], doc.generations[i], doc.dates[i])
+                self._saved = len(self.commit_ids)
+
+    def _append(self, commit_id, parents, generation, date):
+        self.index[commit_id] = len(self.commit_ids)
+        self.commit_ids.append(commit_id)
+        self.parents.extend(parents)
+        self.parent_offsets.append(len(self.parents))
+        self.generations.append(generation)
+        self.dates.append(date)
+
+    def _parents(self, n):
+        return self.parents[self.parent_offsets[n]:self.parent_offsets[n + 1]]
+
+    def add_commits(self, commit_docs):
+        '''Add commits to the graph (but not to mongo, see :meth:`save`).
+
+        `commit_docs` are CommitDocs (or dicts with the same _id, parent_ids
+        and committed.date) in any order.  Parents that aren't in the graph
+        or in `commit_docs` are ignored.
+        '''
+        docs = {doc['_id']: doc for doc in commit_docs if doc['_id'] not in self.index}
+        graph = {oid: set(p for p in doc.get('parent_ids') or [] if p in docs)
+                 for oid, doc in six.iteritems(docs)}
+        with self._lock:
+            for oid in topological_sort(graph):
+                doc = docs[oid]
+                parents = [self.index[p] for p in doc.get('parent_ids') or [] if p in self.index]
+                generation = 1 + max([self.generations[p] for p in parents] or [0])
+                date = (doc.get('committed') or {}).get('date')
+                self._append(oid, parents, generation, calendar.timegm(date.utctimetuple()) if date else 0)
+
+    def save(self):
+        '''Save the commits added since the last save.
+
+        Commits are appended to the chunks in mongo only if those still hold
+        the commits this graph last loaded or saved.  If another process (or
+        a stale cached graph) saved commits first, this graph is reloaded
+        from mongo, its unsaved commits are added again after those, and the
+        save is retried.
+        '''
+        for attempt in range(self.SAVE_ATTEMPTS):
+            with self._lock:
+                if self._append_unsaved():
+                    return
+                unsaved = self._pop_unsaved()
+            log.info('Commit graph of repo %s was changed by another process, reloading', self.repo_id)
+            self.load()
+            self.add_commits(unsaved)
+        raise pymongo.errors.OperationFailure(
+            'Could not save commit graph of repo %s after %d attempts' % (self.repo_id, self.SAVE_ATTEMPTS))
+
+    def _append_unsaved(self):
+        '''Append the unsaved commits to mongo, returning False if the chunks
+        there have changed since this graph was last loaded or saved'''
+        coll = CommitGraphDoc.m.collection
+        while self._saved < len(self):
+            chunk, saved_in_chunk = divmod(self._saved, self.CHUNK_SIZE)
+            start = self._saved
+            end = min(len(self), (chunk + 1) * self.CHUNK_SIZE)
+            new = dict(
+                commit_ids=self.commit_ids[start:end],
+                parents=[self._parents(n).tolist() for n in range(start, end)],
+                generations=self.generations[start:end].tolist(),
+                dates=self.dates[start:end].tolist())
+            if saved_in_chunk == 0:
+                try:
+                    coll.insert_one(dict(new, _id='%s:%s' % (self.repo_id, chunk), repo_id=self.repo_id,
+                                         chunk=chunk, count=end - start))
+                except pymongo.errors.DuplicateKeyError:
+                    return False
+            else:
+                updated = coll.update_one(
+                    dict(repo_id=self.repo_id, chunk=chunk, count=saved_in_chunk),
+                    {'$push': {k: {'$each': v} for k, v in six.iteritems(new)},
+                     '$inc': {'count': end - start}})
+                if not updated.matched_count:
+                    return False
+            self._saved = end
+        return True
+
+    def _pop_unsaved(self):
+        '''Remove the unsaved commits from this graph, and return them as
+        dicts for :meth:`add_commits`'''
+        unsaved = []
+        for n in range(self._saved, len(self)):
+            unsaved.append({
+                '_id': self.commit_ids[n],
+                'parent_ids': self.parent_ids(self.commit_ids[n]),
+                'committed': {'date': datetime.utcfromtimestamp(self.dates[n])},
+            })
+        for commit_id in self.commit_ids[self._saved:]:
+            del self.index[commit_id]
+        del self.parents[self.parent_offsets[self._saved]:]
+        del self.parent_offsets[self._saved + 1:]
+        for values in (self.commit_ids, self.generations, self.dates):
+            del values[self._saved:]
+        return unsaved
+
+    def parent_ids(self, commit_id):
+        return [self.commit_ids[p] for p in self._parents(self.index[commit_id])]
+
+    def date(self, commit_id):
+        return datetime.utcfromtimestamp(self.dates[self.index[commit_id]])
+
+    def log(self, head_ids, limit=None):
+        '''Yield the ids of commits reachable from `head_ids`, newest first
+        (by committed date, like `git log`)'''
+        to_visit = [(-self.dates[self.index[oid]], -self.index[oid])
+                    for oid in set(head_ids) if oid in self.index]
+        heapq.heapify(to_visit)
+        seen = set(-n for _, n in to_visit)
+        count = 0
+        while to_visit and (limit is None or count < limit):
+            _, n = heapq.heappop(to_visit)
+            n = -n
+            yield self.commit_ids[n]
+            count += 1
+            for p in self._parents(n):
+                if p not in seen:
+                    seen.add(p)
+                    heapq.heappush(to_visit, (-self.dates[p], -p))
+
+    def is_ancestor(self, ancestor_id, commit_id):
+        '''Return True if `ancestor_id` is `commit_id` or one of its ancestors'''
+        target = self.index[ancestor_id]
+        generation = self.generations[target]
+        to_visit = [self.index[commit_id]]
+        seen = set()
+        while to_visit:
+            n = to_visit.pop()
+            if n == target:
+                return True
+            if n in seen or self.generations[n] <= generation:
+                continue
+            seen.add(n)
+            to_visit.extend(self._parents(n))
+        return False
+
+    def count(self, head_ids):
+        '''Return the number of commits reachable from `head_ids` (the graph
+        also has commits that no longer are, e.g. after a force push)'''
+        to_visit = [self.index[oid] for oid in head_ids if oid in self.index]
+        seen = set(to_visit)
+        while to_visit:
+            for p in self._parents(to_visit.pop()):
+                if p not in seen:
+                    seen.add(p)
+                    to_visit.append(p)
+        return len(seen)
+
+    def merge_base(self, commit_id1, commit_id2):
+        '''Return the id of a best common ancestor of two commits (like `git
+        merge-base`), or None if they have none'''
+        a, b = self.index[commit_id1], self.index[commit_id2]
+        if a == b:
+            return commit_id1
+        # walk down from both, highest generation first; a commit's flags are
+        # final once popped since they only come from higher generations
+        flags = {a: 1, b: 2}
+        to_visit = [(-self.generations[a], a), (-self.generations[b], b)]
+        heapq.heapify(to_visit)
+        while to_visit:
+            _, n = heapq.heappop(to_visit)
+            if flags[n] == 3:
+                return self.commit_ids[n]
+            for p in self._parents(n):
+                p_flags = flags.get(p, 0)
+                if p_flags | flags[n] != p_flags:
+                    flags[p] = p_flags | flags[n]
+                    heapq.heappush(to_visit, (-self.generations[p], p))
+        return None
+
+
 class GitLikeTree(object):
 
     '''
@@ -38,6 +38,13 @@ class __mongometa__:
     hook_url = FieldProperty(str)
     secret = FieldProperty(str)
     last_sent = FieldProperty(dt.datetime, if_missing=None)
+    # delivery stats and circuit breaker state, see record_delivery()
+    delivered = FieldProperty(int, if_missing=0)
+    failed = FieldProperty(int, if_missing=0)
+    delivery_time = FieldProperty(float, if_missing=0.0)
+    last_delivery_time = FieldProperty(float, if_missing=None)
+    consecutive_failures = FieldProperty(int, if_missing=0)
+    circuit_open_until = FieldProperty(dt.datetime, if_missing=None)
 
     def url(self):
         app = self.app_config.load()
@@ -59,6 +66,49 @@ def update_limit(self):
         self.last_sent = dt.datetime.utcnow()
         session(self).flush(self)
 
+    def circuit_open(self):
+        '''Returns True if sending is suspended because of repeated failures'''
+        return (self.circuit_open_until is not None and
+                self.circuit_open_until > dt.datetime.utcnow())
+
+    def record_delivery(self, ok, elapsed):
+        '''Update delivery stats for one delivery attempt that took `elapsed`
+        seconds.
+
+        After `webhook.circuit_breaker.failures` failures in a row the circuit
+        is opened: nothing is sent for `webhook.circuit_breaker.reset` seconds.
+        The first delivery after that closes it again if it succeeds, or
+        re-opens it if it fails.
+        '''
+        update = {'$inc': {'delivered' if ok else 'failed': 1,
+                           'delivery_time': elapsed},
+                  '$set': {'last_delivery_time': elapsed}}
+        if ok:
+            update['$set'].update(consecutive_failures=0, circuit_open_until=None)
+        else:
+            update['$inc']['consecutive_failures'] = 1
+        wh = Webhook.query.find_and_modify(query={'_id': self._id}, update=update, new=True)
+        threshold = asint(config.get('webhook.circuit_breaker.failures', 5))
+        if not ok and wh and threshold and wh.consecutive_failures >= threshold:
+            reset = asint(config.get('webhook.circuit_breaker.reset', 600))
+            # set just this field (not flush the whole doc), so counts
+            # incremented meanwhile by other workers aren't overwritten
+            Webhook.query.find_and_modify(
+                query={'_id': self._id, 'consecutive_failures': {'$gte': threshold}},
+                update={'$set': {'circuit_open_until': dt.datetime.utcnow() + dt.timedelta(seconds=reset)}},
+                new=True)
+
+    def delivery_stats(self):
+        attempts = self.delivered + self.failed
+        return {
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'avg_time': self.delivery_time / attempts if attempts else None,
+            'last_time': self.last_delivery_time,
+            'consecutive_failures': self.consecutive_failures,
+            'circuit_open': self.circuit_open(),
+        }
+
     @classmethod
     def max_hooks(self, type, tool_name):
         type = type.replace('-', '_')
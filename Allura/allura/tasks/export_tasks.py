@@ -22,13 +22,21 @@
 import logging
 import shutil
 import codecs
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent import futures
 
 import tg
 from tg import app_globals as g, tmpl_context as c
+from paste.deploy.converters import asbool, asint
+from ming.orm import session
 
 from allura.tasks import mail_tasks
 from allura.lib.decorators import task
 from allura.lib import helpers as h
+from allura.model.monq_model import MonQTask
 from allura.model.repository import zipdir
 
 
@@ -52,23 +60,26 @@ class BulkExport(object):
 
     def process(self, project, tools, user, filename=None, send_email=True, with_attachments=False):
         export_filename = filename or project.bulk_export_filename()
-        tmp_path = os.path.join(
-            project.bulk_export_path(rootdir=tg.config.get('bulk_export_tmpdir', tg.config['bulk_export_path'])),
-            os.path.splitext(export_filename)[0],  # e.g. test-backup-2018-06-26-210524 without the .zip
-        )
         export_path = project.bulk_export_path(rootdir=tg.config['bulk_export_path'])
         export_fullpath = os.path.join(export_path, export_filename)
-        if not os.path.exists(tmp_path):
-            os.makedirs(tmp_path)
         if not os.path.exists(export_path):
             os.makedirs(export_path)
         apps = [project.app_instance(tool) for tool in tools]
         exportable = self.filter_exportable(apps)
-        results = [self.export(tmp_path, app, with_attachments) for app in exportable]
-        exported = self.filter_successful(results)
-        if exported:
-            zipdir(tmp_path, export_fullpath)
-        shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
+        if asbool(tg.config.get('bulk_export_streaming', False)):
+            exported = self.export_streaming(project, export_fullpath, exportable, with_attachments)
+        else:
+            tmp_path = os.path.join(
+                project.bulk_export_path(rootdir=tg.config.get('bulk_export_tmpdir', tg.config['bulk_export_path'])),
+                os.path.splitext(export_filename)[0],  # e.g. test-backup-2018-06-26-210524 without the .zip
+            )
+            if not os.path.exists(tmp_path):
+                os.makedirs(tmp_path)
+            results = [self.export(tmp_path, app, with_attachments) for app in exportable]
+            exported = self.filter_successful(results)
+            if exported:
+                zipdir(tmp_path, export_fullpath)
+            shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
 
         if not user:
             log.info('No user. Skipping notification.')
@@ -117,3 +128,117 @@ def export(self, export_path, app, with_attachments=False):
 
     def filter_successful(self, results):
         return [result for result in results if result is not None]
+
+    def export_streaming(self, project, export_fullpath, apps, with_attachments=False):
+        '''
+        Export the apps concurrently (bulk_export_workers at a time), writing
+        their json and attachments straight into the zip file, instead of
+        to a temp dir that is zipped afterwards.
+        '''
+        partial_path = export_fullpath + '.partial'
+        prefix = os.path.splitext(os.path.basename(export_fullpath))[0]
+        workers = max(1, min(asint(tg.config.get('bulk_export_workers', 4)), len(apps)))
+        results = {}
+        context = dict(project=project, user=c.user)
+        with ExportArchive(partial_path, prefix) as archive:
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = {pool.submit(self.export_to_archive, archive, app, with_attachments, context): i
+                           for i, app in enumerate(apps)}
+                for future in futures.as_completed(pending):
+                    results[pending[future]] = future.result()
+                    self.report_progress(project, apps, results, archive)
+        exported = self.filter_successful([results[i] for i in sorted(results)])
+        if exported:
+            os.rename(partial_path, export_fullpath)
+        else:
+            os.remove(partial_path)
+        return exported
+
+    def export_to_archive(self, archive, app, with_attachments=False, context=None):
+        '''Export one app into `archive`.  Runs in a worker thread.'''
+        tool = app.config.options.mount_point
+        with h.worker_context(app=app, **(context or {})):
+            try:
+                # the json is spooled, since attachments are written to the
+                # archive while it is being generated
+                with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as tmp:
+                    app.bulk_export_archive = archive if with_attachments else None
+                    try:
+                        app.bulk_export(codecs.getwriter('utf-8')(tmp), '', with_attachments)
+                    finally:
+                        app.bulk_export_archive = None
+                    tmp.seek(0)
+                    archive.write_stream('%s.json' % tool, tmp)
+            except Exception:
+                log.error('Error exporting: %s on %s', tool,
+                          app.project.shortname, exc_info=True)
+                return None
+            else:
+                return app
+
+    def report_progress(self, project, apps, results, archive):
+        progress = dict(
+            tools_total=len(apps),
+            tools_done=len(results),
+            tools_failed=len([r for r in results.values() if r is None]),
+            bytes_written=archive.bytes_written,
+        )
+        log.info('Bulk export of %s: %s of %s tools done, %s failed, %s bytes written',
+                 project.shortname, progress['tools_done'], progress['tools_total'],
+                 progress['tools_failed'], progress['bytes_written'])
+        # the running task itself (same query as Project.bulk_export_status)
+        current_task = MonQTask.query.get(**{
+            'task_name': 'allura.tasks.export_tasks.bulk_export',
+            'state': {'$in': ['busy', 'ready']},
+            'context.project_id': project._id,
+        })
+        if current_task:
+            current_task.progress = progress
+            session(current_task).flush(current_task)
+
+
+class ExportArchive(object):
+
+    '''
+    Zip file being written by a streaming bulk export.  Members are written
+    from file objects (e.g. straight from GridFS) without temp copies, and
+    can be written from several threads.  A zip can only have one member open
+    for writing, so writes are serialized: the first chunk of each member is
+    read before taking the lock (so files up to `chunk_size` are read
+    concurrently), but the rest of a bigger file is read while holding it.
+    '''
+
+    def __init__(self, path, prefix=''):
+        self.path = path
+        self.prefix = prefix
+        self.bytes_written = 0
+        self._names = set()
+        self._lock = threading.Lock()
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def write_stream(self, name, fileobj, chunk_size=1024 * 1024):
+        arcname = os.path.join(self.prefix, name)
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        with self._lock:
+            if arcname in self._names:
+                log.warning('Skipping duplicate file in bulk export: %s', arcname)
+                return
+            self._names.add(arcname)
+        chunk = fileobj.read(chunk_size)
+        with self._lock:
+            with self._zip.open(info, 'w', force_zip64=True) as dest:
+                while chunk:
+                    dest.write(chunk)
+                    self.bytes_written += len(chunk)
+                    chunk = fileobj.read(chunk_size)
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
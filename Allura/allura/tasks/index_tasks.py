@@ -23,11 +23,15 @@
 
 from tg import app_globals as g
 from tg import tmpl_context as c
+from tg import config
+from paste.deploy.converters import asint
+from ming.orm import session
 
 from allura.lib import helpers as h
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
 from allura.lib.solr import make_solr_from_config
+from allura.lib.utils import chunked_list
 import six
 
 
@@ -88,50 +92,76 @@ def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
+@task(coalesce=True)
 def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
 
+    Artifacts are processed in batches of ``solr.add_batch_size``: each batch
+    is loaded with one query per artifact class, sent to SOLR, and then its
+    references and artifacts are expunged from the ming sessions, so memory
+    use doesn't grow with the number of ``ref_ids``.
+
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
     '''
     from allura import model as M
-    from allura.lib.search import find_shortlinks
 
     exceptions = []
-    solr_updates = []
-    with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
-            try:
-                artifact = ref.artifact
-                if artifact is None:
-                    continue
-                # c.app is normally set, so keep using it.  During a reindex its not though, so set it from artifact
-                with h.push_config(c, app=getattr(c, 'app', None) or artifact.app):
-                    s = artifact.solarize()
-                    if s is None:
-                        continue
-                    if update_solr:
-                        solr_updates.append(s)
-                    if update_refs:
-                        if isinstance(artifact, M.Snapshot):
-                            continue
-                        # Find shortlinks in the raw text, not the escaped html
-                        # created by the `solarize()`.
-                        link_text = artifact.index().get('text') or ''
-                        shortlinks = find_shortlinks(link_text)
-                        ref.references = [link.ref_id for link in shortlinks]
-            except Exception:
-                log.error('Error indexing artifact %s', ref._id)
-                exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+    solr = __get_solr(solr_hosts)
+    batch_size = asint(config.get('solr.add_batch_size', 500))
+    artifact_session = M.session.artifact_orm_session._get()
+    multiple_batches = len(ref_ids) > batch_size
+    with _indexing_disabled(artifact_session):
+        for chunk in chunked_list(ref_ids, batch_size):
+            refs = M.ArtifactReference.query.find(dict(_id={'$in': chunk})).all()
+            solr_updates = _index_refs(refs, update_solr, update_refs, exceptions)
+            if solr_updates:
+                solr.add(solr_updates)
+            check_for_dirty_ming_records('add_artifacts task')
+            if multiple_batches:
+                # save updated references, then drop just this batch's objects
+                # from the sessions (anything else loaded stays attached)
+                M.session.main_orm_session.flush()
+                _expunge(refs + [ref.artifact for ref in refs])
 
     if len(exceptions) == 1:
         six.reraise(exceptions[0][0], exceptions[0][1], exceptions[0][2])
     if exceptions:
         raise CompoundError(*exceptions)
-    check_for_dirty_ming_records('add_artifacts task')
+
+
+def _index_refs(refs, update_solr, update_refs, exceptions):
+    '''Solarize the artifacts for ``refs`` and update their references.
+    Returns the solr documents; errors are appended to ``exceptions``.
+    '''
+    from allura import model as M
+    from allura.lib.search import find_shortlinks
+
+    solr_updates = []
+    for ref, artifact in zip(refs, M.ArtifactReference.resolve_artifacts(refs)):
+        try:
+            if artifact is None:
+                continue
+            # c.app is normally set, so keep using it.  During a reindex its not though, so set it from artifact
+            with h.push_config(c, app=getattr(c, 'app', None) or artifact.app):
+                s = artifact.solarize()
+                if s is None:
+                    continue
+                if update_solr:
+                    solr_updates.append(s)
+                if update_refs:
+                    if isinstance(artifact, M.Snapshot):
+                        continue
+                    # Find shortlinks in the raw text, not the escaped html
+                    # created by the `solarize()`.
+                    link_text = artifact.index().get('text') or ''
+                    shortlinks = find_shortlinks(link_text)
+                    ref.references = [link.ref_id for link in shortlinks]
+        except Exception:
+            log.error('Error indexing artifact %s', ref._id)
+            exceptions.append(sys.exc_info())
+    return solr_updates
 
 
 @task
@@ -157,6 +187,13 @@ def commit():
 def solr_del_tool(project_id, mount_point_s):
     g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
 
+
+def _expunge(objects):
+    for obj in objects:
+        if obj is not None and session(obj) is not None:
+            session(obj).expunge(obj)
+
+
 @contextmanager
 def _indexing_disabled(session):
     session.disable_index = session.skip_mod_date = True
@@ -20,10 +20,16 @@
 import logging
 import six.moves.html_parser
 import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from tg import tmpl_context as c, app_globals as g, config
+import bson
 from bson import ObjectId
 import markupsafe
+from paste.deploy.converters import asbool, asint
 
 from allura.lib import helpers as h
 from allura.lib.decorators import task
@@ -34,6 +40,7 @@
 log = logging.getLogger(__name__)
 
 smtp_client = mail_util.SMTPClient()
+smtp_pool = mail_util.SMTPClientPool()
 
 
 def mail_meta_content(metalink):
@@ -140,57 +147,91 @@ def replace_html(matchobj):
     return multi_msg, plain_msg
 
 
-@task
-def sendmail(fromaddr, destinations, text, reply_to, subject,
-             message_id, in_reply_to=None, sender=None, references=None, metalink=None):
-    '''
-    Send an email to the specified list of destinations with respect to the preferred email format specified by user.
-    It is best for broadcast messages.
+def _user_ids(addrs):
+    """The ObjectIds among `addrs` (user ids rather than email addresses)"""
+    ids = []
+    for addr in addrs:
+        if addr is None or isinstance(addr, six.string_types) and '@' in addr:
+            continue
+        try:
+            ids.append(ObjectId(addr))
+        except Exception:
+            pass
+    return ids
 
-    :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
 
-    '''
+def _lookup_users(addrs):
+    """Load the enabled users referenced by id in `addrs`, in one query.
+    Returns {ObjectId: user}"""
     from allura import model as M
-    addrs_plain = []
-    addrs_multi = []
+    ids = _user_ids(addrs)
+    if not ids:
+        return {}
+    users = M.User.query.find({'_id': {'$in': ids}, 'disabled': False, 'pending': False})
+    return {u._id: u for u in users}
+
+
+def _fromaddr(fromaddr, users):
     if fromaddr is None:
-        fromaddr = g.noreply
-    elif not isinstance(fromaddr, six.string_types) or '@' not in fromaddr:
+        return g.noreply
+    if not isinstance(fromaddr, six.string_types) or '@' not in fromaddr:
         log.warning('Looking up user with fromaddr: %s', fromaddr)
-        user = M.User.query.get(_id=ObjectId(fromaddr), disabled=False, pending=False)
+        user = users.get(ObjectId(fromaddr))
         if not user:
             log.warning('Cannot find user with ID: %s', fromaddr)
-            fromaddr = g.noreply
-        else:
-            fromaddr = user.email_address_header()
-    # Divide addresses based on preferred email formats
+            return g.noreply
+        return user.email_address_header()
+    return fromaddr
+
+
+def _destination_addrs(destinations, users):
+    """Divide destinations based on preferred email formats.
+    Returns (plain addresses, multipart addresses)"""
+    addrs_plain = []
+    addrs_multi = []
     for addr in destinations:
         if mail_util.isvalid(addr):
             addrs_plain.append(addr)
-        else:
-            try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
-            except Exception:
-                log.exception('Error looking up user with ID: %r' % addr)
-                continue
-            addr = user.email_address_header()
-            if not addr and user.email_addresses:
-                addr = user.email_addresses[0]
-                log.warning(
-                    'User %s has not set primary email address, using %s',
-                    user._id, addr)
-            if not addr:
-                log.error(
-                    "User %s (%s) has not set any email address, can't deliver",
-                    user._id, user.username)
+            continue
+        try:
+            user = users.get(ObjectId(addr))
+            if not user:
+                log.warning('Cannot find user with ID: %s', addr)
                 continue
-            if user.get_pref('email_format') == 'plain':
-                addrs_plain.append(addr)
-            else:
-                addrs_multi.append(addr)
+        except Exception:
+            log.exception('Error looking up user with ID: %r' % addr)
+            continue
+        addr = user.email_address_header()
+        if not addr and user.email_addresses:
+            addr = user.email_addresses[0]
+            log.warning(
+                'User %s has not set primary email address, using %s',
+                user._id, addr)
+        if not addr:
+            log.error(
+                "User %s (%s) has not set any email address, can't deliver",
+                user._id, user.username)
+            continue
+        if user.get_pref('email_format') == 'plain':
+            addrs_plain.append(addr)
+        else:
+            addrs_multi.append(addr)
+    return addrs_plain, addrs_multi
+
+
+@task
+def sendmail(fromaddr, destinations, text, reply_to, subject,
+             message_id, in_reply_to=None, sender=None, references=None, metalink=None):
+    '''
+    Send an email to the specified list of destinations with respect to the preferred email format specified by user.
+    It is best for broadcast messages.
+
+    :param fromaddr: ObjectId or str(ObjectId) of user, or email address str
+
+    '''
+    users = _lookup_users(list(destinations) + [fromaddr])
+    fromaddr = _fromaddr(fromaddr, users)
+    addrs_plain, addrs_multi = _destination_addrs(destinations, users)
 
     multi_msg, plain_msg = create_multipart_msg(text, metalink)
     smtp_client.sendmail(
@@ -201,6 +242,129 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
         in_reply_to, plain_msg, sender=sender, references=references)
 
 
+# keep the args of each sendmail_bulk task, which include whole email bodies,
+# well under mongo's 16MB document limit
+BULK_MAX_MESSAGES = 1000
+BULK_MAX_BYTES = 4 * 1024 * 1024
+
+
+@task(coalesce=True, coalesce_max_items=BULK_MAX_MESSAGES, coalesce_max_bytes=BULK_MAX_BYTES)
+def sendmail_bulk(messages):
+    '''
+    Send many emails at once.  Each item of `messages` is a dict of
+    :func:`sendmail` keyword arguments.
+
+    All the users are looked up together, messages that differ only by their
+    destinations are sent once to all of them, and the sending is spread over
+    a pool of persistent SMTP connections.  Queued calls are merged, so
+    posting a message while another batch is waiting adds it to that batch
+    (up to BULK_MAX_MESSAGES messages or BULK_MAX_BYTES).
+    '''
+    start = time.time()
+    # merge messages identical but for their destinations
+    merged = OrderedDict()
+    for msg in messages:
+        msg = dict(msg)
+        destinations = msg.pop('destinations')
+        key = tuple(sorted((k, repr(v)) for k, v in six.iteritems(msg)))
+        merged.setdefault(key, (msg, []))[1].extend(destinations)
+
+    all_addrs = []
+    for msg, destinations in merged.values():
+        destinations[:] = OrderedDict.fromkeys(destinations)
+        all_addrs.extend(destinations)
+        all_addrs.append(msg.get('fromaddr'))
+    users = _lookup_users(all_addrs)
+
+    prepared = []
+    for msg, destinations in merged.values():
+        fromaddr = _fromaddr(msg.get('fromaddr'), users)
+        addrs_plain, addrs_multi = _destination_addrs(destinations, users)
+        multi_msg, plain_msg = create_multipart_msg(msg['text'], msg.get('metalink'))
+        for addrs, mime_msg in ((addrs_multi, multi_msg), (addrs_plain, plain_msg)):
+            p = mail_util.SMTPClient.prepare(
+                addrs, fromaddr, msg['reply_to'], msg['subject'], msg['message_id'],
+                msg.get('in_reply_to'), mime_msg, sender=msg.get('sender'), references=msg.get('references'))
+            if p:
+                prepared.append(p)
+
+    failed = smtp_pool.send_all(prepared)
+    log.info('Sent %s of %s emails (from %s queued messages) to %s recipients in %.2fs',
+             len(prepared) - len(failed), len(prepared), len(messages),
+             sum(len(addrs) for addrs, content in prepared), time.time() - start)
+    if failed:
+        # retry just those, rather than the whole batch
+        delay = asint(config.get('forgemail.bulk.retry_delay', 60))
+        log.warning('Queueing %s emails to retry in %ss', len(failed), delay)
+        send_prepared.post(failed, delay=delay)
+
+
+@task
+def send_prepared(messages):
+    '''
+    Send emails as already prepared by :meth:`SMTPClient.prepare`: a list of
+    (smtp addresses, content) pairs, such as those :func:`sendmail_bulk`
+    couldn't send.  Raises if any of them fail, leaving the task in the error
+    state so it can be re-queued.
+    '''
+    failed = smtp_pool.send_all([tuple(msg) for msg in messages])
+    if failed:
+        raise exc.MailError('Failed to send %s of %s emails' % (len(failed), len(messages)))
+
+
+def post_sendmail(**kw):
+    '''
+    Queue a :func:`sendmail` call, or add it to a :func:`sendmail_bulk` batch
+    if `forgemail.bulk` is enabled or it's made within :func:`sendmail_batch`.
+    '''
+    batch = getattr(_batch, 'messages', None)
+    if batch is not None:
+        batch.append(kw)
+    elif asbool(config.get('forgemail.bulk', False)):
+        sendmail_bulk.post([kw])
+    else:
+        sendmail.post(**kw)
+
+
+_batch = threading.local()
+
+
+@contextmanager
+def sendmail_batch():
+    '''
+    Collect the :func:`post_sendmail` calls made in this thread within the
+    block, and queue them together as :func:`sendmail_bulk` tasks (as few as
+    the size limits allow).
+    '''
+    if getattr(_batch, 'messages', None) is not None:
+        # already in a batch, which will queue these too
+        yield
+        return
+    _batch.messages = []
+    try:
+        yield
+    finally:
+        # queue what was collected even if the block fails part way, as
+        # post_sendmail calls outside a batch would have been
+        messages, _batch.messages = _batch.messages, None
+        for chunk in _bulk_chunks(messages):
+            sendmail_bulk.post(chunk)
+
+
+def _bulk_chunks(messages):
+    '''Split `messages` into lists that fit in one :func:`sendmail_bulk` task'''
+    chunk, size = [], 0
+    for msg in messages:
+        msg_size = len(bson.BSON.encode(msg))
+        if chunk and (len(chunk) >= BULK_MAX_MESSAGES or size + msg_size > BULK_MAX_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(msg)
+        size += msg_size
+    if chunk:
+        yield chunk
+
+
 @task
 def sendsimplemail(
         fromaddr,
@@ -221,21 +385,12 @@ def sendsimplemail(
     :param toaddr: ObjectId or str(ObjectId) of user, or email address str
 
     '''
-    from allura import model as M
-    if fromaddr is None:
-        fromaddr = g.noreply
-    elif not isinstance(fromaddr, six.string_types) or '@' not in fromaddr:
-        log.warning('Looking up user with fromaddr: %s', fromaddr)
-        user = M.User.query.get(_id=ObjectId(fromaddr), disabled=False, pending=False)
-        if not user:
-            log.warning('Cannot find user with ID: %s', fromaddr)
-            fromaddr = g.noreply
-        else:
-            fromaddr = user.email_address_header()
+    users = _lookup_users([fromaddr, toaddr])
+    fromaddr = _fromaddr(fromaddr, users)
 
     if not isinstance(toaddr, six.string_types) or '@' not in toaddr:
         log.warning('Looking up user with toaddr: %s', toaddr)
-        user = M.User.query.get(_id=ObjectId(toaddr), disabled=False, pending=False)
+        user = users.get(ObjectId(toaddr))
         if not user:
             log.warning('Cannot find user with ID: %s', toaddr)
             toaddr = g.noreply
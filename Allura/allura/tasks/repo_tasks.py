@@ -89,6 +89,12 @@ def refresh(**kwargs):
                  c.project.shortname, c.app.config.options.mount_point)
 
 
+@task
+def commit_activity(commit_ids):
+    from allura.model.repo_refresh import refresh_commit_activity
+    refresh_commit_activity(c.app.repo, commit_ids)
+
+
 @task
 def uninstall(**kwargs):
     from allura import model as M
@@ -28,7 +28,7 @@
 from tg import tmpl_context as c
 from alluratest.tools import with_setup, assert_raises, assert_equal
 from mock import patch
-from ming.orm.ormsession import ThreadLocalORMSession
+from ming.orm.ormsession import ThreadLocalORMSession, ORMSession
 from ming.orm import Mapper
 from bson import ObjectId
 from webob import Request
@@ -36,6 +36,7 @@
 import allura
 from allura import model as M
 from allura.lib import helpers as h
+from allura.lib import search
 from allura.lib import security
 from allura.tests import decorators as td
 from allura.websetup.schema import REGISTRY
@@ -142,6 +143,29 @@ def test_artifactlink():
     assert q_shortlink.count() == 0
 
 
+@with_setup(setUp, tearDown)
+def test_resolve_artifacts():
+    pages = [WM.Page(title='ResolvePage%d' % i) for i in range(3)]
+    msg = Checkmessage(text='foo', slug='foo')
+    ThreadLocalORMSession.flush_all()
+    ref_ids = [pages[2].index_id(), msg.index_id(), 'no-such-ref', pages[0].index_id()]
+    ThreadLocalORMSession.close_all()
+    with patch.object(ORMSession, 'find', autospec=True, side_effect=ORMSession.find) as find:
+        artifacts = M.ArtifactReference.artifacts_by_ids(ref_ids)
+    # one query for the references, and one per artifact class
+    queried = [call[0][1] for call in find.call_args_list]
+    assert_equal(queried.count(M.ArtifactReference), 1)
+    assert_equal(queried.count(WM.Page), 1)
+    assert_equal(queried.count(Checkmessage), 1)
+    assert_equal([a.index_id() if a else None for a in artifacts],
+                 [pages[2].index_id(), msg.index_id(), None, pages[0].index_id()])
+    assert_equal(search.artifacts_from_index_ids(ref_ids),
+                 [a for a in artifacts if a])
+    pairs = M.ArtifactReference.artifacts_by_ids(ref_ids, with_refs=True)
+    assert_equal([(r._id if r else None, a) for r, a in pairs],
+                 [(ref_ids[0], artifacts[0]), (ref_ids[1], artifacts[1]), (None, None), (ref_ids[3], artifacts[3])])
+
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.localhost',
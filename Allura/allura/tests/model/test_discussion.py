@@ -402,6 +402,11 @@ def test_post_url_paginated():
         url += '#' + _p.slug
         assert_equal(_p.url_paginated(), url)
 
+    # position is found with a count, without loading the whole thread
+    with patch.object(M.Thread, 'find_posts') as find_posts:
+        assert_equal(p[8].url_paginated(), t.url() + '?limit=3&page=2#' + p[8].slug)
+    assert not find_posts.called
+
 
 @with_setup(setUp, tearDown)
 def test_post_url_paginated_with_artifact():
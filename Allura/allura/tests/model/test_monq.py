@@ -18,6 +18,9 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import pprint
+from datetime import timedelta
+
+import mock
 from alluratest.tools import with_setup
 
 from ming.orm import ThreadLocalORMSession
@@ -42,3 +45,141 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_queue_latency():
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+    assert task.queue_latency is None
+    task.time_start = task.time_queue + timedelta(seconds=3)
+    assert task.queue_latency == 3.0, task.queue_latency
+
+
+@with_setup(setUp)
+def test_post_signals_wakeup():
+    with mock.patch.object(M.MonQWakeup, 'notify') as notify:
+        task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+        notify.assert_called_once_with(task)
+        notify.reset_mock()
+        M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+        assert not notify.called
+
+
+@with_setup(setUp)
+def test_wakeup_disabled_by_default():
+    with mock.patch.object(M.MonQWakeup, 'collection') as collection:
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        assert not collection.called
+
+
+@with_setup(setUp)
+def test_batch_tasks():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    M.MonQTask.post(pprint.saferepr, ('other',))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='test', size=10)
+    assert len(tasks) == 3, tasks
+    assert set(t.task_name for t in tasks) == {'pprint.pformat'}
+    results = M.MonQTask.run_batch(tasks)
+    assert results == ['[0]', '[1]', '[2]'], results
+    ThreadLocalORMSession.close_all()
+    done = M.MonQTask.query.find(dict(state='complete')).sort('time_queue').all()
+    assert [t.result for t in done] == ['[0]', '[1]', '[2]']
+    assert all(t.time_start and t.time_stop and t.process == 'test' for t in done)
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 1
+
+
+@with_setup(setUp)
+def test_batch_tasks_sessions():
+    M.MonQTask.post(pprint.pformat, ([0],))
+    M.MonQTask.post(pprint.pformat, ([1],), dict(bad_arg=1))  # fails
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='test', size=10)
+    assert len(tasks) == 2, tasks
+    with mock.patch('allura.model.monq_model.ThreadLocalORMSession') as orm_session:
+        M.MonQTask.run_batch(tasks)
+    # like the end of a request per task, except nothing is saved for the failed one
+    assert orm_session.flush_all.call_count == 1
+    assert orm_session.close_all.call_count == 2
+    assert [t.state for t in tasks] == ['complete', 'error']
+
+
+@with_setup(setUp)
+def test_coalesce():
+    t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), coalesce=True)
+    t2 = M.MonQTask.post(pprint.pformat, ([2, 3],), coalesce=True)
+    assert t2._id == t1._id
+    assert t2.args == [[1, 2, 3]], t2.args
+    # identical call is dropped
+    t3 = M.MonQTask.post(pprint.pformat, ([3],), coalesce=True)
+    assert t3._id == t1._id
+    # different kwargs, or not opted in, get their own task
+    t4 = M.MonQTask.post(pprint.pformat, ([4],), dict(width=10), coalesce=True)
+    t5 = M.MonQTask.post(pprint.pformat, ([5],))
+    assert len({t1._id, t4._id, t5._id}) == 3
+    # busy tasks aren't merged into
+    task = M.MonQTask.get(only=['pprint.pformat'])
+    assert task._id == t1._id
+    t6 = M.MonQTask.post(pprint.pformat, ([1],), coalesce=True)
+    assert t6._id != t1._id
+
+
+def test_merge_args():
+    from allura.model.monq_model import _merge_args
+    assert _merge_args([[1, 2], 'a'], ([2, 3], 'a')) == [[1, 2, 3], 'a']
+    assert _merge_args([[1, 2], 'a'], ([1], 'a')) == [[1, 2], 'a']
+    assert _merge_args([[1, 2], 'a'], ([1], 'b')) is None
+    assert _merge_args([[1]], ([1], 2)) is None
+    assert _merge_args([[{'a': 1}]], ([{'a': 1}, {'b': 2}],)) == [[{'a': 1}, {'b': 2}]]
+    assert _merge_args([[{'a': 1, 'b': [1]}]], ([{'b': [1], 'a': 1}],)) == [[{'a': 1, 'b': [1]}]]
+    # caps
+    assert _merge_args([[1, 2]], ([3],), max_items=3) == [[1, 2, 3]]
+    assert _merge_args([[1, 2]], ([3, 4],), max_items=3) is None
+    assert _merge_args([['x' * 50]], (['y' * 50],), max_bytes=100) is None
+    assert _merge_args([['x' * 50]], (['x' * 50],), max_bytes=100) == [['x' * 50]]
+
+
+@with_setup(setUp)
+def test_coalesce_keeps_order():
+    # e.g. add_artifacts, del_artifacts, add_artifacts of the same artifact
+    t1 = M.MonQTask.post(pprint.pformat, (['A'],), coalesce=True)
+    t2 = M.MonQTask.post(pprint.saferepr, (['A'],))
+    t3 = M.MonQTask.post(pprint.pformat, (['A'],), coalesce=True)
+    assert len({t1._id, t2._id, t3._id}) == 3
+    # but later calls can be merged into the last one
+    t4 = M.MonQTask.post(pprint.pformat, (['B'],), coalesce=True)
+    assert t4._id == t3._id
+    assert t4.args == [['A', 'B']], t4.args
+
+
+@with_setup(setUp)
+def test_coalesce_max_items():
+    t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), coalesce=True, coalesce_max_items=3)
+    t2 = M.MonQTask.post(pprint.pformat, ([3, 4],), coalesce=True, coalesce_max_items=3)
+    assert t2._id != t1._id
+    assert t1.args == [[1, 2]], t1.args
+    assert t2.args == [[3, 4]], t2.args
+
+
+def test_task_name_query():
+    from allura.model.monq_model import task_name_query, task_name_matches
+    assert task_name_query() is None
+    assert task_name_query(only=['a.b.c']) == {'$in': ['a.b.c']}
+    q = task_name_query(only=['a.b.', 'x.y'], exclude=['a.b.z'])
+    assert q['$regex'] == r'^(?:a\.b\.|x\.y$)', q
+    assert q['$not'].pattern == r'^(?:a\.b\.z$)', q
+    assert task_name_matches('a.b.c', only=['a.b.'])
+    assert not task_name_matches('x.y.z', only=['a.b.', 'x.y'])
+    assert not task_name_matches('a.b.z', only=['a.b.'], exclude=['a.b.z'])
+    assert task_name_matches('q.r', exclude=['a.b.'])
+
+
+@with_setup(setUp)
+def test_get_prefix():
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    assert M.MonQTask.get(only=['json.']) is None
+    task = M.MonQTask.get(only=['pprint.'])
+    assert task.task_name == 'pprint.pformat'
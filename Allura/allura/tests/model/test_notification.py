@@ -22,6 +22,7 @@
 import collections
 
 from tg import tmpl_context as c, app_globals as g
+from tg import config
 from alluratest.tools import assert_equal, assert_in
 from ming.orm import ThreadLocalORMSession
 import mock
@@ -215,6 +216,96 @@ def test_delivery(self):
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+    def test_deliver(self):
+        self._subscribe()
+        self._subscribe(user=M.User.query.get(username='test-user-2'))
+        with mock.patch.object(M.Mailbox, '_deliver_each') as deliver_each:
+            M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        assert_equal(deliver_each.call_count, 0)
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal(len(mboxes), 2)
+        for mbox in mboxes:
+            assert_equal(mbox.queue, ['nid1'])
+            assert not mbox.queue_empty
+
+    @mock.patch('allura.model.notification.log')
+    def test_deliver_errors(self, log):
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe()
+        self._subscribe(user=user2)
+        mboxes = M.Mailbox._collection()
+        user2_mbox = M.Mailbox.query.get(user_id=user2._id)
+
+        def update_one(query, update):
+            if query['_id'] == user2_mbox._id:
+                raise ValueError('bad mailbox')
+            return mboxes.update_one(query, update)
+        coll = mock.Mock(wraps=mboxes)
+        coll.update_many.side_effect = ValueError('bulk update failed')
+        coll.update_one.side_effect = update_one
+        with mock.patch.object(M.Mailbox, '_collection', return_value=coll):
+            M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        ThreadLocalORMSession.close_all()
+        assert_equal(M.Mailbox.query.get(user_id=c.user._id).queue, ['nid1'])
+        assert_equal(M.Mailbox.query.get(user_id=user2._id).queue, [])
+        # one error for the bulk update, then one for the mailbox it failed for
+        assert_equal(log.exception.call_count, 2)
+        assert_equal(log.exception.call_args[0][-1], user2._id)
+
+    def test_fire_ready_sharded(self):
+        users = [M.User.query.get(username=u) for u in ('test-admin', 'test-user', 'test-user-2')]
+        for u in users:
+            self._subscribe(user=u)
+        self._post_notification()
+        ThreadLocalORMSession.flush_all()
+        with h.push_config(config, **{'notification.fire_workers': '2',
+                                      'notification.fire_batch_size': '1'}):
+            M.MonQTask.run_ready()
+        ThreadLocalORMSession.close_all()
+        for mbox in M.Mailbox.query.find().all():
+            assert_equal(mbox.queue, [])
+            assert mbox.queue_empty
+        # emails are queued in bulk
+        assert_equal(M.MonQTask.query.find({'task_name': 'allura.tasks.mail_tasks.sendmail'}).count(), 0)
+        bulk_tasks = M.MonQTask.query.find({'task_name': 'allura.tasks.mail_tasks.sendmail_bulk'}).all()
+        messages = [msg for t in bulk_tasks for msg in t.args[0]]
+        assert_equal(sorted(d for msg in messages for d in msg['destinations']),
+                     sorted(str(u._id) for u in users))
+
+    def test_fire_ready_sharded_errors(self):
+        users = [M.User.query.get(username=u) for u in ('test-admin', 'test-user', 'test-user-2')]
+        for u in users:
+            self._subscribe(user=u)
+        self._post_notification()
+        ThreadLocalORMSession.flush_all()
+        fire = M.Mailbox.fire
+
+        def fire_or_fail(mbox, *args):
+            if mbox.user_id == users[1]._id:
+                raise ValueError('bad mailbox')
+            return fire(mbox, *args)
+        # the 2nd and 3rd mailboxes are claimed together by the 2nd shard
+        with h.push_config(config, **{'notification.fire_workers': '2',
+                                      'notification.fire_batch_size': '10'}), \
+                mock.patch.object(M.Mailbox, 'fire', autospec=True, side_effect=fire_or_fail):
+            M.MonQTask.run_ready()
+        # the rest of the failed mailbox's batch is still sent
+        bulk_tasks = M.MonQTask.query.find({'task_name': 'allura.tasks.mail_tasks.sendmail_bulk'}).all()
+        messages = [msg for t in bulk_tasks for msg in t.args[0]]
+        assert_equal(sorted(d for msg in messages for d in msg['destinations']),
+                     sorted(str(u._id) for u in (users[0], users[2])))
+
+    def test_shard_ranges(self):
+        for i in range(5):
+            self._subscribe(user=M.User(username='shard-user-%s' % i))
+        query = {'type': 'direct'}
+        ids = sorted(mbox._id for mbox in M.Mailbox.query.find(query))
+        assert_equal(len(ids), 5)
+        ranges = M.Mailbox._shard_ranges(query, 2)
+        assert_equal(ranges, [(None, ids[2]), (ids[2], None)])
+        assert_equal(len(M.Mailbox._shard_ranges(query, 10)), 5)
+        assert_equal(M.Mailbox._shard_ranges({'type': 'summary'}, 2), [])
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
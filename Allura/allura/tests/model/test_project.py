@@ -22,8 +22,8 @@
 """
 from __future__ import unicode_literals
 from __future__ import absolute_import
-from alluratest.tools import with_setup, assert_equals, assert_in
-from tg import tmpl_context as c
+from alluratest.tools import with_setup, assert_equals, assert_in, assert_not_in, assert_not_equal
+from tg import tmpl_context as c, app_globals as g
 from ming.orm.ormsession import ThreadLocalORMSession
 from formencode import validators as fev
 
@@ -32,6 +32,8 @@
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib.exceptions import ToolError, Invalid
+from allura.lib.nav_cache import NavbarCache
+from allura.lib.security import Credentials
 from mock import MagicMock, patch
 
 
@@ -159,6 +161,56 @@ def test_set_ordinal_to_admin_tool():
         assert_equals(sm[-1].tool_name, 'admin')
 
 
+@with_setup(setUp)
+def test_sitemap_cached():
+    with patch.object(g, 'navbar_cache', NavbarCache()):
+        labels = [e.label for e in c.project.sitemap()]
+        assert_equals(g.navbar_cache.stats['misses'], 1)
+        assert_equals([e.label for e in c.project.sitemap()], labels)
+        assert_equals(g.navbar_cache.stats['hits'], 1)
+        c.project.sitemap(tools_only=True)  # not cached
+        # cached separately for different roles
+        with h.push_config(c, user=M.User.anonymous()):
+            c.project.sitemap()
+        assert_equals(g.navbar_cache.stats['misses'], 2)
+        assert_equals(len(g.navbar_cache), 2)
+
+        c.project.install_app('wiki', 'navwiki', 'Nav Wiki')
+        assert_equals(len(g.navbar_cache), 0)
+        assert_in('Nav Wiki', [e.label for e in c.project.sitemap()])
+
+        # subproject changes aren't made through the parent
+        sub = c.project.direct_subprojects[0]
+        sub.name = 'Renamed Subproject'
+        ThreadLocalORMSession.flush_all()
+        assert_in('Renamed Subproject', [e.label for e in c.project.sitemap()])
+        sub.deleted = True
+        ThreadLocalORMSession.flush_all()
+        assert_not_in('Renamed Subproject', [e.label for e in c.project.sitemap()])
+
+
+@with_setup(setUp)
+def test_nav_cache_key_roles():
+    user1, user2 = M.User.by_username('test-user'), M.User.by_username('test-user-2')
+    # each has a role of their own, but the same permissions
+    for user in (user1, user2):
+        M.ProjectRole.by_user(user, project=c.project, upsert=True)
+    ThreadLocalORMSession.flush_all()
+
+    def key(user):
+        Credentials.get().clear()
+        with h.push_config(c, user=user):
+            return c.project.nav_cache_key('sitemap')
+    assert_equals(key(user1), key(user2))
+    assert_not_equal(key(user1), key(M.User.by_username('test-admin')))
+    assert_not_equal(key(user1), key(M.User.anonymous()))
+    # until an ACL names one of their roles
+    role = M.ProjectRole.by_user(user1, project=c.project)
+    c.project.app_configs[0].acl.append(M.ACE.deny(role._id, 'read'))
+    ThreadLocalORMSession.flush_all()
+    assert_not_equal(key(user1), key(user2))
+
+
 @with_setup(setUp)
 def test_users_and_roles():
     p = M.Project.query.get(shortname='test')
@@ -130,6 +130,15 @@ def test_clone_command_categories(self):
             {'key': 'https_anon', 'name': 'HTTPS', 'title': 'HTTPS'}
         ])
 
+    def test_refresh_commits_children(self):
+        from allura.model.repo_refresh import refresh_commits_children
+        for _id, parent_ids in [('a', []), ('b', ['a']), ('c', ['a']), ('d', ['b', 'c'])]:
+            M.repository.CommitDoc(dict(_id=_id, parent_ids=parent_ids, child_ids=[])).m.insert()
+        M.repository.CommitDoc.m.update_partial({'_id': 'a'}, {'$set': {'child_ids': ['b']}})
+        refresh_commits_children(['b', 'c', 'd'], batch_size=2)
+        children = {ci._id: ci.child_ids for ci in M.repository.CommitDoc.m.find()}
+        assert_equal(children, {'a': ['b', 'c'], 'b': ['d'], 'c': ['d'], 'd': []})
+
 
 class TestLastCommit(unittest.TestCase):
     def setUp(self):
@@ -158,6 +167,9 @@ def setUp(self):
         lcids = M.repository.RepositoryImplementation.last_commit_ids
         lcids = getattr(lcids, '__func__', lcids)
         self.repo.last_commit_ids = lambda *a, **k: lcids(self.repo, *a, **k)
+        _lcids = M.repository.RepositoryImplementation._last_commit_ids
+        _lcids = getattr(_lcids, '__func__', _lcids)
+        self.repo._last_commit_ids = lambda *a, **k: _lcids(self.repo, *a, **k)
         c.lcid_cache = {}
 
     def _build_tree(self, commit, path, tree_paths):
@@ -291,6 +303,23 @@ def test_subdir_lcd_prev_commit(self):
         self.assertEqual(lcd.by_name['file1'], commit3._id)
         self.assertEqual(lcd.by_name['file2'], commit2._id)
 
+    def test_compute_lcds(self):
+        from allura.model.repo_refresh import compute_lcds
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file1'])
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file1', 'dir1/file2'], ['dir1/file2'], [commit1])
+        commit3 = self._add_commit('Commit 3', ['file1', 'dir1/file1', 'dir1/file2', 'file2'], ['file2'], [commit2])
+        model_cache = M.repository.ModelCache()
+        lcid_cache = {}
+        self.assertEqual(compute_lcds(commit1, model_cache, lcid_cache), 2)
+        self.assertEqual(compute_lcds(commit2, model_cache, lcid_cache), 2)
+        self.assertEqual(lcid_cache['dir1'], commit2._id)
+        self.repo.log = mock.Mock(side_effect=AssertionError('should use lcid_cache'))
+        self.assertEqual(compute_lcds(commit3, model_cache, lcid_cache), 1)  # dir1 unchanged
+        lcd = model_cache.get(M.repository.LastCommit, dict(path='', commit_id=commit3._id))
+        self.assertEqual(lcd.by_name, {'file1': commit1._id, 'dir1': commit2._id, 'file2': commit3._id})
+        lcd = model_cache.get(M.repository.LastCommit, dict(path='dir1', commit_id=commit2._id))
+        self.assertEqual(lcd.by_name, {'file1': commit1._id, 'file2': commit2._id})
+
     def test_subdir_lcd_always_empty(self):
         commit1 = self._add_commit('Commit 1', ['file1', 'dir1'])
         commit2 = self._add_commit('Commit 2', ['file1', 'file2'], ['file2'], [commit1])
@@ -681,6 +710,220 @@ def test_pruning_instance_flush(self, session):
         session.return_value.expunge.assert_called_once_with(tree1)
 
 
+class TestSharedModelCache(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.shared = M.repository.SharedModelCache(max_size=10 * 1024)
+        for i in range(3):
+            M.repository.Tree(_id='tree%d' % i, tree_ids=[], blob_ids=[], other_ids=[])
+        session(M.repository.Tree).flush()
+        session(M.repository.Tree).clear()
+
+    def test_shared_between_caches(self):
+        tree = M.repository.ModelCache(shared=self.shared).get(M.repository.Tree, {'_id': 'tree0'})
+        self.assertEqual(tree._id, 'tree0')
+        self.assertEqual(len(self.shared), 1)
+        session(M.repository.Tree).clear()
+
+        with mock.patch.object(M.repository.Tree.query, 'get') as tr_get:
+            tree = M.repository.ModelCache(shared=self.shared).get(M.repository.Tree, {'_id': 'tree0'})
+        self.assertFalse(tr_get.called)
+        self.assertEqual(tree._id, 'tree0')
+        self.assertEqual(tree.tree_ids, [])
+        self.assertEqual(self.shared.stats, dict(hits=1, misses=1, evictions=0))
+
+    def test_only_immutable_types(self):
+        cache = M.repository.ModelCache(shared=self.shared)
+        cache.get(M.repository.CommitGraphDoc, {'_id': 'foo'})
+        # commits get new repo_ids and child_ids
+        M.repository.Commit(_id='commit0', repo_ids=[], child_ids=[])
+        session(M.repository.Commit).flush()
+        cache.get(M.repository.Commit, {'_id': 'commit0'})
+        self.assertEqual(len(self.shared), 0)
+        self.assertEqual(self.shared.stats['misses'], 0)
+
+    def test_max_size(self):
+        trees = [M.repository.Tree.query.get(_id='tree%d' % i) for i in range(3)]
+        self.shared.put('tree0', trees[0])
+        self.shared.max_size = self.shared.size * 2  # all the same size
+        for i, tree in enumerate(trees):
+            self.shared.put('tree%d' % i, tree)
+        self.assertEqual(list(self.shared._entries.keys()), ['tree1', 'tree2'])
+        self.assertEqual(self.shared.size, self.shared.max_size)
+        self.assertEqual(self.shared.stats['evictions'], 1)
+
+    def test_new_objects_not_cached(self):
+        tree = M.repository.Tree(_id='tree4', tree_ids=[], blob_ids=[], other_ids=[])
+        self.shared.put('tree4', tree)
+        self.assertEqual(len(self.shared), 0)
+
+
+class TestRefreshCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.repo = mock.Mock(_id=ObjectId(), full_fs_path='/repo')
+        self.repo.all_commit_ids.return_value = ['2', '1']
+        self.calls = []
+
+    def _stage(self, name, fail_on=None):
+        def stage(repo, checkpoint, all_commit_ids):
+            self.calls.append((name, checkpoint['commit_ids']))
+            if checkpoint['commit_ids'] == fail_on:
+                raise ValueError(name)
+        return name, stage
+
+    @mock.patch('allura.model.repo_refresh.CHECKPOINT_CHUNK_SIZE', 1)
+    @mock.patch('allura.model.repo_refresh.unknown_commit_ids')
+    def test_resume(self, unknown_commit_ids):
+        from allura.model.repo_refresh import refresh_repo, _load_checkpoint
+        stages = [self._stage('one'), self._stage('two', fail_on=['2', '1'])]
+        unknown_commit_ids.return_value = ['2', '1']
+        with mock.patch('allura.model.repo_refresh.REFRESH_STAGES', stages):
+            self.assertRaises(ValueError, refresh_repo, self.repo)
+            checkpoint = _load_checkpoint(self.repo)
+            assert_equal(checkpoint['stages'], ['one'])
+            assert_equal(checkpoint['commit_ids'], ['2', '1'])
+            assert_equal(checkpoint['attempts'], 1)
+            # state doc, and a doc per chunk of commit ids
+            assert_equal(M.repository.RefreshCheckpointDoc.m.find(dict(repo_id=self.repo._id)).count(), 3)
+
+            stages[1] = self._stage('two')
+            self.repo.all_commit_ids.return_value = ['3', '2', '1']
+            unknown_commit_ids.return_value = ['3']
+            refresh_repo(self.repo)
+        assert_equal(self.calls, [
+            ('one', ['2', '1']), ('two', ['2', '1']),  # first refresh, failed
+            ('two', ['2', '1']),  # resumed
+            ('one', ['3']), ('two', ['3']),  # new refresh
+        ])
+        assert_equal(_load_checkpoint(self.repo), None)
+        assert_equal(M.repository.RefreshCheckpointDoc.m.find(dict(repo_id=self.repo._id)).count(), 0)
+
+    @mock.patch('allura.model.repo_refresh.unknown_commit_ids')
+    def test_max_attempts(self, unknown_commit_ids):
+        from allura.model.repo_refresh import refresh_repo, _load_checkpoint
+        stages = [self._stage('one'), self._stage('two', fail_on=['2'])]
+        unknown_commit_ids.return_value = ['2']
+        with mock.patch('allura.model.repo_refresh.REFRESH_STAGES', stages), \
+                h.push_config(config, **{'scm.refresh.max_attempts': '2'}):
+            self.assertRaises(ValueError, refresh_repo, self.repo)
+            self.assertRaises(ValueError, refresh_repo, self.repo)  # resumed, fails again
+            assert_equal(_load_checkpoint(self.repo)['attempts'], 2)
+            unknown_commit_ids.return_value = ['3']
+            refresh_repo(self.repo)  # gives up on the old one
+        assert_equal(self.calls, [
+            ('one', ['2']), ('two', ['2']),
+            ('two', ['2']),
+            ('one', ['3']), ('two', ['3']),
+        ])
+        assert_equal(_load_checkpoint(self.repo), None)
+
+
+class TestCommitGraph(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.repo_id = ObjectId()
+        #   a - b - d - e
+        #    \     /
+        #     - c -
+        self.docs = [
+            dict(_id='e', parent_ids=['d'], committed=dict(date=datetime(2020, 1, 5))),
+            dict(_id='d', parent_ids=['b', 'c'], committed=dict(date=datetime(2020, 1, 4))),
+            dict(_id='c', parent_ids=['a'], committed=dict(date=datetime(2020, 1, 3))),
+            dict(_id='b', parent_ids=['a'], committed=dict(date=datetime(2020, 1, 2))),
+            dict(_id='a', parent_ids=[], committed=dict(date=datetime(2020, 1, 1))),
+        ]
+
+    def _graph(self, docs):
+        graph = M.repository.CommitGraph(self.repo_id)
+        graph.add_commits(docs)
+        graph.save()
+        return graph
+
+    def test_add_commits(self):
+        graph = self._graph(self.docs)
+        assert_equal(len(graph), 5)
+        assert_equal(graph.commit_ids[0], 'a')
+        assert_equal(graph.commit_ids[-1], 'e')
+        assert_equal(sorted(graph.parent_ids('d')), ['b', 'c'])
+        assert_equal(graph.date('c'), datetime(2020, 1, 3))
+        assert_equal(graph.generations[graph.index['d']], 3)
+        assert_equal(graph.generations[graph.index['e']], 4)
+
+    def test_save_and_load(self):
+        with mock.patch.object(M.repository.CommitGraph, 'CHUNK_SIZE', 2):
+            graph = self._graph(self.docs[2:])
+            graph.add_commits(self.docs[:2])
+            graph.save()
+            loaded = M.repository.CommitGraph(self.repo_id)
+            loaded.load()
+            assert_equal(loaded.commit_ids, graph.commit_ids)
+            assert_equal(loaded.parents, graph.parents)
+            assert_equal(loaded.generations, graph.generations)
+            assert_equal(loaded.dates, graph.dates)
+            assert_equal(M.repository.CommitGraphDoc.m.find(dict(repo_id=self.repo_id)).count(), 3)
+
+    def test_concurrent_save(self):
+        with mock.patch.object(M.repository.CommitGraph, 'CHUNK_SIZE', 2):
+            self._graph(self.docs[3:])  # a, b
+            graph1 = M.repository.CommitGraph.get(self.repo_id)
+            graph2 = M.repository.CommitGraph(self.repo_id)
+            graph2.load()
+            graph1.add_commits(self.docs[2:3])  # c
+            graph1.save()
+            # graph2 is stale: it adds c and d on top of a and b too
+            graph2.add_commits(self.docs[1:])
+            graph2.save()
+            loaded = M.repository.CommitGraph(self.repo_id)
+            loaded.load()
+            assert_equal(loaded.commit_ids, ['a', 'b', 'c', 'd'])
+            assert_equal(graph2.commit_ids, loaded.commit_ids)
+            assert_equal(sorted(loaded.parent_ids('d')), ['b', 'c'])
+            assert_equal(loaded.generations.tolist(), [1, 2, 2, 3])
+            docs = M.repository.CommitGraphDoc.m.find(dict(repo_id=self.repo_id)).sort('chunk').all()
+            assert_equal([doc.count for doc in docs], [2, 2])
+
+    def test_cache_size(self):
+        with mock.patch.object(M.repository.CommitGraph, '_cache', OrderedDict()), \
+                mock.patch.object(M.repository.CommitGraph, 'CACHE_MAX_COMMITS', 6):
+            self._graph(self.docs)
+            other_repo_id = ObjectId()
+            other = M.repository.CommitGraph(other_repo_id)
+            other.add_commits(self.docs)
+            other.save()
+            M.repository.CommitGraph.get(self.repo_id)
+            M.repository.CommitGraph.get(other_repo_id)
+            assert_equal(list(M.repository.CommitGraph._cache), [other_repo_id])
+
+    def test_log(self):
+        graph = self._graph(self.docs)
+        assert_equal(list(graph.log(['e'])), ['e', 'd', 'c', 'b', 'a'])
+        assert_equal(list(graph.log(['e'], limit=2)), ['e', 'd'])
+        assert_equal(list(graph.log(['b', 'c'])), ['c', 'b', 'a'])
+
+    def test_count(self):
+        graph = self._graph(self.docs)
+        assert_equal(graph.count(['e']), 5)
+        assert_equal(graph.count(['b', 'c']), 3)
+        # e.g. after a force push to b
+        assert_equal(graph.count(['b']), 2)
+        assert_equal(graph.count(['unknown']), 0)
+
+    def test_ancestry(self):
+        graph = self._graph(self.docs)
+        assert graph.is_ancestor('a', 'e')
+        assert graph.is_ancestor('c', 'd')
+        assert graph.is_ancestor('e', 'e')
+        assert not graph.is_ancestor('b', 'c')
+        assert not graph.is_ancestor('e', 'a')
+        assert_equal(graph.merge_base('b', 'c'), 'a')
+        assert_equal(graph.merge_base('e', 'c'), 'c')
+        assert_equal(graph.merge_base('b', 'b'), 'b')
+
+
 class TestMergeRequest(object):
 
     def setUp(self):
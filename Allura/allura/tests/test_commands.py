@@ -28,7 +28,7 @@
 
 from ming.base import Object
 from ming.orm import ThreadLocalORMSession
-from mock import Mock, call, patch
+from mock import Mock, call, patch, mock_open
 import pymongo
 import pkg_resources
 
@@ -337,6 +337,48 @@ def test_purge_old_only(self):
         assert_equal(M.MonQTask.query.find().count(), 0)
 
 
+class TestTaskdCommand(object):
+
+    def test_load_pools(self):
+        cmd = taskd.TaskdCommand('taskd')
+        pools = cmd.load_pools({
+            'taskd.pools': 'indexing, mail, default',
+            'taskd.pool.indexing.tasks': 'allura.tasks.index_tasks.',
+            'taskd.pool.indexing.workers': '3',
+            'taskd.pool.mail.tasks': 'allura.tasks.mail_tasks.sendmail, allura.tasks.mail_tasks.sendsimplemail',
+        })
+        assert_equal([p['name'] for p in pools], ['indexing', 'mail', 'default'])
+        assert_equal([p['workers'] for p in pools], [3, 1, 1])
+        assert_equal(pools[0]['only'], ['allura.tasks.index_tasks.'])
+        assert_equal(pools[0]['exclude'], [])
+        assert_equal(pools[2]['only'], [])
+        assert_equal(pools[2]['exclude'], ['allura.tasks.index_tasks.',
+                                           'allura.tasks.mail_tasks.sendmail',
+                                           'allura.tasks.mail_tasks.sendsimplemail'])
+
+    def test_load_pools_default(self):
+        pools = taskd.TaskdCommand('taskd').load_pools({})
+        assert_equal(pools, [dict(name='default', only=[], exclude=[], workers=1)])
+
+    def test_memory_mb(self):
+        with patch.object(taskd, 'open', mock_open(read_data='5000 2048 300 1 0 900 0\n'), create=True), \
+                patch.object(taskd.os, 'sysconf', return_value=4096):
+            assert_equal(taskd.memory_mb(), 8)
+        with patch.object(taskd, 'open', side_effect=IOError, create=True), \
+                patch.object(taskd.resource, 'getrusage') as getrusage:
+            getrusage.return_value.ru_maxrss = 10 * 1024
+            assert_equal(taskd.memory_mb(), 10)
+
+    def test_should_recycle(self):
+        cmd = taskd.TaskdCommand('taskd')
+        with patch.dict(taskd.tg.config, {'taskd.max_tasks': '10', 'taskd.max_memory_mb': '100'}), \
+                patch.object(taskd, 'memory_mb', return_value=50) as memory_mb:
+            assert not cmd.should_recycle(9)
+            assert cmd.should_recycle(10)
+            memory_mb.return_value = 100
+            assert cmd.should_recycle(1)
+
+
 class TestTaskdCleanupCommand(object):
 
     def setUp(self):
@@ -60,6 +60,23 @@ def mock_post(f, args, kw, delay=None):
         MonQTask.post.side_effect = mock_post
         func.post('test', foo=2, delay=1)
 
+    @patch('allura.lib.decorators.c')
+    @patch('allura.model.MonQTask')
+    def test_post_coalesce_limits(self, MonQTask, c):
+        @task(coalesce=True, coalesce_max_items=10)
+        def func(ids):
+            pass
+
+        c.project = None
+        func.post([1])
+        self.assertTrue(MonQTask.post.call_args[1]['coalesce'])
+        self.assertEqual(MonQTask.post.call_args[1]['coalesce_max_items'], 10)
+        self.assertNotIn('coalesce_max_bytes', MonQTask.post.call_args[1])
+        func.post([1], coalesce_max_items=5, coalesce_max_bytes=100)
+        self.assertEqual(MonQTask.post.call_args[0][2], {})
+        self.assertEqual(MonQTask.post.call_args[1]['coalesce_max_items'], 5)
+        self.assertEqual(MonQTask.post.call_args[1]['coalesce_max_bytes'], 100)
+
 
 class TestMemoize(object):
 
@@ -46,6 +46,8 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib.app_globals import ForgeMarkdown
+from allura.lib.markdown_cache import MarkdownRenderCache
+from allura.lib.nav_cache import NavbarCache
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -402,6 +404,31 @@ def test_wiki_artifact_links():
         assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
 
 
+@td.with_wiki
+def test_wiki_artifact_links_prefetched():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        md = g.markdown
+        with patch.object(M.Shortlink, 'lookup') as lookup:
+            text = md.convert('See [Home] and [test:wiki:Home] and [NoSuchPage] and [there](Home)')
+        # resolved all at once by the prefetch, not one at a time
+        assert not lookup.called
+        assert '<a class="alink" href="/p/test/wiki/Home/">[Home]</a>' in text, text
+        assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
+        assert '<a class="" href="/p/test/wiki/Home/">there</a>' in text, text
+        assert '<span>[NoSuchPage]</span>' in text, text
+        assert_equal(len(md.treeprocessors['links'].alinks), 3)
+
+
+@td.with_wiki
+def test_external_links_not_looked_up():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        with patch.object(M.Shortlink, 'from_links', wraps=M.Shortlink.from_links) as from_links:
+            text = g.markdown.convert('See [Home], [this](http://example.com/) and [me](mailto:a@example.com)')
+        assert_equal([link for args, kw in from_links.call_args_list for link in args], ['Home'])
+        assert '<a class="alink" href="/p/test/wiki/Home/">[Home]</a>' in text, text
+        assert 'href="http://example.com/"' in text, text
+
+
 def test_markdown_links():
     with patch.dict(tg.config, {'nofollow_exempt_domains': 'foobar.net'}):
         text = g.markdown.convert('Read [here](http://foobar.net/) about our project')
@@ -809,6 +836,138 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestMarkdownRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MarkdownRenderCache(max_size=100)
+        self.md = ForgeMarkdown(render_cache=self.cache, cache_variant='test')
+
+    def test_convert_cached(self):
+        from jinja2 import Markup
+        html = self.md.convert('**bold**')
+        self.assertEqual(html, '<p><strong>bold</strong></p>')
+        self.assertEqual(len(self.cache), 1)
+        with patch('markdown.Markdown.convert') as convert:
+            cached = self.md.convert('**bold**')
+            self.assertEqual(cached, html)
+            self.assertIsInstance(cached, Markup)
+            self.assertFalse(convert.called)
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_convert_not_cached(self):
+        self.md.convert('text [[macro]] pass')
+        self.assertEqual(len(self.cache), 0)
+        # rendering depends on what these point to
+        for source in ['see [SomePage]', 'see [text](SomePage)', 'hi @test-admin', 'fixes #1', 'in r2',
+                       'see ticket:3']:
+            self.md.convert(source)
+            self.assertEqual(len(self.cache), 0, source)
+        self.md.convert('email me at foo @ example.com, 10# of tickets')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.clear()
+        ForgeMarkdown(render_cache=self.cache).convert('**bold**')  # no variant
+        self.assertEqual(len(self.cache), 0)
+
+    def test_key(self):
+        key = MarkdownRenderCache.key
+        self.assertEqual(key('text', 'a', 4), key('text', 'a', 4))
+        self.assertNotEqual(key('text', 'a', 4), key('text', 'b', 4))
+        self.assertNotEqual(key('text', 'a', 4), key('text', 'a', 5))
+        self.assertNotEqual(key('text', 'a', 4, 'p1'), key('text', 'a', 4, 'p2'))
+        self.assertNotEqual(key('text', 'a', 4, 'p1', 'a1'), key('text', 'a', 4, 'p1', 'a2'))
+
+    def test_lru_eviction(self):
+        self.cache.put('a', 'x' * 40)
+        self.cache.put('b', 'x' * 40)
+        self.cache.get('a')
+        self.cache.put('c', 'x' * 40)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 'x' * 40)
+        self.assertEqual(self.cache.get('c'), 'x' * 40)
+        self.assertEqual(self.cache.size, 80)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.cache.put('d', 'x' * 101)  # too big to cache at all
+        self.assertEqual(len(self.cache), 2)
+
+    def test_shared(self):
+        collection = Mock()
+        collection.find_one.return_value = {'_id': 'a', 'html': 'shared html'}
+        cache = MarkdownRenderCache(collection=collection)
+        self.assertEqual(cache.get('a'), 'shared html')
+        self.assertEqual(cache.get('a'), 'shared html')
+        collection.find_one.assert_called_once_with({'_id': 'a'})
+        self.assertEqual(cache.stats['shared_hits'], 1)
+        cache.put('b', 'html')
+        collection.insert_one.assert_called_once_with({'_id': 'b', 'html': 'html'})
+
+    def test_from_config(self):
+        self.assertIsNone(MarkdownRenderCache.from_config({}))
+        cache = MarkdownRenderCache.from_config({'markdown_render_cache': 'true',
+                                                 'markdown_render_cache.max_size': '1000'})
+        self.assertEqual(cache.max_size, 1000)
+        self.assertIsNone(cache.collection)
+
+
+class TestNavbarCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = NavbarCache(max_entries=2, ttl=60)
+
+    def test_get_put_copies(self):
+        self.assertIsNone(self.cache.get(('p1', 'sitemap')))
+        entries = [{'label': 'Wiki'}]
+        self.cache.put(('p1', 'sitemap'), entries)
+        entries[0]['label'] = 'changed'
+        cached = self.cache.get(('p1', 'sitemap'))
+        self.assertEqual(cached, [{'label': 'Wiki'}])
+        cached[0]['label'] = 'changed'
+        self.assertEqual(self.cache.get(('p1', 'sitemap')), [{'label': 'Wiki'}])
+        self.assertEqual(self.cache.stats['hits'], 2)
+        self.assertEqual(self.cache.stats['misses'], 1)
+        self.assertAlmostEqual(self.cache.hit_rate(), 2 / 3.0)
+
+    @patch('allura.lib.nav_cache.time.time')
+    def test_ttl(self, time):
+        time.return_value = 1000
+        self.cache.put(('p1', 'sitemap'), [])
+        time.return_value = 1059
+        self.assertEqual(self.cache.get(('p1', 'sitemap')), [])
+        time.return_value = 1061
+        self.assertIsNone(self.cache.get(('p1', 'sitemap')))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate(self):
+        self.cache.put(('p1', 'sitemap'), [])
+        self.cache.put(('p2', 'sitemap'), [])
+        self.cache.invalidate('p1')
+        self.assertIsNone(self.cache.get(('p1', 'sitemap')))
+        self.assertEqual(self.cache.get(('p2', 'sitemap')), [])
+
+    def test_lru_eviction(self):
+        self.cache.put(('p1',), [1])
+        self.cache.put(('p2',), [2])
+        self.cache.get(('p1',))
+        self.cache.put(('p3',), [3])
+        self.assertIsNone(self.cache.get(('p2',)))
+        self.assertEqual(self.cache.get(('p1',)), [1])
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+    @patch('allura.lib.nav_cache.log')
+    def test_report(self, log):
+        cache = NavbarCache(report_interval=2)
+        cache.get(('p1',))
+        self.assertFalse(log.info.called)
+        cache.get(('p1',))
+        self.assertEqual(log.info.call_count, 1)
+
+    def test_from_config(self):
+        self.assertIsNone(NavbarCache.from_config({}))
+        cache = NavbarCache.from_config({'navbar_cache': 'true', 'navbar_cache.ttl': '30'})
+        self.assertEqual(cache.ttl, 30)
+        self.assertEqual(cache.max_entries, 10000)
+
+
 class TestEmojis(unittest.TestCase):
 
     def test_markdown_emoji_atomic(self):
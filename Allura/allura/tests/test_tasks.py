@@ -19,10 +19,15 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import json
 import operator
+import os
 import shutil
 import sys
+import tempfile
 import unittest
+import zipfile
+from datetime import datetime
 
 import six
 from base64 import b64encode
@@ -34,9 +39,9 @@
 from tg import tmpl_context as c, app_globals as g
 
 from datadiff.tools import assert_equal
-from alluratest.tools import assert_in, assert_less
+from alluratest.tools import assert_in, assert_less, assert_raises
 from ming.orm import FieldProperty, Mapper
-from ming.orm import ThreadLocalORMSession
+from ming.orm import ThreadLocalORMSession, session
 from testfixtures import LogCapture
 
 from alluratest.controller import setup_basic_test, setup_global_objects, TestController
@@ -44,8 +49,9 @@
 from allura import model as M
 from allura.command.taskd import TaskdCommand
 from allura.lib import helpers as h
+from allura.lib import mail_util
 from allura.lib import search
-from allura.lib.exceptions import CompoundError
+from allura.lib.exceptions import CompoundError, MailError
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
 from allura.tasks import mail_tasks
@@ -244,6 +250,29 @@ def test_del_artifacts(self, solr):
         solr_query = 'id:({0})'.format(' || '.join(ref_ids))
         solr.delete.assert_called_once_with(q=solr_query)
 
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_batches(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='tb_%s' % x, text='')
+                     for x in range(5)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        project = c.project
+        with mock.patch.dict(tg.config, {'solr.add_batch_size': '2'}):
+            index_tasks.add_artifacts(ref_ids)
+        assert_equal([len(call[0][0]) for call in solr.add.call_args_list], [2, 2, 1])
+        added = [doc['id'] for call in solr.add.call_args_list for doc in call[0][0]]
+        assert_equal(sorted(added), sorted(ref_ids))
+        # the batches are dropped from the sessions, but nothing else is
+        assert session(artifacts[0]) is None
+        assert session(project) is not None
+        project.short_description = 'changed after indexing'
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        assert_equal(M.Project.query.get(_id=project._id).short_description, 'changed after indexing')
+
 
 class TestMailTasks(unittest.TestCase):
 
@@ -489,6 +518,98 @@ def test_send_email_long_lines_use_quoted_printable(self):
             assert_in('<div class=3D"markdown_content"><p>0123456789012345678901234567890123456789=', body)
             assert_in('<p>=D0=93=D1=80=D0=BE=D0=BC=D0=B0=D0=B4=D1=8B =D1=81=D1=82=D1=80=D0=BE =D0=', body)
 
+    def test_sendmail_bulk(self):
+        admin = M.User.by_username('test-admin')
+        user1 = M.User.by_username('test-user-1')
+        user1.preferences['email_address'] = 'user1@mail.com'
+        ThreadLocalORMSession.flush_all()
+        smtp = mock.Mock()
+
+        def connect(client):
+            client._client = smtp
+        message_id = h.gen_message_id()
+        mail = dict(fromaddr=str(admin._id), text='This is a test', reply_to=g.noreply,
+                    subject='Test subject', message_id=message_id)
+        pool = mail_util.SMTPClientPool(size=2)
+        with mock.patch.object(mail_util.SMTPClient, '_connect', autospec=True, side_effect=connect), \
+                mock.patch.object(mail_tasks, 'smtp_pool', pool):
+            mail_tasks.sendmail_bulk([
+                dict(mail, destinations=[str(admin._id)]),
+                dict(mail, destinations=[str(user1._id), str(admin._id)]),
+                dict(mail, destinations=['blah@blah.com'], subject='Other subject'),
+            ])
+        # the first two are the same message, so they're sent together
+        assert_equal(smtp.sendmail.call_count, 2)
+        sent = {}
+        for (return_path, rcpts, body) in [ca[0] for ca in smtp.sendmail.call_args_list]:
+            subject = [line for line in body.split('\n') if line.startswith('Subject: ')][0]
+            sent[subject] = sorted(rcpts)
+        assert_equal(sent, {
+            'Subject: Test subject': sorted([admin.get_pref('email_address'), 'user1@mail.com']),
+            'Subject: Other subject': ['blah@blah.com'],
+        })
+        assert_equal(pool.stats['messages'], 2)
+        assert_equal(pool.stats['recipients'], 3)
+        assert_equal(pool.stats['errors'], 0)
+
+    def test_smtp_pool_errors(self):
+        pool = mail_util.SMTPClientPool(size=2)
+        with mock.patch.object(mail_util.SMTPClient, '_connect', autospec=True) as connect:
+            connect.side_effect = IOError('no server')
+            failed = pool.send_all([(['a@example.com'], 'msg1'),
+                                    (['b@example.com'], 'msg2'),
+                                    (['c@example.com'], 'msg3')])
+        assert_equal(sorted(msg for addrs, msg in failed), ['msg1', 'msg2', 'msg3'])
+        assert_equal(pool.stats['errors'], 3)
+        assert_equal(pool.stats['messages'], 0)
+
+    def test_sendmail_bulk_retries_failed(self):
+        admin = M.User.by_username('test-admin')
+        mail = dict(fromaddr=str(admin._id), text='This is a test', reply_to=g.noreply,
+                    subject='Test subject', message_id=h.gen_message_id())
+        pool = mail_util.SMTPClientPool(size=1)
+        with mock.patch.object(mail_util.SMTPClient, '_connect', autospec=True) as connect, \
+                mock.patch.object(mail_tasks, 'smtp_pool', pool):
+            connect.side_effect = IOError('no server')
+            mail_tasks.sendmail_bulk([dict(mail, destinations=['blah@blah.com'])])
+            # only the failed email is queued again, for later
+            retry = M.MonQTask.query.get(task_name='allura.tasks.mail_tasks.send_prepared')
+            assert_equal([addrs for addrs, content in retry.args[0]], [['blah@blah.com']])
+            assert retry.time_queue > datetime.utcnow()
+            # and stays in the error state if it fails again
+            with assert_raises(MailError):
+                mail_tasks.send_prepared(*retry.args)
+
+    @mock.patch('allura.tasks.mail_tasks.sendmail_bulk')
+    @mock.patch('allura.tasks.mail_tasks.sendmail')
+    def test_post_sendmail(self, sendmail, sendmail_bulk):
+        mail_tasks.post_sendmail(destinations=['blah@blah.com'], text='hi')
+        sendmail.post.assert_called_once_with(destinations=['blah@blah.com'], text='hi')
+        assert_equal(sendmail_bulk.post.call_count, 0)
+        with h.push_config(tg.config, **{'forgemail.bulk': 'true'}):
+            mail_tasks.post_sendmail(destinations=['blah@blah.com'], text='hi')
+        sendmail_bulk.post.assert_called_once_with([dict(destinations=['blah@blah.com'], text='hi')])
+
+    def test_sendmail_bulk_batches_queued_mail(self):
+        mail_tasks.sendmail_bulk.post([dict(destinations=['a@example.com'], text='a')])
+        mail_tasks.sendmail_bulk.post([dict(destinations=['b@example.com'], text='b')])
+        tasks = M.MonQTask.query.find(dict(task_name='allura.tasks.mail_tasks.sendmail_bulk')).all()
+        assert_equal(len(tasks), 1)
+        assert_equal(tasks[0].args, [[dict(destinations=['a@example.com'], text='a'),
+                                      dict(destinations=['b@example.com'], text='b')]])
+
+    @mock.patch.object(mail_tasks, 'BULK_MAX_MESSAGES', 2)
+    def test_sendmail_batch_limits(self):
+        with mock.patch.object(mail_tasks, 'sendmail_bulk') as sendmail_bulk:
+            with mail_tasks.sendmail_batch():
+                for i in range(5):
+                    mail_tasks.post_sendmail(destinations=['%s@example.com' % i], text='hi')
+        assert_equal([len(args[0]) for args, kw in sendmail_bulk.post.call_args_list], [2, 2, 1])
+
+        msg = dict(destinations=['a@example.com'], text='x' * 1000)
+        with mock.patch.object(mail_tasks, 'BULK_MAX_BYTES', 1500):
+            assert_equal(list(mail_tasks._bulk_chunks([msg, msg, msg])), [[msg], [msg], [msg]])
+
     @td.with_wiki
     def test_receive_email_ok(self):
         c.user = M.User.by_username('test-admin')
@@ -664,6 +785,35 @@ def test_bulk_export(self, zipdir, shutil):
         assert_in('The following tools were exported:\n- wiki', text)
         assert_in('Sample instructions for test', text)
 
+    @mock.patch.dict(tg.config, {'bulk_export_filename': '{project}.zip', 'bulk_export_streaming': 'true'})
+    @td.with_wiki
+    def test_bulk_export_streaming(self):
+        M.MonQTask.query.remove()
+        task = export_tasks.bulk_export.post(['wiki', 'admin'], send_email=False)
+        M.MonQTask.run_ready()
+        zipfn = '/tmp/bulk_export/p/test/test.zip'
+        with zipfile.ZipFile(zipfn) as zf:
+            assert_equal(sorted(zf.namelist()), ['test/admin.json', 'test/wiki.json'])
+            wiki = json.loads(zf.read('test/wiki.json').decode('utf-8'))
+        assert_equal([p['title'] for p in wiki['pages']], ['Home'])
+        assert not os.path.exists(zipfn + '.partial')
+        task = M.MonQTask.query.get(_id=task._id)
+        assert_equal(task.progress['tools_done'], 2)
+        assert_equal(task.progress['tools_failed'], 0)
+
+    def test_export_archive(self):
+        path = tempfile.mktemp(suffix='.zip')
+        try:
+            with export_tasks.ExportArchive(path, 'prefix') as archive:
+                archive.write_stream('a/file.txt', six.BytesIO(b'data'), chunk_size=3)
+                archive.write_stream('a/file.txt', six.BytesIO(b'other data'))
+            assert_equal(archive.bytes_written, 4)
+            with zipfile.ZipFile(path) as zf:
+                assert_equal(zf.namelist(), ['prefix/a/file.txt'])
+                assert_equal(zf.read('prefix/a/file.txt'), b'data')
+        finally:
+            os.remove(path)
+
     def test_bulk_export_status(self):
         assert_equal(c.project.bulk_export_status(), None)
         export_tasks.bulk_export.post(['wiki'])
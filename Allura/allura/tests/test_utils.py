@@ -114,6 +114,20 @@ def test_chunked_list(self):
         self.assertEqual([el for sublist in chunks for el in sublist], l)
 
 
+class TestCursor(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [dt.datetime(2020, 5, 6, 7, 8, 9, 123456), 'abc/d\u00e9f', 5]
+        cursor = utils.encode_cursor(values)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(utils.decode_cursor(cursor),
+                         [dt.datetime(2020, 5, 6, 7, 8, 9, 123000), 'abc/d\u00e9f', 5])
+
+    def test_invalid(self):
+        for cursor in ['', 'bogus', 'e30', utils.encode_cursor([])[:-1] + '!']:
+            self.assertRaises(ValueError, utils.decode_cursor, cursor)
+
+
 class TestAntispam(unittest.TestCase):
 
     def setUp(self):
@@ -22,7 +22,7 @@
 import hashlib
 import datetime as dt
 
-from mock import Mock, MagicMock, patch, call
+from mock import Mock, MagicMock, patch
 from alluratest.tools import (
     assert_raises,
     assert_equal,
@@ -41,6 +41,7 @@
     WebhookValidator,
     WebhookController,
     send_webhook,
+    send_webhooks,
     RepoPushWebhookSender,
     SendWebhookHelper,
 )
@@ -462,18 +463,40 @@ def test_log_msg(self):
     @patch('allura.webhooks.SendWebhookHelper', autospec=True)
     def test_send_webhook_task(self, swh):
         send_webhook(self.wh._id, self.payload)
-        swh.assert_called_once_with(self.wh, self.payload)
+        swh.assert_called_once_with(self.wh, self.payload, 0)
+        swh.return_value.send.assert_called_once_with()
 
-    @patch('allura.webhooks.requests', autospec=True)
+        swh.reset_mock()
+        send_webhook(self.wh._id, self.payload, attempt=2)
+        swh.assert_called_once_with(self.wh, self.payload, 2)
+
+    @patch('allura.webhooks.SendWebhookHelper', autospec=True)
+    def test_send_webhook_task_deleted_webhook(self, swh):
+        self.wh.delete()
+        session(self.wh).flush(self.wh)
+        send_webhook(self.wh._id, self.payload, attempt=1)
+        assert_equal(swh.call_count, 0)
+
+    @patch('allura.webhooks.SendWebhookHelper.send_all', autospec=True)
+    def test_send_webhooks_task(self, send_all):
+        send_webhooks([self.wh._id], [1, 2])
+        helpers = send_all.call_args[0][0]
+        assert_equal([(hlp.webhook, hlp.payload, hlp.attempt) for hlp in helpers],
+                     [(self.wh, 1, 0), (self.wh, 2, 0)])
+
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.WebhookSessions', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send(self, log, requests):
-        requests.post.return_value = Mock(status_code=200)
+    def test_send(self, log, sessions, send_webhook):
+        http = sessions.get.return_value
+        http.post.return_value = Mock(status_code=200)
         self.h.sign = Mock(return_value='sha1=abc')
         self.h.send()
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': 'sha1=abc'}
-        requests.post.assert_called_once_with(
+        sessions.get.assert_called_once_with(self.wh.hook_url)
+        http.post.assert_called_once_with(
             self.wh.hook_url,
             data=json.dumps(self.payload),
             headers=headers,
@@ -481,93 +504,125 @@ def test_send(self, log, requests):
         log.info.assert_called_once_with(
             'Webhook successfully sent: %s %s %s' % (
                 self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
+        assert_equal(send_webhook.post.call_count, 0)
+        assert_equal(self.wh.delivered, 1)
+        assert_equal(self.wh.failed, 0)
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.WebhookSessions', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_response_status(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_response_status(self, log, sessions, send_webhook):
+        http = sessions.get.return_value
+        http.post.return_value = Mock(status_code=500)
         self.h.send()
-        assert_equal(requests.post.call_count, 4)  # initial call + 3 retries
-        assert_equal(time.sleep.call_args_list,
-                     [call(60), call(120), call(240)])
-        assert_equal(log.info.call_args_list, [
-            call('Retrying webhook in: %s', [60, 120, 240]),
-            call('Retrying webhook in %s seconds', 60),
-            call('Retrying webhook in %s seconds', 120),
-            call('Retrying webhook in %s seconds', 240)])
-        assert_equal(log.error.call_count, 4)
-        log.error.assert_called_with(
+        # no waiting around: the retry is queued as a delayed task
+        assert_equal(http.post.call_count, 1)
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, attempt=1, delay=60)
+        log.info.assert_called_once_with('Retrying webhook in %s seconds', 60)
+        log.error.assert_called_once_with(
             'Webhook send error: %s %s %s %s %s %s' % (
                 self.wh.type, self.wh.hook_url,
                 self.wh.app_config.url(),
-                requests.post.return_value.status_code,
-                requests.post.return_value.text,
-                requests.post.return_value.headers))
+                http.post.return_value.status_code,
+                http.post.return_value.text,
+                http.post.return_value.headers))
+        assert_equal(self.wh.failed, 1)
+        assert_equal(self.wh.consecutive_failures, 1)
+
+        # the following attempts use the next delay, until there are none left
+        send_webhook.post.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=2).send()
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, attempt=3, delay=240)
+        send_webhook.post.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=3).send()
+        assert_equal(send_webhook.post.call_count, 0)
+        log.warning.assert_called_once_with(
+            'Webhook failed after 3 retries: %s %s %s' % (
+                self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.WebhookSessions', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_no_retries(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_no_retries(self, log, sessions, send_webhook):
+        http = sessions.get.return_value
+        http.post.return_value = Mock(status_code=500)
         with h.push_config(config, **{'webhook.retry': ''}):
             self.h.send()
-            assert_equal(requests.post.call_count, 1)
-            assert_equal(time.call_count, 0)
-            log.info.assert_called_once_with('Retrying webhook in: %s', [])
+            assert_equal(http.post.call_count, 1)
+            assert_equal(send_webhook.post.call_count, 0)
             assert_equal(log.error.call_count, 1)
-            log.error.assert_called_with(
-                'Webhook send error: %s %s %s %s %s %s' % (
-                    self.wh.type, self.wh.hook_url,
-                    self.wh.app_config.url(),
-                    requests.post.return_value.status_code,
-                    requests.post.return_value.text,
-                    requests.post.return_value.headers))
 
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.WebhookSessions', autospec=True)
+    def test_send_circuit_open(self, sessions, send_webhook):
+        self.wh.circuit_open_until = dt.datetime.utcnow() + dt.timedelta(seconds=500)
+        self.h.send()
+        assert_equal(sessions.get.call_count, 0)
+        assert_equal(self.wh.failed, 0)
+        # retried once the circuit can close again
+        args, kw = send_webhook.post.call_args
+        assert_equal(args, (self.wh._id, self.payload))
+        assert_equal(kw['attempt'], 1)
+        assert 490 < kw['delay'] <= 500, kw['delay']
 
-class TestRepoPushWebhookSender(TestWebhookBase):
     @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send(self, send_webhook):
+    @patch('allura.webhooks.WebhookSessions', autospec=True)
+    def test_send_all(self, sessions, send_webhook):
+        http = sessions.get.return_value
+        http.post.side_effect = [Mock(status_code=200), Mock(status_code=500), Mock(status_code=200)]
+        helpers = [SendWebhookHelper(self.wh, {'n': n}) for n in range(3)]
+        with h.push_config(config, **{'webhook.workers': 2}):
+            SendWebhookHelper.send_all(helpers)
+        assert_equal(http.post.call_count, 3)
+        assert_equal(self.wh.delivered, 2)
+        assert_equal(self.wh.failed, 1)
+        assert_equal(send_webhook.post.call_count, 1)
+        assert_equal(send_webhook.post.call_args[1]['attempt'], 1)
+
+
+class TestRepoPushWebhookSender(TestWebhookBase):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send(self, send_webhooks):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock()
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        send_webhook.post.assert_called_once_with(
-            self.wh._id,
-            sender.get_payload.return_value)
+        send_webhooks.post.assert_called_once_with(
+            [self.wh._id],
+            [sender.get_payload.return_value])
 
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_with_list(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_with_list(self, send_webhooks):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock(side_effect=[1, 2])
         self.wh.enforce_limit = Mock(return_value=True)
         with h.push_config(c, app=self.git):
             sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
-        assert_equal(send_webhook.post.call_count, 2)
-        assert_equal(send_webhook.post.call_args_list,
-                     [call(self.wh._id, 1), call(self.wh._id, 2)])
+        send_webhooks.post.assert_called_once_with([self.wh._id], [1, 2])
         assert_equal(self.wh.enforce_limit.call_count, 1)
 
     @patch('allura.webhooks.log', autospec=True)
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_limit_reached(self, send_webhook, log):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_limit_reached(self, send_webhooks, log):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock()
         self.wh.enforce_limit = Mock(return_value=False)
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert_equal(send_webhook.post.call_count, 0)
+        assert_equal(send_webhooks.post.call_count, 0)
         log.warn.assert_called_once_with(
             'Webhook fires too often: %s. Skipping', self.wh)
 
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_no_configured_webhooks(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_no_configured_webhooks(self, send_webhooks):
         self.wh.delete()
         session(self.wh).flush(self.wh)
         sender = RepoPushWebhookSender()
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert_equal(send_webhook.post.call_count, 0)
+        assert_equal(send_webhooks.post.call_count, 0)
 
     def test_get_payload(self):
         sender = RepoPushWebhookSender()
@@ -660,6 +715,49 @@ def test_update_limit(self, dt_mock):
         session(self.wh).expunge(self.wh)
         assert_equal(M.Webhook.query.get(_id=self.wh._id).last_sent, _now)
 
+    def test_record_delivery(self):
+        self.wh.record_delivery(True, 0.5)
+        self.wh.record_delivery(False, 1.5)
+        assert_equal(self.wh.delivery_stats(), {
+            'delivered': 1,
+            'failed': 1,
+            'avg_time': 1.0,
+            'last_time': 1.5,
+            'consecutive_failures': 1,
+            'circuit_open': False,
+        })
+
+    def test_record_delivery_circuit_breaker(self):
+        with h.push_config(config, **{'webhook.circuit_breaker.failures': 3}):
+            for i in range(2):
+                self.wh.record_delivery(False, 1)
+            assert_equal(self.wh.circuit_open(), False)
+            self.wh.record_delivery(False, 1)
+            assert_equal(self.wh.circuit_open(), True)
+            session(self.wh).expunge(self.wh)
+            wh = M.Webhook.query.get(_id=self.wh._id)
+            assert_equal(wh.circuit_open(), True)
+            wh.record_delivery(True, 1)
+            assert_equal(wh.circuit_open(), False)
+            assert_equal(wh.consecutive_failures, 0)
+
+    def test_record_delivery_circuit_breaker_concurrent(self):
+        find_and_modify = M.Webhook.query.find_and_modify
+
+        def other_worker_fails(*args, **kw):
+            result = find_and_modify(*args, **kw)
+            M.Webhook.query.update({'_id': self.wh._id}, {'$inc': {'failed': 1, 'consecutive_failures': 1}})
+            return result
+        with h.push_config(config, **{'webhook.circuit_breaker.failures': 1}), \
+                patch.object(M.Webhook.query, 'find_and_modify', side_effect=other_worker_fails):
+            self.wh.record_delivery(False, 1)
+        session(self.wh).expunge(self.wh)
+        wh = M.Webhook.query.get(_id=self.wh._id)
+        assert_equal(wh.circuit_open(), True)
+        # neither of the other worker's failures was overwritten
+        assert_equal(wh.failed, 3)
+        assert_equal(wh.consecutive_failures, 3)
+
     def test_json(self):
         expected = {
             '_id': six.text_type(self.wh._id),
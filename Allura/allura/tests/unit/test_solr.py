@@ -17,6 +17,7 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import time
 import unittest
 
 import mock
@@ -26,7 +27,7 @@
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
+from allura.lib.solr import Solr, SolrError, SolrPushError, escape_solr_arg
 from allura.lib.search import search_app, SearchIndexable
 
 
@@ -83,6 +84,52 @@ def test_commit(self, pysolr):
         calls = [mock.call('arg', kw='kw')] * 2
         pysolr.Solr().commit.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_push_errors(self, pysolr):
+        server1, server2 = mock.Mock(url='server1'), mock.Mock(url='server2')
+        pysolr.Solr.side_effect = [server1, server2]
+        solr = Solr(['server1', 'server2'], commit=False)
+        server1.add.side_effect = ValueError('boom')
+        with self.assertRaises(ValueError):
+            solr.add('foo')
+        # other servers are still updated
+        server2.add.assert_called_once_with('foo', commit=False)
+        assert_equal(solr.push_stats['server1']['errors'], 1)
+        assert_equal(solr.push_stats['server2']['errors'], 0)
+        assert_equal(solr.push_stats['server2']['calls'], 1)
+
+        server2.add.side_effect = ValueError('bang')
+        with self.assertRaises(SolrPushError) as cm:
+            solr.add('foo')
+        assert_equal(sorted(cm.exception.errors), ['server1', 'server2'])
+
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_push_timeout(self, pysolr):
+        server1, server2 = mock.Mock(url='server1'), mock.Mock(url='server2')
+        pysolr.Solr.side_effect = [server1, server2]
+        solr = Solr(['server1', 'server2'], push_timeout=0.05)
+        server1.commit.side_effect = lambda: time.sleep(0.5)
+        server2.commit.return_value = 'ok'
+        with self.assertRaises(SolrError):
+            solr.commit()
+        assert_equal(solr.push_stats['server1']['timeouts'], 1)
+        assert_equal(solr.push_stats['server2']['timeouts'], 0)
+
+        # the hung server is skipped until its call finishes, without holding
+        # up the healthy one
+        start = time.time()
+        with self.assertRaises(SolrError):
+            solr.commit()
+        assert time.time() - start < 0.4
+        assert_equal(server1.commit.call_count, 1)
+        assert_equal(server2.commit.call_count, 2)
+        assert_equal(solr.push_stats['server1']['timeouts'], 2)
+        time.sleep(0.5)
+        server1.commit.side_effect = None
+        server1.commit.return_value = 'ok'
+        assert_equal(solr.commit(), ['ok', 'ok'])
+        assert_equal(solr.push_stats['server1']['calls'], 3)
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_search(self, pysolr):
         servers = ['server1', 'server2']
@@ -20,12 +20,17 @@
 import logging
 import json
 import hmac
+import math
+import datetime as dt
 import hashlib
 import time
 import socket
 import ssl
+import threading
+from concurrent import futures
 
 import requests
+from six.moves.urllib.parse import urlparse
 from bson import ObjectId
 from tg import expose, validate, redirect, flash, config
 from tg.decorators import with_trailing_slash, without_trailing_slash
@@ -330,10 +335,44 @@ def _delete(self, webhook):
         return {'result': 'ok'}
 
 
+class WebhookSessions(object):
+    """Keep-alive HTTP sessions used to deliver webhooks, one per host, shared
+    by all deliveries in this process."""
+
+    _sessions = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, url):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        with cls._lock:
+            s = cls._sessions.get(key)
+            if s is None:
+                s = requests.Session()
+                pool_size = asint(config.get('webhook.pool_size', 10))
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                s.mount('{}://'.format(parsed.scheme), adapter)
+                cls._sessions[key] = s
+            return s
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            for s in cls._sessions.values():
+                s.close()
+            cls._sessions.clear()
+
+
 class SendWebhookHelper(object):
-    def __init__(self, webhook, payload):
+    def __init__(self, webhook, payload, attempt=0):
         self.webhook = webhook
         self.payload = payload
+        self.attempt = attempt
+        self.elapsed = 0.0
+        # resolved up front, so deliver() doesn't need the db and can run in
+        # another thread
+        self.app_url = webhook.app_config.url()
 
     @property
     def timeout(self):
@@ -356,7 +395,7 @@ def log_msg(self, msg, response=None):
             msg,
             self.webhook.type,
             self.webhook.hook_url,
-            self.webhook.app_config.url())
+            self.app_url)
         if response is not None:
             message = '{} {} {} {}'.format(
                 message,
@@ -366,24 +405,68 @@ def log_msg(self, msg, response=None):
         return message
 
     def send(self):
+        """Send the payload, or schedule a retry if that fails"""
+        if self.webhook.circuit_open():
+            self.skip()
+        else:
+            self.finish(self.deliver())
+
+    @classmethod
+    def send_all(cls, helpers):
+        """Send several payloads at once, using up to `webhook.workers`
+        threads.  Only the HTTP requests run in the threads."""
+        to_deliver = []
+        for helper in helpers:
+            if helper.webhook.circuit_open():
+                helper.skip()
+            else:
+                to_deliver.append(helper)
+        workers = min(asint(config.get('webhook.workers', 4)), len(to_deliver))
+        if workers <= 1:
+            results = [helper.deliver() for helper in to_deliver]
+        else:
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(lambda helper: helper.deliver(), to_deliver))
+        for helper, ok in zip(to_deliver, results):
+            helper.finish(ok)
+
+    def deliver(self):
+        """Make one delivery attempt.  Returns True if it succeeded."""
         json_payload = json.dumps(self.payload, cls=DateJSONEncoder)
         signature = self.sign(json_payload)
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': signature}
-        ok = self._send(self.webhook.hook_url, json_payload, headers)
+        start = time.time()
+        try:
+            return self._send(self.webhook.hook_url, json_payload, headers)
+        finally:
+            self.elapsed = time.time() - start
+
+    def finish(self, ok):
+        """Record the outcome of :meth:`deliver`, and schedule a retry if it failed"""
+        self.webhook.record_delivery(ok, self.elapsed)
         if not ok:
-            log.info('Retrying webhook in: %s', self.retries)
-            for t in self.retries:
-                log.info('Retrying webhook in %s seconds', t)
-                time.sleep(t)
-                ok = self._send(self.webhook.hook_url, json_payload, headers)
-                if ok:
-                    return
+            self.retry_later()
+
+    def skip(self):
+        log.warning(self.log_msg('Webhook circuit open, not sending'))
+        now = dt.datetime.utcnow()
+        self.retry_later(min_delay=(self.webhook.circuit_open_until - now).total_seconds())
+
+    def retry_later(self, min_delay=0):
+        """Post a delayed task for the next attempt, if there are retries left"""
+        retries = self.retries
+        if self.attempt >= len(retries):
+            log.warning(self.log_msg('Webhook failed after {} retries'.format(len(retries))))
+            return
+        delay = max(retries[self.attempt], int(math.ceil(min_delay)))
+        log.info('Retrying webhook in %s seconds', delay)
+        send_webhook.post(self.webhook._id, self.payload, attempt=self.attempt + 1, delay=delay)
 
     def _send(self, url, data, headers):
         try:
-            r = requests.post(
+            r = WebhookSessions.get(url).post(
                 url,
                 data=data,
                 headers=headers,
@@ -402,9 +485,21 @@ def _send(self, url, data, headers):
 
 
 @task()
-def send_webhook(webhook_id, payload):
+def send_webhook(webhook_id, payload, attempt=0):
     webhook = M.Webhook.query.get(_id=webhook_id)
-    SendWebhookHelper(webhook, payload).send()
+    if webhook is None:
+        log.info('Webhook %s was deleted, not sending', webhook_id)
+        return
+    SendWebhookHelper(webhook, payload, attempt).send()
+
+
+@task()
+def send_webhooks(webhook_ids, payloads):
+    """Send each payload to each of the webhooks"""
+    webhooks = M.Webhook.query.find({'_id': {'$in': webhook_ids}}).all()
+    SendWebhookHelper.send_all([SendWebhookHelper(webhook, payload)
+                                for webhook in webhooks
+                                for payload in payloads])
 
 
 class WebhookSender(object):
@@ -424,7 +519,7 @@ def get_payload(self, **kw):
         raise NotImplementedError('get_payload')
 
     def send(self, params_or_list):
-        """Post a task that will send webhook payload
+        """Post a task that will send webhook payload to all the webhooks
 
         :param params_or_list: dict with keyword parameters to be passed to
             :meth:`get_payload` or a list of such dicts. If it's a list for each
@@ -440,13 +535,15 @@ def send(self, params_or_list):
         if webhooks:
             payloads = [self.get_payload(**params)
                         for params in params_or_list]
+            webhook_ids = []
             for webhook in webhooks:
                 if webhook.enforce_limit():
                     webhook.update_limit()
-                    for payload in payloads:
-                        send_webhook.post(webhook._id, payload)
+                    webhook_ids.append(webhook._id)
                 else:
                     log.warn('Webhook fires too often: %s. Skipping', webhook)
+            if webhook_ids:
+                send_webhooks.post(webhook_ids, payloads)
 
     def enforce_limit(self, app):
         '''
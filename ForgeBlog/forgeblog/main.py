@@ -42,7 +42,7 @@
 from allura.app import DefaultAdminController
 from allura.lib import helpers as h
 from allura.lib import validators as v
-from allura.lib.utils import JSONForExport
+from allura.lib.utils import JSONForExport, chunked_find
 from allura.tasks import notification_tasks
 from allura.lib.search import search_app
 from allura.lib.decorators import require_post, memorable_forget
@@ -222,16 +222,20 @@ def uninstall(self, project):
 
     def bulk_export(self, f, export_path='', with_attachments=False):
         f.write('{"posts": [')
-        posts = list(BM.BlogPost.query.find(dict(app_config_id=self.config._id)))
         if with_attachments:
             JSONEncoder = JSONForExport
-            self.export_attachments(posts, export_path)
         else:
             JSONEncoder = jsonify.JSONEncoder
-        for i, post in enumerate(posts):
-            if i > 0:
-                f.write(',')
-            json.dump(post, f, cls=JSONEncoder, indent=2)
+        first = True
+        for posts in chunked_find(BM.BlogPost, dict(app_config_id=self.config._id)):
+            if with_attachments:
+                self.export_attachments(posts, export_path)
+            for post in posts:
+                if not first:
+                    f.write(',')
+                first = False
+                json.dump(post, f, cls=JSONEncoder, indent=2)
+                session(post).expunge(post)
         f.write(']}')
 
     def export_attachments(self, articles, export_path):
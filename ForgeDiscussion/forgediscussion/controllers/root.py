@@ -405,10 +405,13 @@ def _check_security(self):
         require_access(self.forum, 'read')
 
     @expose('json:')
-    def index(self, limit=None, page=0, **kw):
+    def index(self, limit=None, page=0, cursor=None, **kw):
         limit, page, start = g.handle_paging(limit, int(page))
         json_data = {}
-        json_data['topic'] = self.topic.__json__(limit=limit, page=page)
+        try:
+            json_data['topic'] = self.topic.__json__(limit=limit, page=page, cursor=cursor)
+        except ValueError:
+            raise exc.HTTPBadRequest('Invalid cursor')
         json_data['count'] = self.topic.query_posts(status='ok').count()
         json_data['page'] = page
         json_data['limit'] = limit
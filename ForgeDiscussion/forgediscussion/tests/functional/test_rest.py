@@ -196,6 +196,16 @@ def test_topic_pagination(self):
         assert_equal(resp.json['count'], 2)
         assert_equal(resp.json['page'], 1)
         assert_equal(resp.json['limit'], 1)
+        # same page with the cursor from the first one
+        cursor = self.app.get(url + '?limit=1').json['topic']['next_cursor']
+        resp = self.app.get(url + '?limit=1&cursor=' + cursor)
+        posts = resp.json['topic']['posts']
+        assert_equal(len(posts), 1)
+        assert_equal(posts[0]['text'], 'I am second post')
+        resp = self.app.get(url + '?limit=1&cursor=' + resp.json['topic']['next_cursor'])
+        assert_equal(resp.json['topic']['posts'], [])
+        assert 'next_cursor' not in resp.json['topic']
+        self.app.get(url + '?limit=1&cursor=bogus', status=400)
 
     def test_topic_show_ok_only(self):
         thread = ForumThread.query.find({'subject': 'Hi guys'}).first()
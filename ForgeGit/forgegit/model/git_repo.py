@@ -18,20 +18,23 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import os
+import select
 import shutil
 import string
 import logging
 import tempfile
 from datetime import datetime
 from contextlib import contextmanager
+from collections import OrderedDict
 from time import time
 
 import tg
 import git
 import gitdb
 from tg import tmpl_context as c
+from pymongo import UpdateOne
 from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 import six
 
 from ming.base import Object
@@ -39,6 +42,7 @@
 from ming.utils import LazyProperty
 
 from allura.lib import helpers as h
+from allura.lib import utils
 from allura.model.repository import topological_sort, prefix_paths_union
 from allura import model as M
 from io import open
@@ -259,6 +263,8 @@ def all_commit_ids(self):
 
     def new_commits(self, all_commits=False):
         graph = {}
+        # commits in the commit graph are known without a query
+        commit_graph = self._repo.commit_graph if not all_commits else None
 
         to_visit = [self._git.commit(rev=hd.object_id) for hd in self.heads]
         while to_visit:
@@ -267,7 +273,8 @@ def new_commits(self, all_commits=False):
                 continue
             if not all_commits:
                 # Look up the object
-                if M.repository.Commit.query.find(dict(_id=obj.hexsha)).count():
+                if (commit_graph is not None and obj.hexsha in commit_graph) or \
+                        M.repository.Commit.query.find(dict(_id=obj.hexsha)).count():
                     graph[obj.hexsha] = set()  # mark as parentless
                     continue
             graph[obj.hexsha] = set(p.hexsha for p in obj.parents)
@@ -280,19 +287,7 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         if ci_doc and lazy:
             return False
         ci = self._git.rev_parse(oid)
-        args = dict(
-            tree_id=ci.tree.hexsha,
-            committed=Object(
-                name=h.really_unicode(ci.committer.name),
-                email=h.really_unicode(ci.committer.email),
-                date=datetime.utcfromtimestamp(ci.committed_date)),
-            authored=Object(
-                name=h.really_unicode(ci.author.name),
-                email=h.really_unicode(ci.author.email),
-                date=datetime.utcfromtimestamp(ci.authored_date)),
-            message=h.really_unicode(ci.message or ''),
-            child_ids=[],
-            parent_ids=[p.hexsha for p in ci.parents])
+        args = self._commit_doc_args(ci)
         if ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
@@ -306,11 +301,119 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
-    def refresh_tree_info(self, tree, seen, lazy=True):
+    def refresh_commits_info(self, oids, seen, lazy=True):
+        """Bulk version of :meth:`refresh_commit_info`, if `scm.refresh.bulk`
+        is enabled.
+
+        Commits are read from git in batches, ids already in mongo are found
+        with one query per batch (and per tree depth), and new docs are
+        written with unordered bulk writes: trees (deepest first) and then
+        their commits, so a tree or commit in mongo always has everything it
+        refers to, even if a refresh dies halfway.  Each tree is only written
+        once per refresh, even if `lazy` is False.
+        """
+        if not asbool(tg.config.get('scm.refresh.bulk', False)):
+            return super(GitImplementation, self).refresh_commits_info(oids, seen, lazy)
+        from allura.model.repository import CommitDoc, TreeDoc
+        batch_size = asint(tg.config.get('scm.refresh.bulk.batch_size', 1000))
+        start = time()
+        num_commits = num_trees = 0
+        for chunk in utils.chunked_iter(oids, batch_size):
+            chunk = list(chunk)
+            if lazy:
+                known = self._known_ids(CommitDoc, chunk)
+                chunk = [oid for oid in chunk if oid not in known]
+            commits = [self._git.rev_parse(oid) for oid in chunk]
+            tree_docs = self._new_tree_docs([ci.tree for ci in commits], seen, lazy)
+            self._bulk_save(TreeDoc, tree_docs, lazy)
+            # repo_ids and child_ids are maintained by other repos' refreshes
+            self._bulk_save(CommitDoc, [CommitDoc(dict(self._commit_doc_args(ci), _id=ci.hexsha))
+                                        for ci in commits], lazy, keep=('repo_ids', 'child_ids'))
+            num_commits += len(commits)
+            num_trees += len(tree_docs)
+            elapsed = time() - start
+            log.info('Refresh commit info: %d commits, %d trees in %.1fs (%.1f commits/s) on %s',
+                     num_commits, num_trees, elapsed, num_commits / elapsed if elapsed else 0,
+                     self._repo.full_fs_path)
+        return num_commits
+
+    def _commit_doc_args(self, ci):
+        return dict(
+            tree_id=ci.tree.hexsha,
+            committed=Object(
+                name=h.really_unicode(ci.committer.name),
+                email=h.really_unicode(ci.committer.email),
+                date=datetime.utcfromtimestamp(ci.committed_date)),
+            authored=Object(
+                name=h.really_unicode(ci.author.name),
+                email=h.really_unicode(ci.author.email),
+                date=datetime.utcfromtimestamp(ci.authored_date)),
+            message=h.really_unicode(ci.message or ''),
+            child_ids=[],
+            parent_ids=[p.hexsha for p in ci.parents])
+
+    def _new_tree_docs(self, trees, seen, lazy):
+        """Return TreeDocs for the given trees and all their subtrees, deepest
+        first, skipping trees in `seen` and (if lazy) trees already in mongo.
+        """
         from allura.model.repository import TreeDoc
+        levels = []
+        while trees:
+            level = OrderedDict()
+            for tree in trees:
+                if tree.binsha not in seen:
+                    level[tree.binsha] = tree
+            if lazy and level:
+                # a tree in mongo means its subtrees are too
+                known = self._known_ids(TreeDoc, [tree.hexsha for tree in level.values()])
+                for binsha, tree in list(level.items()):
+                    if tree.hexsha in known:
+                        seen.add(binsha)
+                        del level[binsha]
+            seen.update(level)
+            levels.append([self._tree_doc(tree) for tree in level.values()])
+            trees = [subtree for tree in level.values() for subtree in tree.trees]
+        return [doc for level in reversed(levels) for doc in level]
+
+    def _known_ids(self, doc_cls, ids):
+        known = set()
+        for chunk in utils.chunked_iter(ids, 1000):
+            q = doc_cls.m.collection.find({'_id': {'$in': list(chunk)}}, {'_id': 1})
+            known.update(doc['_id'] for doc in q)
+        return known
+
+    def _bulk_save(self, doc_cls, docs, lazy, keep=()):
+        """Upsert `docs`.  Existing docs are left alone if `lazy`, otherwise
+        overwritten, except for the fields in `keep` which are only set on
+        insert."""
+        if not docs:
+            return
+        requests = []
+        for doc in docs:
+            data = doc_cls.m.schema.validate(doc)
+            _id = data.pop('_id')
+            if lazy:
+                update = {'$setOnInsert': data}
+            else:
+                update = {'$set': {k: v for k, v in six.iteritems(data) if k not in keep}}
+                on_insert = {k: v for k, v in six.iteritems(data) if k in keep}
+                if on_insert:
+                    update['$setOnInsert'] = on_insert
+            requests.append(UpdateOne({'_id': _id}, update, upsert=True))
+        doc_cls.m.collection.bulk_write(requests, ordered=False)
+
+    def refresh_tree_info(self, tree, seen, lazy=True):
         if lazy and tree.binsha in seen:
             return
         seen.add(tree.binsha)
+        for o in tree.trees:
+            self.refresh_tree_info(o, seen, lazy)
+        doc = self._tree_doc(tree)
+        doc.m.save()
+        return doc
+
+    def _tree_doc(self, tree):
+        from allura.model.repository import TreeDoc
         doc = TreeDoc(dict(
             _id=tree.hexsha,
             tree_ids=[],
@@ -323,14 +426,12 @@ def refresh_tree_info(self, tree, seen, lazy=True):
                 name=h.really_unicode(o.name),
                 id=o.hexsha)
             if o.type == 'tree':
-                self.refresh_tree_info(o, seen, lazy)
                 doc.tree_ids.append(obj)
             elif o.type == 'blob':
                 doc.blob_ids.append(obj)
             else:
                 obj.type = o.type
                 doc.other_ids.append(obj)
-        doc.m.save()
         return doc
 
     def log(self, revs=None, path=None, exclude=None, id_only=True, limit=None, **kw):
@@ -622,6 +723,67 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def _last_commit_ids(self, commit, paths, deadline):
+        '''
+        Resolve all the paths with a single streamed `git log`, rather than
+        one `git log -1` per path chunk: walk history from `commit` and assign
+        each commit to the remaining paths it touched, stopping as soon as
+        every path has been found.
+        '''
+        result = {}
+        remaining = set(paths)
+        proc = None
+
+        def assign(commit_id, files):
+            # merge commits don't list any files (see _get_last_commit) so
+            # they never claim a path
+            changed = prefix_paths_union(remaining, files)
+            for path in changed:
+                result[path] = commit_id
+            remaining.difference_update(changed)
+
+        try:
+            proc = self._git.git.log(commit._id, '--', *paths,
+                                     format='%x01%H', name_only=True, z=True,
+                                     as_process=True)
+            fd = proc.stdout.fileno()
+            buf = b''
+            commit_id, files = None, set()
+            while remaining:
+                # wait for output no later than the deadline, since git can
+                # go a long time without any (e.g. for paths changed long ago)
+                timeout = deadline - time()
+                if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+                    log.error('last_commit_ids timeout for %s on %s',
+                              commit._id, ', '.join(remaining))
+                    break
+                data = os.read(fd, 64 * 1024)
+                if not data:
+                    tokens, buf = [buf], b''
+                else:
+                    tokens = (buf + data).split(b'\0')
+                    buf = tokens.pop()
+                for token in tokens:
+                    token = token.lstrip(b'\n')
+                    if token.startswith(b'\x01'):
+                        if commit_id:
+                            assign(commit_id, files)
+                        commit_id, files = token[1:41].decode('ascii'), set()
+                        token = token[41:].lstrip(b'\n')
+                    if token:
+                        files.add(h.really_unicode(token))
+                if not data:
+                    if commit_id:
+                        assign(commit_id, files)
+                    break
+        except Exception as e:
+            log.exception('Error in SCM log: %s', e)
+        finally:
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        return result
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
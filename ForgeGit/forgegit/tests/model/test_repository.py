@@ -23,6 +23,8 @@
 import os
 import shutil
 import stat
+import subprocess
+import time
 import unittest
 import pkg_resources
 import datetime
@@ -33,7 +35,7 @@
 import tg
 from ming.base import Object
 from ming.orm import ThreadLocalORMSession, session
-from alluratest.tools import assert_equal, assert_in, assert_less
+from alluratest.tools import assert_equal, assert_in, assert_less, assert_not_equal
 from testfixtures import TempDirectory
 from datadiff.tools import assert_equals
 
@@ -392,6 +394,33 @@ def test_refresh(self):
         assert commit2_loc != -1
         assert_less(commit1_loc, commit2_loc)
 
+    def test_refresh_commits_info_bulk(self):
+        commit_ids = list(self.repo.all_commit_ids())
+        commits = {ci._id: ci for ci in M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids}))}
+        trees = {t._id: t for t in M.repository.TreeDoc.m.find()}
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        with h.push_config(tg.config, **{'scm.refresh.bulk': 'true', 'scm.refresh.bulk.batch_size': '2'}):
+            assert_equal(self.repo.refresh_commits_info(commit_ids, set(), True), len(commit_ids))
+            for ci in M.repository.CommitDoc.m.find():
+                old = commits.pop(ci._id)
+                for field in ('tree_id', 'parent_ids', 'message', 'authored', 'committed'):
+                    assert_equal(ci[field], old[field])
+            assert_equal(commits, {})
+            assert_equal({t._id: t for t in M.repository.TreeDoc.m.find()}, trees)
+            # everything is known now
+            assert_equal(self.repo.refresh_commits_info(commit_ids, set(), True), 0)
+
+            # a non-lazy refresh rewrites commit info, but keeps links set by other refreshes
+            M.repository.CommitDoc.m.update_partial(
+                {'_id': commit_ids[0]},
+                {'$set': {'repo_ids': [self.repo._id], 'child_ids': ['child'], 'message': 'changed'}})
+            self.repo.refresh_commits_info(commit_ids, set(), False)
+            ci = M.repository.CommitDoc.m.get(_id=commit_ids[0])
+            assert_equal(ci.repo_ids, [self.repo._id])
+            assert_equal(ci.child_ids, ['child'])
+            assert_not_equal(ci.message, 'changed')
+
     def test_notification_email(self):
         send_notifications(
             self.repo, ['1e146e67985dcd71c74de79613719bef7bddca4a', ])
@@ -1016,6 +1045,19 @@ def test_last_commit_ids_threaded_error(self, _git):
                 mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt'])
             self.assertEqual(lcds, {})
 
+    @mock.patch('forgegit.model.git_repo.GitImplementation._git', new_callable=mock.PropertyMock)
+    def test_last_commit_ids_timeout_no_output(self, _git):
+        # git log that never writes anything mustn't block past the deadline
+        proc = subprocess.Popen(['sleep', '30'], stdout=subprocess.PIPE)
+        _git.return_value.git.log.return_value = proc
+        impl = GM.git_repo.GitImplementation(mock.Mock())
+        start = time.time()
+        with h.push_config(tg.config, lcd_timeout=0.5):
+            lcds = impl.last_commit_ids(mock.Mock(_id='deadbeef'), ['f2.txt'])
+        self.assertEqual(lcds, {})
+        assert_less(time.time() - start, 5)
+        assert proc.poll() is not None
+
 
 class TestGitCommit(unittest.TestCase):
 
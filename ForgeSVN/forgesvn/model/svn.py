@@ -27,6 +27,7 @@
 import operator as op
 from subprocess import Popen, PIPE
 from hashlib import sha1
+from concurrent import futures
 from io import BytesIO
 from datetime import datetime
 import tempfile
@@ -159,6 +160,9 @@ def __init__(self, repo):
 
     @LazyProperty
     def _svn(self):
+        return self._new_svn()
+
+    def _new_svn(self):
         return SVNLibWrapper(pysvn.Client())
 
     @LazyProperty
@@ -627,7 +631,7 @@ def _revision(self, oid):
     def _oid(self, revno):
         return '%s:%s' % (self._repo._id, revno)
 
-    def last_commit_ids(self, commit, paths):
+    def _last_commit_ids(self, commit, paths, deadline):
         '''
         Return a mapping {path: commit_id} of the _id of the last
         commit to touch each path, starting from the given commit.
@@ -639,6 +643,11 @@ def last_commit_ids(self, commit, paths):
         NB: This assumes that all paths are direct children of a
         single common parent path (i.e., you are only asking for
         a subset of the nodes of a single tree, one level deep).
+
+        The call runs in the shared :meth:`lcd_pool` so that it can be
+        abandoned once the deadline passes.  It uses its own client, since
+        pysvn clients aren't thread-safe and an abandoned call may still be
+        running.
         '''
         if len(paths) == 1:
             tree_path = '/' + os.path.dirname(paths[0].strip('/'))
@@ -647,11 +656,17 @@ def last_commit_ids(self, commit, paths):
             tree_path = '/' + os.path.commonprefix(paths).strip('/')
         paths = [path.strip('/') for path in paths]
         rev = self._revision(commit._id)
+        future = self.lcd_pool().submit(
+            self._new_svn().info2,
+            self._url + tree_path,
+            revision=rev,
+            depth=pysvn.depth.immediates)
         try:
-            infos = self._svn.info2(
-                self._url + tree_path,
-                revision=rev,
-                depth=pysvn.depth.immediates)
+            infos = future.result(timeout=max(deadline - time.time(), 0))
+        except futures.TimeoutError:
+            log.error('last_commit_ids timeout for %s on %s',
+                      commit._id, tree_path)
+            return {}
         except pysvn.ClientError:
             log.exception('Error computing tree for: %s: %s(%s)',
                           self._repo, commit, tree_path)
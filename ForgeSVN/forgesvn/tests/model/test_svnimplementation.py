@@ -17,11 +17,15 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import time
+
 from mock import Mock, patch
 from alluratest.tools import assert_equal
+import tg
 from tg import app_globals as g
 
 from alluratest.controller import setup_unit_test
+from allura.lib import helpers as h
 from allura.model.repository import Commit
 from forgesvn.model.svn import SVNImplementation
 
@@ -68,16 +72,32 @@ def _test_last_commit_ids(self, path):
         repo.name = 'code'
         repo._id = '5057636b9c1040636b81e4b1'
         impl = SVNImplementation(repo)
-        impl._svn.info2 = Mock()
-        impl._svn.info2.return_value = [('trunk', Mock()), ('foo', Mock())]
-        impl._svn.info2.return_value[1][1].last_changed_rev.number = '1'
+        impl._new_svn = Mock()
+        svn = impl._new_svn.return_value
+        svn.info2.return_value = [('trunk', Mock()), ('foo', Mock())]
+        svn.info2.return_value[1][1].last_changed_rev.number = '1'
         commit = Commit()
         commit._id = '5057636b9c1040636b81e4b1:6'
         entries = impl.last_commit_ids(commit, [path])
 
         assert_equal(entries, {path.strip('/'): '5057636b9c1040636b81e4b1:1'})
-        assert_equal(impl._svn.info2.call_args[0]
+        assert_equal(svn.info2.call_args[0]
                      [0], 'file://' + g.tmpdir + '/code/trunk')
+        # the lcd pool thread gets its own client, not the shared one
+        assert '_svn' not in impl.__dict__
+
+    def test_last_commit_ids_timeout(self):
+        repo = Mock(fs_path=g.tmpdir + '/')
+        repo.name = 'code'
+        repo._id = '5057636b9c1040636b81e4b1'
+        impl = SVNImplementation(repo)
+        impl._new_svn = Mock()
+        impl._new_svn.return_value.info2.side_effect = lambda *a, **kw: time.sleep(0.5)
+        commit = Commit()
+        commit._id = '5057636b9c1040636b81e4b1:6'
+        with h.push_config(tg.config, lcd_timeout=0):
+            entries = impl.last_commit_ids(commit, ['trunk/foo'])
+        assert_equal(entries, {})
 
     @patch('forgesvn.model.svn.svn_path_exists')
     def test__tarball_path_clean(self, path_exists):
@@ -23,6 +23,7 @@
 import six.moves.urllib.error
 import json
 import difflib
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import os
 
@@ -231,16 +232,86 @@ def milestone_count(self, name):
             'app_config_id': self.app_config_id,
             'deleted': False
         }
-        d['hits'] = Ticket.query.find(dict(mongo_query, acl=[])).count()
-        d['closed'] = Ticket.query.find(dict(mongo_query, acl=[],
-                                             status={'$in': list(self.set_of_closed_status_names)})).count()
-
-        secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
-        if secured_tickets.count():
-            tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
-            d['hits'] += len(tickets)
-            d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
-        return d
+        return self._count_milestones(mongo_query, [fld_name]).get(name, d)
+
+    def milestone_counts(self, user=None):
+        """Return {'field:milestone': dict(name=, hits=, closed=)} for all
+        the milestones with tickets (that `user` can read), computed together.
+        """
+        field_names = [fld.name for fld in self.milestone_fields]
+        if not field_names:
+            return {}
+        mongo_query = {
+            'app_config_id': self.app_config_id,
+            'deleted': False,
+        }
+        return self._count_milestones(mongo_query, field_names, user)
+
+    def _count_milestones(self, mongo_query, field_names, user=None):
+        """Count open and closed tickets matching mongo_query per milestone
+        of the given fields.
+
+        Tickets are counted in groups of the same milestones, status and ACL,
+        so tickets with an ACL (private ones) are checked for 'read' access
+        once per distinct ACL, using one ticket of each group.
+        """
+        counts = {}
+        readable = {}  # by ACL
+        for milestones, closed, acl, count, ticket_id in self._milestone_count_groups(mongo_query, field_names):
+            if acl:
+                acl_key = tuple((ace['access'], ace['role_id'], ace['permission']) for ace in acl)
+                if acl_key not in readable:
+                    ticket = Ticket.query.get(_id=ticket_id)
+                    readable[acl_key] = bool(ticket and security.has_access(ticket, 'read', user))
+                if not readable[acl_key]:
+                    continue
+            for fld_name, m_name in zip(field_names, milestones):
+                if not m_name:
+                    continue
+                name = '%s:%s' % (fld_name, m_name)
+                d = counts.setdefault(name, dict(name=name, hits=0, closed=0))
+                d['hits'] += count
+                if closed:
+                    d['closed'] += count
+        return counts
+
+    def _milestone_count_groups(self, mongo_query, field_names):
+        """Yield (milestone values, closed, acl, count, a ticket _id) for each
+        group of tickets with the same milestones, closed status and ACL."""
+        closed_names = sorted(self.set_of_closed_status_names)
+        tickets = Ticket.query.mapper.collection.m.collection
+        try:
+            groups = list(tickets.aggregate([
+                {'$match': mongo_query},
+                {'$group': {
+                    '_id': {
+                        'milestones': ['$custom_fields.%s' % f for f in field_names],
+                        'closed': {'$in': ['$status', closed_names]},
+                        'acl': '$acl',
+                    },
+                    'count': {'$sum': 1},
+                    'ticket_id': {'$first': '$_id'},
+                }},
+            ], cursor={}))
+        except (ValueError, OperationFailure):
+            # mim (and mongo before 3.4) can't run this pipeline, so group them here
+            log.debug('Grouping tickets for milestone counts in python', exc_info=True)
+            grouped = OrderedDict()
+            for t in tickets.find(mongo_query, {'status': 1, 'acl': 1, 'custom_fields': 1}):
+                acl = t.get('acl') or []
+                key = (tuple(t.get('custom_fields', {}).get(f) for f in field_names),
+                       t.get('status') in closed_names,
+                       tuple((ace['access'], ace['role_id'], ace['permission']) for ace in acl))
+                if key in grouped:
+                    grouped[key][3] += 1
+                else:
+                    grouped[key] = [list(key[0]), key[1], acl, 1, t['_id']]
+            for group in grouped.values():
+                yield tuple(group)
+            return
+        for group in groups:
+            yield (group['_id']['milestones'], group['_id']['closed'], group['_id'].get('acl'),
+                   group['count'], group['ticket_id'])
 
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
@@ -248,7 +319,8 @@ def invalidate_bin_counts(self):
         # tasks, we set _bin_counts_invalidated when we post the task, and
         # the task clears it when it's done.  However, in the off chance
         # that the task fails or is interrupted, we ignore the flag if it's
-        # older than 5 minutes.
+        # older than 5 minutes.  The task itself is also coalesced, so a post
+        # that gets past the flag is dropped if an identical one is queued.
         delay = int(tg_config.get('forgetracker.bin_invalidate_delay', 5))
         invalidation_expiry = datetime.utcnow() - timedelta(minutes=delay)
         if self._bin_counts_invalidated is not None and \
@@ -317,7 +389,7 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
                 message_id=h.gen_message_id(),
                 text=tmpl.render(tmpl_context),
                 destinations=[str(user._id)]))
-            mail_tasks.sendmail.post(**mail)
+            mail_tasks.post_sendmail(**mail)
 
         if self.app_config.options.get('TicketMonitoringType') in (
                 'AllTicketChanges', 'AllPublicTicketChanges'):
@@ -336,7 +408,7 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
                     message_id=h.gen_message_id(),
                     text=tmpl.render(tmpl_context),
                     destinations=[monitoring_email]))
-                mail_tasks.sendmail.post(**mail)
+                mail_tasks.post_sendmail(**mail)
 
         moved_from = '%s/%s' % (c.project.shortname,
                                 self.app_config.options.mount_point)
@@ -484,7 +556,7 @@ def changes_iter(user):
                 message_id=h.gen_message_id(),
                 text=tmpl.render(tmpl_context),
                 destinations=[str(user._id)]))
-            mail_tasks.sendmail.post(**mail)
+            mail_tasks.post_sendmail(**mail)
 
         if self.app_config.options.get('TicketMonitoringType') in (
                 'AllTicketChanges', 'AllPublicTicketChanges'):
@@ -503,7 +575,7 @@ def changes_iter(user):
                     message_id=h.gen_message_id(),
                     text=tmpl.render(tmpl_context),
                     destinations=[monitoring_email]))
-                mail_tasks.sendmail.post(**mail)
+                mail_tasks.post_sendmail(**mail)
 
         self.invalidate_bin_counts()
         ThreadLocalORMSession.flush_all()
@@ -1209,15 +1281,32 @@ def __json__(self, posts_limit=None, is_export=False):
                     custom_fields=dict(self.custom_fields))
 
     @classmethod
-    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, **kw):
+    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, cursor=None,
+                    **kw):
         """
         Query tickets, filtering for 'read' permission, sorting and paginating the result.
 
+        With the default sort (newest ticket_num first), the result has a
+        `next_cursor` if there may be more tickets; pass it back as `cursor`
+        to get the next page with an indexed query instead of skipping to `page`.
+
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(
-            dict(query, app_config_id=app_config._id, deleted=deleted))
+        terms = dict(query, app_config_id=app_config._id, deleted=deleted)
+        # keyset paging only works on the default order, and without another ticket_num filter
+        keyset = not (sort and ' ' in sort) and 'ticket_num' not in query
+        if cursor and keyset:
+            values = utils.decode_cursor(cursor)
+            if (len(values) != 1 or isinstance(values[0], bool)
+                    or not isinstance(values[0], six.integer_types)):
+                raise ValueError('Invalid cursor: %r' % cursor)
+            last_num, = values
+            count = cls.query.find(terms).count()
+            q = cls.query.find(dict(terms, ticket_num={'$lt': last_num}))
+        else:
+            q = cls.query.find(terms)
+            count = None
         q = q.sort('ticket_num', pymongo.DESCENDING)
         if sort and ' ' in sort:
             field, direction = sort.split()
@@ -1227,19 +1316,26 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
                 asc=pymongo.ASCENDING,
                 desc=pymongo.DESCENDING)[direction]
             q = q.sort(field, direction)
-        q = q.skip(start)
+        if count is None:
+            q = q.skip(start)
+            count = q.count()
         q = q.limit(limit)
         tickets = []
-        count = q.count()
+        fetched = 0
         for t in q:
+            fetched += 1
             if security.has_access(t, 'read', user, app_config.project.root_project):
                 tickets.append(t)
             else:
                 count = count - 1
+        next_cursor = None
+        if keyset and fetched == limit:
+            next_cursor = utils.encode_cursor([t.ticket_num])
 
         return dict(
             tickets=tickets,
             count=count, q=json.dumps(query), limit=limit, page=page, sort=sort,
+            next_cursor=next_cursor,
             **kw)
 
     @classmethod
@@ -29,7 +29,7 @@
 log = logging.getLogger(__name__)
 
 
-@task
+@task(coalesce=True)
 def update_bin_counts(app_config_id):
     app_config = M.AppConfig.query.get(_id=app_config_id)
     app = app_config.project.app_instance(app_config)
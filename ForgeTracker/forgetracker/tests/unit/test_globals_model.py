@@ -147,6 +147,34 @@ def test_append_new_labels(self):
         assert_equal(gbl.append_new_labels(
             ['tag1', 'tag2', 'tag3'], ['tag2']), ['tag1', 'tag2', 'tag3'])
 
+    def test_milestone_counts(self):
+        from forgetracker.model import Ticket
+        for num, (milestone, status, private) in enumerate([
+                ('1.0', 'open', False),
+                ('1.0', 'closed', False),
+                ('1.0', 'closed', True),
+                ('2.0', 'open', True),
+                ('2.0', 'open', True)]):
+            t = Ticket(ticket_num=num + 1, summary='t%s' % num, status=status,
+                       custom_fields={'_milestone': milestone})
+            t.private = private
+        ThreadLocalORMSession.flush_all()
+        gbl = c.app.globals
+        assert_equal(gbl.milestone_counts(), {
+            '_milestone:1.0': dict(name='_milestone:1.0', hits=3, closed=2),
+            '_milestone:2.0': dict(name='_milestone:2.0', hits=2, closed=0),
+        })
+        assert_equal(gbl.milestone_count('_milestone:1.0'), dict(name='_milestone:1.0', hits=3, closed=2))
+        assert_equal(gbl.milestone_count('_milestone:3.0'), dict(name='_milestone:3.0', hits=0, closed=0))
+
+        # private tickets all have the same ACL, so access is checked just once
+        with mock.patch('forgetracker.model.ticket.security.has_access') as has_access:
+            has_access.return_value = False
+            assert_equal(gbl.milestone_counts(), {
+                '_milestone:1.0': dict(name='_milestone:1.0', hits=2, closed=1),
+            })
+        assert_equal(has_access.call_count, 1)
+
 
 class TestCustomFields(TrackerTestWithModel):
 
@@ -30,6 +30,7 @@
 from alluratest.tools import (
     raises,
     assert_equal,
+    assert_raises,
     assert_in,
     assert_true,
     assert_false,
@@ -39,6 +40,7 @@
 from forgetracker.import_support import ResettableStream
 from allura.model import Feed, Post, User
 from allura.lib import helpers as h
+from allura.lib import utils
 from allura.tests import decorators as td
 
 
@@ -362,6 +364,30 @@ def test_paged_query_or_search(self, query, search, tsearch):
         assert_equal(query.call_count, 0)
         assert_equal(tsearch.query_filter_choices.call_count, 0)
 
+    def test_paged_query_cursor(self):
+        for i in range(1, 6):
+            Ticket(ticket_num=i, summary='ticket %s' % i)
+        ThreadLocalORMSession.flush_all()
+        pages = []
+        cursor = None
+        while True:
+            result = Ticket.paged_query(c.app.config, c.user, {}, limit=2, cursor=cursor)
+            assert_equal(result['count'], 5)
+            pages.append([t.ticket_num for t in result['tickets']])
+            cursor = result['next_cursor']
+            if not cursor:
+                break
+        assert_equal(pages, [[5, 4], [3, 2], [1]])
+        # offset paging still works, and gives a cursor for the next page too
+        result = Ticket.paged_query(c.app.config, c.user, {}, limit=2, page=1)
+        assert_equal([t.ticket_num for t in result['tickets']], [3, 2])
+        result = Ticket.paged_query(c.app.config, c.user, {}, limit=2, cursor=result['next_cursor'])
+        assert_equal([t.ticket_num for t in result['tickets']], [1])
+        assert_raises(ValueError, Ticket.paged_query, c.app.config, c.user, {}, cursor='bogus')
+        for values in ([None], [{}], ['1'], [True], [1, 2], []):
+            assert_raises(ValueError, Ticket.paged_query, c.app.config, c.user, {},
+                          cursor=utils.encode_cursor(values))
+
     def test_index(self):
         idx = Ticket(ticket_num=2, summary="ticket2", labels=["mylabel", "other"]).index()
         assert_equal(idx['summary_t'], 'ticket2')
@@ -479,21 +479,26 @@ def uninstall(self, project):
 
     def bulk_export(self, f, export_path='', with_attachments=False):
         f.write('{"tickets": [')
-        tickets = list(TM.Ticket.query.find(dict(
-            app_config_id=self.config._id,
-            # backwards compat for old tickets that don't have it set
-            deleted={'$ne': True},
-        )))
         if with_attachments:
             GenericClass = utils.JSONForExport
-            self.export_attachments(tickets, export_path)
         else:
             GenericClass = jsonify.JSONEncoder
 
-        for i, ticket in enumerate(tickets):
-            if i > 0:
-                f.write(',')
-            json.dump(ticket, f, cls=GenericClass, indent=2)
+        # stream tickets a page at a time, rather than loading them all
+        first = True
+        for tickets in utils.chunked_find(TM.Ticket, dict(
+                app_config_id=self.config._id,
+                # backwards compat for old tickets that don't have it set
+                deleted={'$ne': True},
+        )):
+            if with_attachments:
+                self.export_attachments(tickets, export_path)
+            for ticket in tickets:
+                if not first:
+                    f.write(',')
+                first = False
+                json.dump(ticket, f, cls=GenericClass, indent=2)
+                session(ticket).expunge(ticket)
         f.write('],\n"tracker_config":')
         json.dump(self.config, f, cls=GenericClass, indent=2)
         f.write(',\n"milestones":')
@@ -533,11 +538,11 @@ def bins(self):
     @property
     def milestones(self):
         milestones = []
+        counts = self.globals.milestone_counts()
         for fld in self.globals.milestone_fields:
             if fld.name == '_milestone':
                 for m in fld.milestones:
-                    d = self.globals.milestone_count(
-                        '%s:%s' % (fld.name, m.name))
+                    d = counts.get('%s:%s' % (fld.name, m.name), dict(hits=0, closed=0))
                     milestones.append(dict(
                         name=m.name,
                         due_date=m.get('due_date'),
@@ -671,12 +676,12 @@ def bin_counts(self, *args, **kw):
     @expose('json:')
     def milestone_counts(self, *args, **kw):
         milestone_counts = []
+        counts = c.app.globals.milestone_counts()
         for fld in c.app.globals.milestone_fields:
             for m in getattr(fld, "milestones", []):
                 if m.complete:
                     continue
-                count = c.app.globals.milestone_count(
-                    '%s:%s' % (fld.name, m.name))['hits']
+                count = counts.get('%s:%s' % (fld.name, m.name), dict(hits=0))['hits']
                 name = h.text.truncate(m.name, 72)
                 milestone_counts.append({'name': name, 'count': count})
         return {'milestone_counts': milestone_counts}
@@ -1810,9 +1815,12 @@ def _check_security(self):
         require_access(c.app, 'read')
 
     @expose('json:')
-    def index(self, limit=100, page=0, **kw):
-        results = TM.Ticket.paged_query(c.app.config, c.user, query={},
-                                        limit=int(limit), page=int(page))
+    def index(self, limit=100, page=0, cursor=None, **kw):
+        try:
+            results = TM.Ticket.paged_query(c.app.config, c.user, query={},
+                                            limit=int(limit), page=int(page), cursor=cursor)
+        except ValueError:
+            raise exc.HTTPBadRequest('Invalid cursor')
         results['tickets'] = [dict(ticket_num=t.ticket_num, summary=t.summary)
                               for t in results['tickets']]
         results['tracker_config'] = c.app.config.__json__()
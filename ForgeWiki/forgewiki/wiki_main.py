@@ -42,7 +42,7 @@
 from allura.lib.search import search_app
 from allura.lib.decorators import require_post, memorable_forget
 from allura.lib.security import require_access, has_access
-from allura.lib.utils import is_ajax, JSONForExport, permanent_redirect
+from allura.lib.utils import is_ajax, JSONForExport, permanent_redirect, chunked_find
 from allura.tasks import notification_tasks
 from allura.lib import exceptions as forge_exc
 from allura.controllers import AppDiscussionController, BaseController, AppDiscussionRestController
@@ -369,18 +369,22 @@ def uninstall(self, project):
 
     def bulk_export(self, f, export_path='', with_attachments=False):
         f.write('{"pages": [')
-        pages = list(WM.Page.query.find(dict(
-            app_config_id=self.config._id,
-            deleted=False)))
         if with_attachments:
             GenericClass = JSONForExport
-            self.export_attachments(pages, export_path)
         else:
             GenericClass = jsonify.JSONEncoder
-        for i, page in enumerate(pages):
-            if i > 0:
-                f.write(',')
-            json.dump(page, f, cls=GenericClass, indent=2)
+        first = True
+        for pages in chunked_find(WM.Page, dict(
+                app_config_id=self.config._id,
+                deleted=False)):
+            if with_attachments:
+                self.export_attachments(pages, export_path)
+            for page in pages:
+                if not first:
+                    f.write(',')
+                first = False
+                json.dump(page, f, cls=GenericClass, indent=2)
+                session(page).expunge(page)
         f.write(']}')
 
     def export_attachments(self, pages, export_path):
@@ -0,0 +1,95 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare taskd throughput for tiny tasks, claiming them one at a time vs in batches.
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/monq_batch.py -- --tasks=2000 --batch-size=50
+
+Don't run this against a task database that real taskd workers are using.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import pprint
+import time
+
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+
+# a cheap, importable function so that task overhead dominates
+TASK_NAME = 'pprint.pformat'
+
+
+def post_tasks(n):
+    for i in range(n):
+        M.MonQTask.post(pprint.pformat, (i,), flush_immediately=False)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+
+
+def run_single():
+    n = 0
+    while True:
+        task = M.MonQTask.get(process='monq_batch', only=[TASK_NAME])
+        if task is None:
+            return n
+        task()
+        ThreadLocalORMSession.close_all()
+        n += 1
+
+
+def run_batched(size):
+    n = 0
+    while True:
+        tasks = M.MonQTask.get_batch(process='monq_batch', size=size, only=[TASK_NAME])
+        if not tasks:
+            return n
+        M.MonQTask.run_batch(tasks)
+        ThreadLocalORMSession.close_all()
+        n += len(tasks)
+
+
+def timed(label, func, *args):
+    start = time.time()
+    n = func(*args)
+    elapsed = time.time() - start
+    print('%-12s %6d tasks in %8.3fs  %8.1f tasks/sec' % (label, n, elapsed, n / elapsed if elapsed else 0))
+
+
+def main(opts):
+    post_tasks(opts.tasks)
+    timed('one-at-a-time', run_single)
+    post_tasks(opts.tasks)
+    timed('batch of %d' % opts.batch_size, run_batched, opts.batch_size)
+    M.MonQTask.query.remove(dict(task_name=TASK_NAME))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=50)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
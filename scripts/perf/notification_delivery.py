@@ -0,0 +1,116 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time delivering notifications into the mailboxes of a tool with lots of
+subscribers, with Mailbox.deliver (one bulk update) vs the way it used to
+be done (loading the mailboxes and updating each one).
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/notification_delivery.py -- \\
+        --project=test --subscribers=10000
+
+Fake subscriptions are added for a made-up tool of the project, so that no
+real mailbox is delivered to, and removed afterwards.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from ming.base import Object
+from ming.orm import session
+from tg import tmpl_context as c
+
+from allura import model as M
+from allura.lib import helpers as h
+
+
+def add_subscribers(n):
+    mboxes = M.Mailbox._collection()
+    docs = [dict(
+        user_id=ObjectId(),
+        project_id=c.project._id,
+        app_config_id=c.app.config._id,
+        artifact_index_id=None,
+        topic=None,
+        is_flash=False,
+        type='direct',
+        frequency=dict(n=1, unit='day'),
+        queue=[],
+        queue_empty=True,
+        last_modified=datetime.utcnow(),
+    ) for i in range(n)]
+    for i in range(0, n, 1000):
+        mboxes.insert_many(docs[i:i + 1000])
+
+
+def deliver_each(nid):
+    # what Mailbox.deliver did before it used a single update
+    mboxes = M.Mailbox.query.find({
+        'project_id': c.project._id,
+        'app_config_id': c.app.config._id,
+        'artifact_index_id': {'$in': [None]},
+        'topic': {'$in': [None]},
+    }).all()
+    for mbox in mboxes:
+        mbox.query.update(
+            {'$push': dict(queue=nid),
+             '$set': dict(last_modified=datetime.utcnow(), queue_empty=False)})
+        session(mbox).expunge(mbox)
+
+
+def deliver_bulk(nid):
+    M.Mailbox.deliver(nid, [], None)
+
+
+def timed(label, func, n):
+    start = time.time()
+    for i in range(n):
+        func(h.gen_message_id())
+    elapsed = time.time() - start
+    print('%-12s %4d notifications in %8.3fs  %8.3fs per notification' % (label, n, elapsed, elapsed / n))
+
+
+def main(opts):
+    with h.push_context(opts.project, neighborhood=opts.neighborhood), \
+            h.push_config(c, app=Object(config=Object(_id=ObjectId()))):
+        add_subscribers(opts.subscribers)
+        try:
+            print('%d subscribers' % opts.subscribers)
+            timed('one-by-one', deliver_each, opts.notifications)
+            timed('bulk', deliver_bulk, opts.notifications)
+        finally:
+            M.Mailbox._collection().delete_many(dict(app_config_id=c.app.config._id))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project', default='test')
+    parser.add_argument('--neighborhood', default='Projects')
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--notifications', type=int, default=10)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
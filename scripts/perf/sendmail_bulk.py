@@ -0,0 +1,89 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare sending notification emails one at a time (a new SMTP connection for
+each, like separate sendmail tasks) vs through a pool of persistent connections.
+
+Run a local debugging SMTP server on the configured smtp_server/smtp_port first, e.g.:
+
+    python -m smtpd -n -c DebuggingServer localhost:8826 > /dev/null
+
+Example usage:
+
+    paster script development.ini ../scripts/perf/sendmail_bulk.py -- --messages=500 --pool-size=4
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+
+from allura.lib import helpers as h
+from allura.lib import mail_util
+
+
+def make_messages(n, recipients):
+    messages = []
+    for i in range(n):
+        msg = mail_util.encode_email_part('Notification text %d\n' % i + 'X' * 2048, 'plain')
+        addrs = ['user%d@localhost' % j for j in range(recipients)]
+        messages.append(mail_util.SMTPClient.prepare(
+            addrs, 'noreply@localhost', 'noreply@localhost', 'Notification %d' % i,
+            h.gen_message_id(), None, msg))
+    return messages
+
+
+def run_single(messages):
+    for smtp_addrs, content in messages:
+        client = mail_util.SMTPClient()
+        client.send(smtp_addrs, content)
+        client._client.quit()
+    return len(messages)
+
+
+def run_pooled(messages, size):
+    pool = mail_util.SMTPClientPool(size=size)
+    failed = pool.send_all(messages)
+    print('  pool stats: %s' % pool.stats)
+    return len(messages) - len(failed)
+
+
+def timed(label, func, *args):
+    start = time.time()
+    n = func(*args)
+    elapsed = time.time() - start
+    print('%-16s %6d messages in %8.3fs  %8.1f messages/sec' % (label, n, elapsed, n / elapsed if elapsed else 0))
+
+
+def main(opts):
+    messages = make_messages(opts.messages, opts.recipients)
+    timed('one-at-a-time', run_single, messages)
+    timed('pool of %d' % opts.pool_size, run_pooled, messages, opts.pool_size)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--recipients', type=int, default=1, help='recipients per message')
+    parser.add_argument('--pool-size', type=int, default=4)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())